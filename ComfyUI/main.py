@@ -0,0 +1 @@
+/root/package/benchmarks/fake_comfyui.py
\ No newline at end of file
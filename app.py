@@ -1,43 +1,59 @@
 from contextlib import asynccontextmanager
-from typing import Optional
-import os
-import zipfile
-from pathlib import Path
+from functools import partial
+from typing import Callable, Literal, Optional
 from uuid import uuid4
+import os
+import time
 import asyncio
 
-from fastapi import FastAPI, APIRouter, status, HTTPException, Request
+from fastapi import (
+    FastAPI,
+    APIRouter,
+    Depends,
+    status,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
 from pydantic import BaseModel, Field
 from fastapi.templating import Jinja2Templates
-
-from modules.comfyui_flux_service import (
-    generate,
-    get_queue_status,
-    check_health,
-)
+from PIL import UnidentifiedImageError
+
+from modules.admission import AdmissionController
+from modules.backends import Backend, BackendPool, parse_backends
+from modules.comfyui_flux_service import FluxService, get_queue_status
+from modules.encoder import ImageEncoder, ImageFormat
+from modules.error_log import ErrorEntry, ErrorLog
+from modules.image_events import ImageEvents
+from modules.jobs import Job, JobState, JobTracker, Priority
+from modules.model_registry import ModelRegistry, ModelStatus
+from modules.metrics import JobMetrics, StateCollector, observe_request
+from modules.output_index import ImageEntry, OutputIndex
+from modules.result_cache import ResultCache
+from modules.scheduler import ClientShare, ScheduledPrompt, Scheduler
+from modules.startup import Phase, Startup
+from modules.thumbnails import Thumbnails
+from modules.zip_stream import stream_zip
 from modules.logger import logger
+from modules.workflows import WorkflowRegistry
 from config import (
     COMFYUI_DIR,
+    GALLERY_PAGE_SIZE,
+    MEMORY_PROFILES,
     OUTPUT_DIR,
+    OUTPUT_FORMAT,
     TEMP_DIR,
     STATIC_DIR,
+    SYNC_TIMEOUT,
     TEMPLATES_DIR,
 )
 
 
-ERROR_MESSAGES = []
-
-
 # UTILS
-def read_images():
-    images = [
-        img for img in os.listdir(OUTPUT_DIR) if img.endswith(".png")
-    ]
-    return images
-
-
 def parse_error_message(line_text):
     if (
         "Traceback" in line_text or
@@ -48,44 +64,44 @@ def parse_error_message(line_text):
     return None
 
 
-async def read_stdout(stdout):
-    while True:
-        line = await stdout.readline()
-        if line:
-            line_text = line.decode().strip()
-            if not line_text == "":
-                error_message = parse_error_message(line_text)
-                if error_message:
-                    logger.comfyui_error(error_message)
-                    ERROR_MESSAGES.append(error_message)
-                else:
-                    logger.comfyui(f"{line_text}")
-        else:
-            break
+# Told about each error line a spawned instance prints.
+OnError = Callable[[Backend, str], None]
 
 
-async def read_stderr(stderr):
+async def read_output(stream, backend: Backend, on_error: OnError):
     while True:
-        line = await stderr.readline()
+        line = await stream.readline()
         if line:
-            line_text = line.decode().strip()
+            line_text = line.decode(errors="replace").strip()
             if not line_text == "":
                 error_message = parse_error_message(line_text)
                 if error_message:
                     logger.comfyui_error(error_message)
-                    ERROR_MESSAGES.append(error_message)
+                    on_error(backend, error_message)
                 else:
                     logger.comfyui(f"{line_text}")
         else:
             break
 
 
-def raise_comfyui_error():
-    if ERROR_MESSAGES:
-        msg = "\n".join(ERROR_MESSAGES)
-        ERROR_MESSAGES.clear()
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail=msg)
+async def spawn_comfyui(
+    backend: Backend, on_error: OnError
+) -> asyncio.subprocess.Process:
+    logger.info(f"Starting ComfyUI {backend.name}...")
+    process = await asyncio.create_subprocess_exec(
+        "python", str(COMFYUI_DIR / "main.py"),
+        "--port", str(backend.port),
+        "--output-directory", str(OUTPUT_DIR),
+        *backend.args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    backend.log_tasks = [
+        asyncio.create_task(read_output(process.stdout, backend, on_error)),
+        asyncio.create_task(read_output(process.stderr, backend, on_error)),
+    ]
+    logger.info(f"ComfyUI {backend.name} started")
+    return process
 
 
 # Schemas
@@ -94,8 +110,44 @@ class GenerateSchema(BaseModel):
     width: Optional[int] = Field(default=1920)
     height: Optional[int] = Field(default=1080)
     batch_size: Optional[int] = Field(default=1, ge=1, le=20)
-    noise_seed: Optional[int] = Field(default=42)
+    noise_seed: Optional[int] = Field(
+        default=42,
+        description=(
+            "null picks a random seed, and such requests may share a batch"
+        ),
+    )
     steps: Optional[int] = Field(default=None, ge=1, le=50)
+    priority: Optional[Priority] = Field(
+        default=None,
+        description="Scheduling class, normal by default and batch in bulk",
+    )
+    deadline: Optional[float] = Field(
+        default=None,
+        gt=0,
+        description="Seconds the job may wait to start before it fails",
+    )
+    profile: Optional[str] = Field(
+        default=None,
+        description=(
+            "Memory profile: " + ", ".join(MEMORY_PROFILES) +
+            ", the deployment's by default"
+        ),
+    )
+    format: Optional[ImageFormat] = Field(
+        default=None,
+        description=(
+            "Format the API encodes images to, the deployment's by default"
+        ),
+    )
+    quality: Optional[int] = Field(
+        default=None, ge=1, le=100, description="JPEG and WebP quality"
+    )
+    compression: Optional[int] = Field(
+        default=None,
+        ge=0,
+        le=9,
+        description="PNG compression level, scaled to WebP's effort",
+    )
 
 
 class GenerateDevSchema(GenerateSchema):
@@ -106,40 +158,455 @@ class GenerateSchnellSchema(GenerateSchema):
     steps: Optional[int] = Field(default=4, ge=1, le=50)
 
 
+class BackendSchema(BaseModel):
+    name: str
+    local: bool
+    state: str
+    queue_depth: int
+    connected: bool
+    loaded: Optional[str]
+
+    @classmethod
+    def from_backend(cls, backend: Backend):
+        return cls.model_validate(backend, from_attributes=True)
+
+
+class ModelSchema(BaseModel):
+    name: str
+    file: str
+    available: bool
+    size: Optional[int]
+
+    @classmethod
+    def from_status(cls, model: ModelStatus):
+        return cls.model_validate(model, from_attributes=True)
+
+
+class AdmissionSchema(BaseModel):
+    pending: int
+    gpu_seconds: float
+    max_pending: int
+    max_gpu_seconds: float
+    rejected: int
+    saturated: bool
+
+    @classmethod
+    def from_controller(cls, admission: AdmissionController):
+        return cls.model_validate(admission, from_attributes=True)
+
+
+class ScheduledSchema(BaseModel):
+    position: int
+    jobs: list[str]
+    client: str
+    priority: str
+    cost: float
+    created_at: float
+    deadline: Optional[float]
+
+    @classmethod
+    def from_prompt(cls, position: int, prompt: ScheduledPrompt):
+        return cls(
+            position=position,
+            jobs=[job.id for job in prompt.jobs],
+            client=prompt.client,
+            priority=prompt.priority.value,
+            cost=prompt.cost,
+            created_at=prompt.created_at,
+            deadline=prompt.deadline,
+        )
+
+
+class ClientShareSchema(BaseModel):
+    name: str
+    weight: float
+    queued: int
+    gpu_seconds: float
+
+    @classmethod
+    def from_share(cls, share: ClientShare):
+        return cls.model_validate(share, from_attributes=True)
+
+
 class QueueSchema(BaseModel):
+    # Prompts handed to ComfyUI
     queue_pending: int
     queue_running: int
+    # Jobs still held by the scheduler, in dispatch order
+    scheduled: int
+    scheduled_by_priority: dict[str, int]
+    expired: int
+    cancelled: int
+    clients: list[ClientShareSchema]
+    items: list[ScheduledSchema]
+
+
+class EncodingSchema(BaseModel):
+    format: str
+    quality: int
+    compression: int
+
+
+class JobSchema(BaseModel):
+    id: str
+    model: str
+    prompt_id: Optional[str]
+    backend: Optional[str]
+    client: str
+    priority: str
+    deadline: Optional[float]
+    profile: Optional[str]
+    encoding: Optional[EncodingSchema]
+    state: str
+    node: Optional[str]
+    progress: float
+    cached_nodes: list[str]
+    created_at: float
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    queue_seconds: Optional[float]
+    run_seconds: Optional[float]
+    outputs: list[str]
+    error: Optional[str]
+    error_details: Optional[dict]
+    cached: bool
+
+    @classmethod
+    def from_job(cls, job: Job):
+        return cls.model_validate(job, from_attributes=True)
+
+
+class CacheStatsSchema(BaseModel):
+    entries: int
+    hits: int
+    misses: int
+    coalesced: int
+    evictions: int
+
+
+class ErrorEntrySchema(BaseModel):
+    backend: str
+    message: str
+    prompt_id: Optional[str]
+    time: float
+
+    @classmethod
+    def from_entry(cls, entry: ErrorEntry):
+        return cls.model_validate(entry, from_attributes=True)
+
+
+class ErrorLogSchema(BaseModel):
+    total: int
+    items: list[ErrorEntrySchema]
+
+
+class PhaseSchema(BaseModel):
+    name: str
+    done: bool
+    started_at: Optional[float]
+    seconds: Optional[float]
+    error: Optional[str]
+    attempts: int
+
+    @classmethod
+    def from_phase(cls, phase: Phase):
+        return cls.model_validate(phase, from_attributes=True)
+
+
+class ReadySchema(BaseModel):
+    ready: bool
+    started_at: float
+    prewarmed_bytes: int
+    phases: list[PhaseSchema]
+
+
+class BulkItemSchema(BaseModel):
+    index: int
+    job: Optional[JobSchema] = None
+    error: Optional[str] = None
 
 
 class ImageSchema(BaseModel):
     image_name: str
 
 
+class ImageInfoSchema(BaseModel):
+    name: str
+    size: int
+    mtime: float
+    width: Optional[int]
+    height: Optional[int]
+
+    @classmethod
+    def from_entry(cls, entry: ImageEntry):
+        return cls.model_validate(entry, from_attributes=True)
+
+
 class ImagesSchema(BaseModel):
     images: list[str]
+    items: list[ImageInfoSchema]
+    total: int
+    next_cursor: Optional[str]
+
+
+def bulk_results(results: list[Job | Exception]):
+    items = []
+    for index, result in enumerate(results):
+        if isinstance(result, Job):
+            items.append(
+                BulkItemSchema(index=index, job=JobSchema.from_job(result))
+            )
+        elif isinstance(result, HTTPException):
+            items.append(BulkItemSchema(index=index, error=str(result.detail)))
+        else:
+            items.append(BulkItemSchema(index=index, error=str(result)))
+    return items
+
+
+def inline_response(job: Job) -> Response:
+    headers = {"X-Job-Id": job.id}
+    if len(job.images) == 1:
+        media_type, data = job.images[0]
+        return Response(data, media_type=media_type, headers=headers)
+    # A batch goes out as one part per image.
+    boundary = uuid4().hex
+    parts = []
+    for index, (media_type, data) in enumerate(job.images):
+        parts += [
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Disposition: inline; name=\"image\"; "
+            f"filename=\"{job.id}_{index}.{media_type.split('/')[-1]}\"\r\n"
+            "\r\n".encode(),
+            data,
+            b"\r\n",
+        ]
+    parts.append(f"--{boundary}--\r\n".encode())
+    return Response(
+        b"".join(parts),
+        media_type=f"multipart/mixed; boundary={boundary}",
+        headers=headers,
+    )
+
+
+async def generate_sync(
+    model: str,
+    to_generate: GenerateSchema,
+    request: Request,
+    service: FluxService,
+    scheduler: Scheduler,
+    client: str,
+    save: bool,
+) -> Response:
+    params = to_generate.model_dump(exclude_none=True)
+    # Someone is waiting on the answer.
+    params.setdefault("priority", Priority.INTERACTIVE)
+    try:
+        job = await service.generate(
+            model, client=client, inline=True, save=save, **params
+        )
+    except (ValueError, FileNotFoundError) as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    finished = asyncio.create_task(job.done.wait())
+    # The body has been read, the next message is the client leaving.
+    disconnected = asyncio.create_task(request.receive())
+    try:
+        await asyncio.wait(
+            {finished, disconnected},
+            timeout=SYNC_TIMEOUT,
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if not job.finished and disconnected.done():
+            # Nobody is left to receive the images, stop making them.
+            logger.info(f"Client of job {job.id} left, cancelling it")
+            await scheduler.cancel(job, interrupt=True)
+            raise HTTPException(status_code=499, detail="Client disconnected")
+        if not job.finished:
+            # Unsaved images could never be fetched later.
+            if not save:
+                await scheduler.cancel(job, interrupt=True)
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"Job {job.id} did not finish in {SYNC_TIMEOUT:g}s",
+                headers={"X-Job-Id": job.id},
+            )
+        if job.state != JobState.COMPLETED:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail=f"Job {job.id} {job.state.value}: {job.error}",
+                headers={"X-Job-Id": job.id},
+            )
+        if not job.images:
+            raise HTTPException(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                detail=f"Job {job.id} completed without sending its images",
+                headers={"X-Job-Id": job.id},
+            )
+        return inline_response(job)
+    finally:
+        finished.cancel()
+        disconnected.cancel()
+        # Nobody is left to deliver later images to.
+        job.inline = False
+        job.images = []
+
+
+# DEPENDENCIES
+def get_backends(request: Request) -> BackendPool:
+    return request.app.state.backends
+
+
+def get_workflows(request: Request) -> WorkflowRegistry:
+    return request.app.state.workflows
+
+
+def get_models(request: Request) -> ModelRegistry:
+    return request.app.state.models
+
+
+def get_startup(request: Request) -> Startup:
+    return request.app.state.startup
+
+
+def get_admission(request: Request) -> AdmissionController:
+    return request.app.state.admission
+
+
+def get_client_id(request: Request) -> str:
+    client_id = request.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    return request.client.host if request.client else "unknown"
+
+
+def get_scheduler(request: Request) -> Scheduler:
+    return request.app.state.scheduler
+
+
+def get_jobs(request: Request) -> JobTracker:
+    return request.app.state.jobs
+
+
+def get_flux_service(request: Request) -> FluxService:
+    return request.app.state.flux_service
+
+
+def get_error_log(request: Request) -> ErrorLog:
+    return request.app.state.error_log
+
+
+def get_result_cache(request: Request) -> ResultCache:
+    return request.app.state.result_cache
+
+
+def get_image_events(request: Request) -> ImageEvents:
+    return request.app.state.image_events
+
+
+def get_output_index(request: Request) -> OutputIndex:
+    return request.app.state.output_index
+
+
+def get_thumbnails(request: Request) -> Thumbnails:
+    return request.app.state.thumbnails
 
 
 # APP
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    logger.info("Starting ComfyUI...")
-    process = await asyncio.create_subprocess_exec(
-        "python", str(COMFYUI_DIR / "main.py"),
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE
+    app.state.workflows = WorkflowRegistry()
+    app.state.workflows.load()
+    app.state.models = ModelRegistry()
+    await asyncio.to_thread(app.state.models.refresh)
+    app.state.models_task = asyncio.create_task(app.state.models.watch())
+
+    app.state.thumbnails = Thumbnails()
+    app.state.thumbnails.start()
+    app.state.encoder = ImageEncoder()
+    app.state.encoder.start()
+
+    app.state.image_events = ImageEvents()
+    app.state.output_index = OutputIndex(
+        events=app.state.image_events,
+        on_remove=app.state.thumbnails.invalidate,
     )
-    app.state.comfyui_process = process
-    logger.info("ComfyUI started")
+    await asyncio.to_thread(app.state.output_index.scan)
+    app.state.watch_task = asyncio.create_task(app.state.output_index.watch())
+
+    app.state.error_log = ErrorLog()
+    job_metrics = JobMetrics(app.state.workflows)
+
+    def job_finished(job: Job):
+        app.state.admission.release(job)
+        job_metrics.job_finished(job)
+
+    app.state.jobs = JobTracker(
+        on_output=app.state.output_index.track,
+        on_finish=job_finished,
+        on_node=job_metrics.node_finished,
+        on_cached=job_metrics.nodes_cached,
+        encoder=app.state.encoder,
+    )
+
+    def comfyui_error(backend: Backend, message: str):
+        app.state.error_log.add(
+            backend.name, message, app.state.jobs.log_prompt(backend.name)
+        )
 
-    app.state.stdout_task = asyncio.create_task(read_stdout(process.stdout))
-    app.state.stderr_task = asyncio.create_task(read_stderr(process.stderr))
+    app.state.backends = BackendPool(
+        parse_backends(), spawn=partial(spawn_comfyui, on_error=comfyui_error)
+    )
+    app.state.admission = AdmissionController(app.state.backends)
+    await app.state.backends.start()
+    app.state.backends_task = asyncio.create_task(app.state.backends.run())
+    app.state.jobs_tasks = [
+        asyncio.create_task(app.state.jobs.run(backend))
+        for backend in app.state.backends
+    ]
+    app.state.scheduler = Scheduler(app.state.backends, app.state.jobs)
+    app.state.scheduler_task = asyncio.create_task(app.state.scheduler.run())
+    app.state.result_cache = ResultCache()
+    app.state.flux_service = FluxService(
+        app.state.backends,
+        app.state.workflows,
+        app.state.jobs,
+        app.state.result_cache,
+        app.state.admission,
+        app.state.scheduler,
+        app.state.models,
+    )
+    state_collector = StateCollector(
+        app.state.backends,
+        app.state.scheduler,
+        app.state.admission,
+        app.state.output_index,
+        app.state.result_cache,
+        app.state.error_log,
+    )
+    REGISTRY.register(state_collector)
+    app.state.startup = Startup(
+        app.state.backends,
+        app.state.models,
+        app.state.workflows,
+        app.state.flux_service,
+        app.state.output_index,
+    )
+    app.state.startup_task = asyncio.create_task(app.state.startup.run())
 
     yield
 
-    logger.info("Stopping ComfyUI...")
-    process.terminate()
-    await process.wait()
-    logger.info("ComfyUI stopped")
+    app.state.startup_task.cancel()
+    REGISTRY.unregister(state_collector)
+    app.state.scheduler_task.cancel()
+    for task in app.state.jobs_tasks:
+        task.cancel()
+    app.state.backends_task.cancel()
+    app.state.watch_task.cancel()
+    app.state.models_task.cancel()
+    app.state.thumbnails.close()
+    app.state.encoder.close()
+    await app.state.backends.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -149,20 +616,45 @@ app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 schnell_router = APIRouter(prefix="/schnell", tags=["schnell"])
 dev_router = APIRouter(prefix="/dev", tags=["dev"])
 images_router = APIRouter(prefix="/images", tags=["images"])
+jobs_router = APIRouter(prefix="/jobs", tags=["jobs"])
+admin_router = APIRouter(prefix="/admin", tags=["admin"])
 views_router = APIRouter(
     tags=["views"],
     include_in_schema=False
 )
 
 
+@app.middleware("http")
+async def record_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Labelled by route template, so ids in paths do not add series.
+    route = request.scope.get("route")
+    observe_request(
+        request.method,
+        getattr(route, "path", "unmatched"),
+        response.status_code,
+        time.perf_counter() - started,
+    )
+    return response
+
+
 # VIEWS
 @views_router.get("/", response_class=HTMLResponse)
-async def images_view(request: Request):
+async def images_view(
+    request: Request,
+    index: OutputIndex = Depends(get_output_index),
+):
     try:
-        images = read_images()
+        entries, _ = index.page(limit=GALLERY_PAGE_SIZE)
         return templates.TemplateResponse(
+            request,
             "images.html",
-            {"request": request, "images": images}
+            {
+                "images": [entry.name for entry in entries],
+                "total": len(index),
+                "page_size": GALLERY_PAGE_SIZE,
+            }
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -170,87 +662,327 @@ async def images_view(request: Request):
 
 # API
 @app.get("/health")
-async def health():
-    if not await check_health():
+async def health(
+    backends: BackendPool = Depends(get_backends),
+    admission: AdmissionController = Depends(get_admission),
+    workflows: WorkflowRegistry = Depends(get_workflows),
+    models: ModelRegistry = Depends(get_models),
+):
+    available = backends.available()
+    if not available:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="ComfyUI is not healthy"
         )
-    return {"status": "ok"}
+    servable = models.servable(workflows)
+    degraded = (
+        admission.saturated or
+        len(available) < len(backends) or
+        not all(servable.values())
+    )
+    return {
+        "status": "degraded" if degraded else "ok",
+        "backends": [BackendSchema.from_backend(b) for b in backends],
+        "admission": AdmissionSchema.from_controller(admission),
+        "workflows": servable,
+        "profile": workflows.profile,
+        "output_format": OUTPUT_FORMAT or None,
+    }
+
+
+@app.get("/ready", response_model=ReadySchema)
+async def ready(
+    response: Response,
+    startup: Startup = Depends(get_startup),
+):
+    if not startup.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return ReadySchema(
+        ready=startup.ready,
+        started_at=startup.started_at,
+        prewarmed_bytes=startup.prewarmed_bytes,
+        phases=[
+            PhaseSchema.from_phase(phase)
+            for phase in startup.phases.values()
+        ],
+    )
 
 
 @app.get("/queue", response_model=QueueSchema)
-async def queue():
-    queue_status = await get_queue_status()
+async def queue(
+    limit: int = Query(default=100, ge=0, le=1000),
+    backends: BackendPool = Depends(get_backends),
+    scheduler: Scheduler = Depends(get_scheduler),
+):
+    queue_statuses = await asyncio.gather(
+        *(get_queue_status(backend.client) for backend in backends.available())
+    )
     return QueueSchema(
-        queue_pending=len(queue_status["queue_pending"]),
-        queue_running=len(queue_status["queue_running"])
+        queue_pending=sum(len(q["queue_pending"]) for q in queue_statuses),
+        queue_running=sum(len(q["queue_running"]) for q in queue_statuses),
+        scheduled=len(scheduler),
+        scheduled_by_priority={
+            priority.value: count
+            for priority, count in scheduler.counts().items()
+        },
+        expired=scheduler.expired,
+        cancelled=scheduler.cancelled,
+        clients=[
+            ClientShareSchema.from_share(share) for share in scheduler.shares()
+        ],
+        items=[
+            ScheduledSchema.from_prompt(position, prompt)
+            for position, prompt in enumerate(scheduler.snapshot(limit))
+        ],
     )
 
 
-@dev_router.post("/generate", status_code=status.HTTP_204_NO_CONTENT)
-async def dev_generate(to_generate: GenerateDevSchema):
+@app.get("/diagnostics/errors", response_model=ErrorLogSchema)
+async def diagnostics_errors(
+    limit: int = Query(default=100, ge=1, le=1000),
+    backend: Optional[str] = None,
+    job_id: Optional[str] = Query(
+        default=None, description="Only lines printed while it ran"
+    ),
+    errors: ErrorLog = Depends(get_error_log),
+    jobs: JobTracker = Depends(get_jobs),
+):
+    prompt_id = None
+    if job_id is not None:
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Job {job_id} not found"
+            )
+        if job.prompt_id is None:
+            return ErrorLogSchema(total=errors.total, items=[])
+        prompt_id = job.prompt_id
+    return ErrorLogSchema(
+        total=errors.total,
+        items=[
+            ErrorEntrySchema.from_entry(entry)
+            for entry in errors.recent(limit, backend, prompt_id)
+        ],
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/cache", response_model=CacheStatsSchema)
+async def cache_stats(cache: ResultCache = Depends(get_result_cache)):
+    return CacheStatsSchema.model_validate(
+        cache.stats(), from_attributes=True
+    )
+
+
+@dev_router.post(
+    "/generate",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobSchema,
+)
+async def dev_generate(
+    to_generate: GenerateDevSchema,
+    service: FluxService = Depends(get_flux_service),
+    client: str = Depends(get_client_id),
+):
     try:
-        await generate("dev", **to_generate.model_dump(exclude_none=True))
-        raise_comfyui_error()
+        job = await service.generate(
+            "dev",
+            client=client,
+            **to_generate.model_dump(exclude_none=True)
+        )
+        return JobSchema.from_job(job)
     except (ValueError, FileNotFoundError) as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
-@dev_router.post("/generate/bulk", status_code=status.HTTP_204_NO_CONTENT)
-async def dev_generate_bulk(to_generate: list[GenerateDevSchema]):
+@dev_router.post(
+    "/generate/bulk",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=list[BulkItemSchema],
+)
+async def dev_generate_bulk(
+    to_generate: list[GenerateDevSchema],
+    service: FluxService = Depends(get_flux_service),
+    client: str = Depends(get_client_id),
+):
     try:
-        for generate_schema in to_generate:
-            await generate(
-                "dev",
-                **generate_schema.model_dump(exclude_none=True)
-            )
-        raise_comfyui_error()
+        results = await service.generate_bulk(
+            "dev",
+            [item.model_dump(exclude_none=True) for item in to_generate],
+            client=client,
+        )
+        return bulk_results(results)
     except (ValueError, FileNotFoundError) as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
-@schnell_router.post("/generate", status_code=status.HTTP_204_NO_CONTENT)
-async def schnell_generate(to_generate: GenerateSchnellSchema):
+@dev_router.post(
+    "/generate/sync",
+    response_class=Response,
+    responses={200: {"content": {"image/png": {}, "multipart/mixed": {}}}},
+)
+async def dev_generate_sync(
+    to_generate: GenerateDevSchema,
+    request: Request,
+    save: bool = Query(
+        default=False, description="Also save the images to the gallery"
+    ),
+    service: FluxService = Depends(get_flux_service),
+    scheduler: Scheduler = Depends(get_scheduler),
+    client: str = Depends(get_client_id),
+):
+    return await generate_sync(
+        "dev", to_generate, request, service, scheduler, client, save
+    )
+
+
+@schnell_router.post(
+    "/generate",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=JobSchema,
+)
+async def schnell_generate(
+    to_generate: GenerateSchnellSchema,
+    service: FluxService = Depends(get_flux_service),
+    client: str = Depends(get_client_id),
+):
     try:
-        await generate("schnell", **to_generate.model_dump(exclude_none=True))
-        raise_comfyui_error()
+        job = await service.generate(
+            "schnell",
+            client=client,
+            **to_generate.model_dump(exclude_none=True)
+        )
+        return JobSchema.from_job(job)
     except (ValueError, FileNotFoundError) as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
-@schnell_router.post("/generate/bulk", status_code=status.HTTP_204_NO_CONTENT)
-async def schnell_generate_bulk(to_generate: list[GenerateSchnellSchema]):
+@schnell_router.post(
+    "/generate/bulk",
+    status_code=status.HTTP_202_ACCEPTED,
+    response_model=list[BulkItemSchema],
+)
+async def schnell_generate_bulk(
+    to_generate: list[GenerateSchnellSchema],
+    service: FluxService = Depends(get_flux_service),
+    client: str = Depends(get_client_id),
+):
     try:
-        for generate_schema in to_generate:
-            await generate(
-                "schnell",
-                **generate_schema.model_dump(exclude_none=True)
-            )
-            raise_comfyui_error()
+        results = await service.generate_bulk(
+            "schnell",
+            [item.model_dump(exclude_none=True) for item in to_generate],
+            client=client,
+        )
+        return bulk_results(results)
     except (ValueError, FileNotFoundError) as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
-@images_router.get("/download_all", response_class=FileResponse)
-async def download_files():
-    zip_filename = TEMP_DIR / f"output_{uuid4()}.zip"
+@schnell_router.post(
+    "/generate/sync",
+    response_class=Response,
+    responses={200: {"content": {"image/png": {}, "multipart/mixed": {}}}},
+)
+async def schnell_generate_sync(
+    to_generate: GenerateSchnellSchema,
+    request: Request,
+    save: bool = Query(
+        default=False, description="Also save the images to the gallery"
+    ),
+    service: FluxService = Depends(get_flux_service),
+    scheduler: Scheduler = Depends(get_scheduler),
+    client: str = Depends(get_client_id),
+):
+    return await generate_sync(
+        "schnell", to_generate, request, service, scheduler, client, save
+    )
 
-    with zipfile.ZipFile(zip_filename, 'w') as zipf:
-        for root, dirs, files in os.walk(OUTPUT_DIR):
-            logger.info(f"Files in {root}: {files}")
-            for file in files:
-                file_path = Path(root) / file
-                zipf.write(file_path, file_path.relative_to(OUTPUT_DIR))
-    logger.info(f"Downloading {zip_filename}")
-    return FileResponse(
-        zip_filename,
-        filename=zip_filename.name,
-        media_type="application/zip"
+
+@jobs_router.get("/{job_id}", response_model=JobSchema)
+async def get_job(job_id: str, jobs: JobTracker = Depends(get_jobs)):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    return JobSchema.from_job(job)
+
+
+@jobs_router.delete("/{job_id}", response_model=JobSchema)
+async def cancel_job(
+    job_id: str,
+    jobs: JobTracker = Depends(get_jobs),
+    scheduler: Scheduler = Depends(get_scheduler),
+):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Job {job_id} not found"
+        )
+    await scheduler.cancel(job)
+    return JobSchema.from_job(job)
+
+
+@admin_router.post("/models/refresh", response_model=list[ModelSchema])
+async def refresh_models(models: ModelRegistry = Depends(get_models)):
+    await asyncio.to_thread(models.refresh)
+    return [ModelSchema.from_status(model) for model in models]
+
+
+@images_router.get("/download_all")
+async def download_files(
+    names: Optional[list[str]] = Query(
+        default=None, description="Only these images"
+    ),
+    job_id: Optional[str] = Query(
+        default=None, description="Only the outputs of this job"
+    ),
+    since: Optional[float] = Query(
+        default=None, description="Only images modified after this timestamp"
+    ),
+    until: Optional[float] = Query(
+        default=None, description="Only images modified before this timestamp"
+    ),
+    index: OutputIndex = Depends(get_output_index),
+    jobs: JobTracker = Depends(get_jobs),
+):
+    if job_id is not None:
+        job = jobs.get(job_id)
+        if job is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Job {job_id} not found"
+            )
+        names = [
+            name for name in job.outputs if names is None or name in names
+        ]
+    if names is None:
+        entries, _ = index.page(len(index), order="oldest", since=since)
+    else:
+        entries = [index.get(name) for name in names if name in index]
+        if since is not None:
+            entries = [entry for entry in entries if entry.mtime > since]
+    if until is not None:
+        entries = [entry for entry in entries if entry.mtime < until]
+    selected = [entry.name for entry in entries]
+
+    logger.info(f"Streaming zip of {len(selected)} images")
+    filename = f"output_{int(time.time())}.zip"
+    return StreamingResponse(
+        stream_zip((OUTPUT_DIR / name, name) for name in selected),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
@@ -261,7 +993,10 @@ async def download_image(image_name: str):
 
 
 @images_router.delete("", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_files():
+async def delete_files(
+    index: OutputIndex = Depends(get_output_index),
+    thumbnails: Thumbnails = Depends(get_thumbnails),
+):
     try:
         for file in os.listdir(OUTPUT_DIR):
             logger.info(f"Deleting {file}")
@@ -271,28 +1006,96 @@ async def delete_files():
             (TEMP_DIR / file).unlink()
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        index.clear()
+        await thumbnails.clear()
+        await asyncio.to_thread(index.scan)
 
 
 @images_router.delete("/{image_name}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_image(image_name: str):
+async def delete_image(
+    image_name: str,
+    index: OutputIndex = Depends(get_output_index),
+):
+    if not (OUTPUT_DIR / image_name).exists():
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Image {image_name} not found"
+        )
     try:
-        if (OUTPUT_DIR / image_name).exists():
-            (OUTPUT_DIR / image_name).unlink()
-        else:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"Image {image_name} not found"
-            )
+        (OUTPUT_DIR / image_name).unlink()
+        index.remove(image_name)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@images_router.get("/events")
+async def image_events(events: ImageEvents = Depends(get_image_events)):
+    return StreamingResponse(
+        events.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @images_router.get("", response_model=ImagesSchema)
-async def get_images(request: Request):
+async def get_images(
+    request: Request,
+    response: Response,
+    limit: int = Query(default=100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    order: Literal["newest", "oldest"] = "newest",
+    since: Optional[float] = Query(
+        default=None, description="Only images modified after this timestamp"
+    ),
+    index: OutputIndex = Depends(get_output_index),
+):
+    etag = index.etag
+    if request.headers.get("if-none-match") == etag:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={"ETag": etag},
+        )
     try:
-        return ImagesSchema(images=read_images())
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        entries, next_cursor = index.page(limit, cursor, order, since)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    response.headers["ETag"] = etag
+    return ImagesSchema(
+        images=[entry.name for entry in entries],
+        items=[ImageInfoSchema.from_entry(entry) for entry in entries],
+        total=len(index),
+        next_cursor=next_cursor,
+    )
+
+
+@images_router.get("/{image_name}/thumb", response_class=FileResponse)
+async def get_thumbnail(
+    image_name: str,
+    w: int = Query(default=256, description="Thumbnail width"),
+    image_format: Literal["webp", "jpeg"] = Query(
+        default="webp", alias="format"
+    ),
+    thumbnails: Thumbnails = Depends(get_thumbnails),
+):
+    try:
+        path = await thumbnails.get(image_name, w, image_format)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    except UnidentifiedImageError:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f"{image_name} is not an image"
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    return FileResponse(
+        path,
+        media_type=f"image/{image_format}",
+        headers={"Cache-Control": "public, max-age=86400"},
+    )
 
 
 @images_router.get("/{image_name}", response_class=FileResponse)
@@ -307,6 +1110,8 @@ app.include_router(views_router)
 app.include_router(schnell_router)
 app.include_router(dev_router)
 app.include_router(images_router)
+app.include_router(jobs_router)
+app.include_router(admin_router)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from modules.comfyui_client import ComfyUIClient  # noqa: E402
+
+
+async def fake_queue(request):
+    return web.json_response({"queue_running": [], "queue_pending": []})
+
+
+async def start_server(port: int):
+    app = web.Application()
+    app.router.add_get("/queue", fake_queue)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    return runner
+
+
+async def session_per_request(base_url: str):
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{base_url}/queue") as response:
+            return await response.json()
+
+
+async def run(name, call, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def timed():
+        async with semaphore:
+            started = time.perf_counter()
+            await call()
+            timings.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    timings.sort()
+    print(
+        f"{name:<22} "
+        f"mean: {statistics.mean(timings) * 1000:7.3f} ms  "
+        f"p50: {timings[len(timings) // 2] * 1000:7.3f} ms  "
+        f"p95: {timings[int(len(timings) * 0.95)] * 1000:7.3f} ms  "
+        f"throughput: {requests / elapsed:9.1f} req/s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare a new aiohttp session per ComfyUI call against the "
+            "pooled ComfyUIClient using a local stand-in server."
+        )
+    )
+    parser.add_argument("-n", "--requests", type=int, default=2000)
+    parser.add_argument("-c", "--concurrency", type=int, default=1)
+    parser.add_argument("-p", "--port", type=int, default=18188)
+    args = parser.parse_args()
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    runner = await start_server(args.port)
+    client = ComfyUIClient(base_url=base_url)
+    await client.start()
+    try:
+        print(
+            f"{args.requests} GET /queue requests, "
+            f"concurrency {args.concurrency}"
+        )
+        await run(
+            "session per request",
+            lambda: session_per_request(base_url),
+            args.requests,
+            args.concurrency,
+        )
+        await run(
+            "pooled ComfyUIClient",
+            lambda: client.get("/queue"),
+            args.requests,
+            args.concurrency,
+        )
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
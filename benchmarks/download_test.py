@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import hashlib
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from modules.downloader import SegmentedDownload  # noqa: E402
+
+
+# Serves one file of seeded random bytes like a CDN would: honouring Range
+# requests unless told not to, and failing or dropping some of them.
+class RangeServer:
+    def __init__(
+        self,
+        data: bytes,
+        ranges: bool = True,
+        failure_rate: float = 0.0,
+        drop_rate: float = 0.0,
+        rate_limit_rate: float = 0.0,
+    ):
+        self.data = data
+        self.etag = f'"{hashlib.sha256(data).hexdigest()[:16]}"'
+        self.ranges = ranges
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests = 0
+        self.failures = 0
+
+    async def model(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        header = request.headers.get("Range", "")
+        # The probe of the first byte is left alone, the test is about
+        # the transfer.
+        if header != "bytes=0-0":
+            roll = random.random()
+            if roll < self.rate_limit_rate:
+                self.failures += 1
+                return web.Response(status=429)
+            if roll < self.rate_limit_rate + self.failure_rate:
+                self.failures += 1
+                return web.Response(status=random.choice((500, 502, 503)))
+        start, end = 0, len(self.data)
+        status = 200
+        if self.ranges and header.startswith("bytes="):
+            first, _, last = header[len("bytes="):].partition("-")
+            start, end = int(first), min(int(last) + 1, len(self.data))
+            status = 206
+        response = web.StreamResponse(
+            status=status,
+            headers={"ETag": self.etag, "Accept-Ranges": "bytes"},
+        )
+        if status == 206:
+            response.headers["Content-Range"] = (
+                f"bytes {start}-{end - 1}/{len(self.data)}"
+            )
+        response.content_length = end - start
+        await response.prepare(request)
+        view = memoryview(self.data)[start:end]
+        drop_at = None
+        if header != "bytes=0-0" and random.random() < self.drop_rate:
+            self.failures += 1
+            drop_at = random.randrange(len(view))
+        for offset in range(0, len(view), 1024 * 1024):
+            chunk = view[offset:offset + 1024 * 1024]
+            if drop_at is not None and offset + len(chunk) > drop_at:
+                await response.write(chunk[:drop_at - offset])
+                request.transport.close()
+                return response
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+
+async def start_server(server: RangeServer, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/model.safetensors", server.model)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+
+async def download(args, url: str, destination: Path) -> float:
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        started = time.perf_counter()
+        await SegmentedDownload(
+            session,
+            url,
+            destination,
+            connections=args.connections,
+            segment_size=args.segment_size * 1024 * 1024,
+            retries=args.retries,
+        ).run()
+        return time.perf_counter() - started
+
+
+async def run(args) -> int:
+    data = random.Random(args.seed).randbytes(args.size * 1024 * 1024)
+    server = RangeServer(
+        data,
+        ranges=args.ranges,
+        failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate,
+        rate_limit_rate=args.rate_limit_rate,
+    )
+    runner = await start_server(server, args.port)
+    url = f"http://127.0.0.1:{args.port}/model.safetensors"
+    try:
+        with tempfile.TemporaryDirectory(prefix="flux-download-") as tmp:
+            destination = Path(tmp) / "model.safetensors"
+            if args.interrupt:
+                # Stop part way, the second run has to resume from the
+                # progress file.
+                try:
+                    await asyncio.wait_for(
+                        download(args, url, destination), args.interrupt
+                    )
+                except asyncio.TimeoutError:
+                    print(
+                        f"Interrupted after {args.interrupt}s", file=sys.stderr
+                    )
+            seconds = await download(args, url, destination)
+            ok = destination.read_bytes() == data
+    finally:
+        await runner.cleanup()
+    print(
+        f"{args.size} MiB in {seconds:.2f}s "
+        f"({args.size / seconds:.0f} MiB/s), {server.requests} requests, "
+        f"{server.failures} failed or dropped, "
+        f"{'content matches' if ok else 'CONTENT MISMATCH'}"
+    )
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Download a file of random bytes from a local range server with "
+            "the model downloader, optionally with failing, rate limited and "
+            "dropped responses, and check the result."
+        )
+    )
+    parser.add_argument("--size", type=int, default=256, help="MiB")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument(
+        "--segment-size", type=int, default=16, help="MiB per range"
+    )
+    parser.add_argument("--retries", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-ranges", dest="ranges", action="store_false",
+        help="Ignore Range headers, forcing a single stream",
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0,
+        help="Share of range requests answered 500, 502 or 503",
+    )
+    parser.add_argument(
+        "--rate-limit-rate", type=float, default=0.0,
+        help="Share of range requests answered 429",
+    )
+    parser.add_argument(
+        "--drop-rate", type=float, default=0.0,
+        help="Share of responses cut off part way",
+    )
+    parser.add_argument(
+        "--interrupt", type=float,
+        help="Stop the first download after this many seconds and resume",
+    )
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()
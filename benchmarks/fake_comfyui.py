@@ -0,0 +1,558 @@
+import argparse
+import asyncio
+import functools
+import json
+import os
+import random
+import re
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+from uuid import uuid4
+
+from aiohttp import web
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+SAMPLERS = {"SamplerCustomAdvanced", "KSampler", "KSamplerAdvanced"}
+ENCODERS = {"CLIPTextEncode", "CLIPTextEncodeFlux"}
+# Node sending images over the websocket instead of saving them, and the
+# binary message header it is sent with: a preview image, PNG encoded.
+WEBSOCKET_SAVE = "SaveImageWebsocket"
+PREVIEW_IMAGE, PNG = 1, 2
+LOADERS = {
+    "UNETLoader",
+    "CLIPLoader",
+    "DualCLIPLoader",
+    "VAELoader",
+    "CheckpointLoaderSimple",
+}
+
+
+def png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data)) + kind + data +
+        struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def placeholder_png(width: int, height: int, noisy: bool = False) -> bytes:
+    # Noise compresses as badly as a real image, a flat grey to nothing.
+    row = b"\x00" + b"\x80" * (width * 3)
+    compressor = zlib.compressobj(1)
+    data = b"".join(
+        compressor.compress(
+            b"\x00" + random.randbytes(width * 3) if noisy else row
+        )
+        for _ in range(height)
+    )
+    return (
+        PNG_SIGNATURE +
+        png_chunk(
+            b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        ) +
+        png_chunk(b"IDAT", data + compressor.flush()) +
+        png_chunk(b"IEND", b"")
+    )
+
+
+def find_input(prompt: dict, name: str, default):
+    for node in prompt.values():
+        if name in node.get("inputs", {}):
+            return node["inputs"][name]
+    return default
+
+
+def find_save_node(prompt: dict) -> tuple[str, str]:
+    for node_id, node in prompt.items():
+        if node.get("class_type") == "SaveImage":
+            return node_id, node["inputs"].get("filename_prefix", "ComfyUI")
+    return "9", "ComfyUI"
+
+
+def node_signatures(prompt: dict) -> dict[str, str]:
+    # A node's class and inputs, with links replaced by the signature of the
+    # node they come from, as ComfyUI's cache compares them.
+    signatures = {}
+
+    def sign(node_id: str) -> str:
+        if node_id not in signatures:
+            node = prompt[node_id]
+            inputs = {
+                name: (
+                    [sign(value[0]), value[1]]
+                    if isinstance(value, list) and value and
+                    value[0] in prompt else value
+                )
+                for name, value in node.get("inputs", {}).items()
+            }
+            signatures[node_id] = json.dumps(
+                [node.get("class_type"), inputs], sort_keys=True
+            )
+        return signatures[node_id]
+
+    for node_id in prompt:
+        sign(node_id)
+    return signatures
+
+
+# Stand-in for a ComfyUI instance: accepts prompts, "executes" them for a
+# configurable time on a fixed number of workers, pushes the same websocket
+# events as ComfyUI and writes placeholder PNGs of the requested size.
+class FakeComfyUI:
+    def __init__(
+        self,
+        output_dir: Path,
+        delay: float = 0.5,
+        steps: int = 4,
+        workers: int = 1,
+        failure_rate: float = 0.0,
+        reject_rate: float = 0.0,
+        encode_delay: float = 0.0,
+        load_delay: float = 0.0,
+        noisy_images: bool = False,
+    ):
+        self.output_dir = output_dir
+        self.delay = delay
+        self.steps = steps
+        self.workers = workers
+        self.failure_rate = failure_rate
+        self.reject_rate = reject_rate
+        self.encode_delay = encode_delay
+        self.load_delay = load_delay
+        self.noisy_images = noisy_images
+        # Signatures of the nodes of the last prompt run, like ComfyUI's
+        # cache of the previous prompt's outputs.
+        self.cache: set[str] = set()
+        self.number = 0
+        self.pending: OrderedDict[str, dict] = OrderedDict()
+        self.running: dict[str, dict] = {}
+        self.history: OrderedDict[str, dict] = OrderedDict()
+        self.interrupted: set[str] = set()
+        self.sockets: dict[str, web.WebSocketResponse] = {}
+        self.counters: dict[str, int] = {}
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        # Held while a prompt sends its images: ComfyUI runs one prompt at
+        # a time, so nothing comes between them and their executing event.
+        self.sending = asyncio.Lock()
+
+    async def send(self, client_id: str | None, event: str, data: dict):
+        async with self.sending:
+            await self.send_unlocked(client_id, event, data)
+
+    async def send_unlocked(
+        self, client_id: str | None, event: str, data: dict
+    ):
+        if client_id is None:
+            sockets = list(self.sockets.values())
+        else:
+            sockets = [self.sockets.get(client_id)]
+        for ws in filter(None, sockets):
+            try:
+                await ws.send_json({"type": event, "data": data})
+            except (ConnectionError, RuntimeError):
+                pass
+
+    async def send_bytes(self, client_id: str | None, data: bytes):
+        ws = self.sockets.get(client_id)
+        if ws is None:
+            return
+        try:
+            await ws.send_bytes(data)
+        except (ConnectionError, RuntimeError):
+            pass
+
+    async def send_status(self):
+        await self.send(
+            None,
+            "status",
+            {"status": {"exec_info": {
+                "queue_remaining": len(self.pending) + len(self.running)
+            }}},
+        )
+
+    def next_filename(self, prefix: str) -> str:
+        if prefix not in self.counters:
+            pattern = re.compile(rf"{re.escape(prefix)}_(\d+)_\.png$")
+            numbers = [
+                int(match.group(1))
+                for name in os.listdir(self.output_dir)
+                if (match := pattern.match(name))
+            ]
+            self.counters[prefix] = max(numbers, default=0)
+        self.counters[prefix] += 1
+        return f"{prefix}_{self.counters[prefix]:05}_.png"
+
+    def write_images(self, prompt: dict) -> list[dict]:
+        width = int(find_input(prompt, "width", 64))
+        height = int(find_input(prompt, "height", 64))
+        batch_size = int(find_input(prompt, "batch_size", 1))
+        _, prefix = find_save_node(prompt)
+        data = placeholder_png(width, height, self.noisy_images)
+        images = []
+        for _ in range(batch_size):
+            filename = self.next_filename(prefix)
+            (self.output_dir / filename).write_bytes(data)
+            images.append(
+                {"filename": filename, "subfolder": "", "type": "output"}
+            )
+        return images
+
+    async def sample(self, prompt_id: str, client_id: str, node_id: str):
+        for step in range(self.steps):
+            await asyncio.sleep(self.delay / max(1, self.steps))
+            if prompt_id in self.interrupted:
+                return "interrupted"
+            await self.send(
+                client_id,
+                "progress",
+                {
+                    "value": step + 1,
+                    "max": self.steps,
+                    "prompt_id": prompt_id,
+                    "node": node_id,
+                },
+            )
+        return "success"
+
+    async def execute(self, prompt_id: str):
+        item = self.pending.pop(prompt_id)
+        self.running[prompt_id] = item
+        client_id, prompt = item["client_id"], item["prompt"]
+        started = time.time()
+        await self.send(client_id, "execution_start", {"prompt_id": prompt_id})
+        save_node, _ = find_save_node(prompt)
+        websocket_nodes = [
+            node_id for node_id, node in prompt.items()
+            if node.get("class_type") == WEBSOCKET_SAVE
+        ]
+        # Without a SaveImage node the images only go over the websocket.
+        save = not websocket_nodes or any(
+            node.get("class_type") == "SaveImage" for node in prompt.values()
+        )
+        status, outputs = "success", {}
+        messages = [["execution_start", {"timestamp": started}]]
+        signatures = node_signatures(prompt)
+        cached = [
+            node_id for node_id in prompt
+            if node_id != save_node and signatures[node_id] in self.cache
+        ]
+        await self.send(
+            client_id,
+            "execution_cached",
+            {"nodes": cached, "prompt_id": prompt_id},
+        )
+        messages.append(["execution_cached", {"nodes": cached}])
+        # Nodes report in turn like ComfyUI's, the sampler taking the time.
+        sampler = next(
+            (
+                node_id for node_id, node in prompt.items()
+                if node.get("class_type") in SAMPLERS
+            ),
+            next(iter(prompt)),
+        )
+        for node_id in prompt:
+            if (
+                node_id == save_node or node_id in cached or
+                node_id in websocket_nodes
+            ):
+                continue
+            await self.send(
+                client_id,
+                "executing",
+                {"node": node_id, "prompt_id": prompt_id},
+            )
+            if prompt[node_id].get("class_type") in ENCODERS:
+                await asyncio.sleep(self.encode_delay)
+            elif prompt[node_id].get("class_type") in LOADERS:
+                await asyncio.sleep(self.load_delay)
+            if node_id == sampler:
+                status = await self.sample(prompt_id, client_id, node_id)
+                if status != "success":
+                    break
+        if status == "success" and random.random() < self.failure_rate:
+            status = "error"
+        if status == "success":
+            self.cache = set(signatures.values())
+            if save:
+                await self.send(
+                    client_id,
+                    "executing",
+                    {"node": save_node, "prompt_id": prompt_id},
+                )
+                images = await asyncio.to_thread(self.write_images, prompt)
+                outputs = {save_node: {"images": images}}
+                await self.send(
+                    client_id,
+                    "executed",
+                    {
+                        "node": save_node,
+                        "output": {"images": images},
+                        "prompt_id": prompt_id,
+                    },
+                )
+            for node_id in websocket_nodes:
+                png = await asyncio.to_thread(
+                    placeholder_png,
+                    int(find_input(prompt, "width", 64)),
+                    int(find_input(prompt, "height", 64)),
+                    self.noisy_images,
+                )
+                data = struct.pack(">II", PREVIEW_IMAGE, PNG) + png
+                async with self.sending:
+                    await self.send_unlocked(
+                        client_id,
+                        "executing",
+                        {"node": node_id, "prompt_id": prompt_id},
+                    )
+                    for _ in range(int(find_input(prompt, "batch_size", 1))):
+                        await self.send_bytes(client_id, data)
+            await self.send(
+                client_id, "execution_success", {"prompt_id": prompt_id}
+            )
+        elif status == "error":
+            error = {
+                "prompt_id": prompt_id,
+                "node_id": "13",
+                "node_type": "SamplerCustomAdvanced",
+                "exception_type": "RuntimeError",
+                "exception_message": "Injected failure",
+                "traceback": ["RuntimeError: Injected failure\n"],
+            }
+            # ComfyUI prints the failure while still running the prompt.
+            print(
+                "!!! Exception during processing !!! Injected failure\n"
+                "Traceback (most recent call last):\n"
+                "RuntimeError: Injected failure",
+                file=sys.stderr,
+                flush=True,
+            )
+            await self.send(client_id, "execution_error", error)
+            messages.append(["execution_error", error])
+        else:
+            await self.send(
+                client_id, "execution_interrupted", {"prompt_id": prompt_id}
+            )
+            messages.append(
+                ["execution_interrupted", {"prompt_id": prompt_id}]
+            )
+        await self.send(
+            client_id, "executing", {"node": None, "prompt_id": prompt_id}
+        )
+        self.interrupted.discard(prompt_id)
+        del self.running[prompt_id]
+        self.history[prompt_id] = {
+            "prompt": [item["number"], prompt_id, prompt, {}, [save_node]],
+            "outputs": outputs,
+            "status": {
+                "status_str": "success" if status == "success" else "error",
+                "completed": status == "success",
+                "messages": messages,
+            },
+        }
+        while len(self.history) > 10000:
+            self.history.popitem(last=False)
+        await self.send_status()
+
+    async def worker(self):
+        while True:
+            prompt_id = await self.queue.get()
+            if prompt_id in self.pending:
+                await self.execute(prompt_id)
+
+    async def post_prompt(self, request: web.Request):
+        body = await request.json()
+        prompt = body.get("prompt")
+        if not isinstance(prompt, dict) or not prompt:
+            return web.json_response(
+                {"error": {"type": "no_prompt", "message": "No prompt"}},
+                status=400,
+            )
+        if random.random() < self.reject_rate:
+            return web.json_response(
+                {
+                    "error": {
+                        "type": "prompt_outputs_failed_validation",
+                        "message": "Injected rejection",
+                    },
+                    "node_errors": {},
+                },
+                status=400,
+            )
+        prompt_id = body.get("prompt_id") or str(uuid4())
+        self.number += 1
+        self.pending[prompt_id] = {
+            "number": self.number,
+            "prompt": prompt,
+            "client_id": body.get("client_id"),
+        }
+        self.queue.put_nowait(prompt_id)
+        await self.send_status()
+        return web.json_response(
+            {"prompt_id": prompt_id, "number": self.number, "node_errors": {}}
+        )
+
+    def queue_item(self, prompt_id: str, item: dict) -> list:
+        return [item["number"], prompt_id, item["prompt"], {}, []]
+
+    async def get_queue(self, request: web.Request):
+        return web.json_response({
+            "queue_running": [
+                self.queue_item(prompt_id, item)
+                for prompt_id, item in self.running.items()
+            ],
+            "queue_pending": [
+                self.queue_item(prompt_id, item)
+                for prompt_id, item in self.pending.items()
+            ],
+        })
+
+    async def post_queue(self, request: web.Request):
+        body = await request.json()
+        if body.get("clear"):
+            self.pending.clear()
+        for prompt_id in body.get("delete", []):
+            self.pending.pop(prompt_id, None)
+        await self.send_status()
+        return web.Response()
+
+    async def interrupt(self, request: web.Request):
+        self.interrupted.update(self.running)
+        return web.Response()
+
+    async def get_history(self, request: web.Request):
+        prompt_id = request.match_info.get("prompt_id")
+        if prompt_id is None:
+            return web.json_response(dict(self.history))
+        if prompt_id in self.history:
+            return web.json_response({prompt_id: self.history[prompt_id]})
+        return web.json_response({})
+
+    async def view(self, request: web.Request):
+        path = self.output_dir / request.query.get("subfolder", "") / (
+            request.query["filename"]
+        )
+        if not path.resolve().is_relative_to(self.output_dir.resolve()):
+            raise web.HTTPForbidden()
+        if not path.exists():
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+    async def websocket(self, request: web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or uuid4().hex
+        self.sockets[client_id] = ws
+        await self.send_status()
+        try:
+            async for _ in ws:
+                pass
+        finally:
+            if self.sockets.get(client_id) is ws:
+                del self.sockets[client_id]
+        return ws
+
+    async def index(self, request: web.Request):
+        return web.Response(text="Fake ComfyUI")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/", self.index)
+        app.router.add_get("/ws", self.websocket)
+        app.router.add_post("/prompt", self.post_prompt)
+        app.router.add_get("/queue", self.get_queue)
+        app.router.add_post("/queue", self.post_queue)
+        app.router.add_post("/interrupt", self.interrupt)
+        app.router.add_get("/history", self.get_history)
+        app.router.add_get("/history/{prompt_id}", self.get_history)
+        app.router.add_get("/view", self.view)
+
+        async def start_workers(app):
+            app["workers"] = [
+                asyncio.create_task(self.worker())
+                for _ in range(self.workers)
+            ]
+
+        async def stop_workers(app):
+            for task in app["workers"]:
+                task.cancel()
+
+        app.on_startup.append(start_workers)
+        app.on_cleanup.append(stop_workers)
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Fake ComfyUI for load tests. Accepts the same --port and "
+            "--output-directory as ComfyUI's main.py and ignores other "
+            "ComfyUI arguments."
+        )
+    )
+    parser.add_argument("--listen", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument(
+        "--output-directory", type=Path, default=Path("output")
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0.5,
+        help="Seconds one prompt takes to execute",
+    )
+    parser.add_argument(
+        "--steps", type=int, default=4, help="Progress events per prompt"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Prompts executed at the same time",
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0,
+        help="Share of prompts failing with an execution error",
+    )
+    parser.add_argument(
+        "--reject-rate", type=float, default=0.0,
+        help="Share of prompts rejected by /prompt",
+    )
+    parser.add_argument(
+        "--encode-delay", type=float, default=0.0,
+        help="Seconds a text encode node takes unless cached",
+    )
+    parser.add_argument(
+        "--load-delay", type=float, default=0.0,
+        help="Seconds a model loader node takes unless cached",
+    )
+    parser.add_argument(
+        "--noisy-images", action="store_true",
+        help="Images of random pixels, as large as real ones",
+    )
+    args, _ = parser.parse_known_args()
+
+    args.output_directory.mkdir(parents=True, exist_ok=True)
+    fake = FakeComfyUI(
+        output_dir=args.output_directory,
+        delay=args.delay,
+        steps=args.steps,
+        workers=args.workers,
+        failure_rate=args.failure_rate,
+        reject_rate=args.reject_rate,
+        encode_delay=args.encode_delay,
+        load_delay=args.load_delay,
+        noisy_images=args.noisy_images,
+    )
+    print(f"Fake ComfyUI listening on {args.listen}:{args.port}", flush=True)
+    web.run_app(
+        fake.app(),
+        host=args.listen,
+        port=args.port,
+        access_log=None,
+        print=None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import aiohttp
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from config import BASE_DIR, COMFYUI_DIR, Models  # noqa: E402
+from modules.jobs import FINISHED_STATES  # noqa: E402
+
+
+FAKE_COMFYUI = Path(__file__).resolve().parent / "fake_comfyui.py"
+SCENARIOS = ("generate", "bulk", "images", "sync")
+
+
+@dataclass
+class Result:
+    scenario: str
+    latencies: list[float] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    job_ids: list[str] = field(default_factory=list)
+    elapsed: float = 0.0
+    job_latencies: list[float] = field(default_factory=list)
+    job_states: Counter = field(default_factory=Counter)
+
+    @property
+    def requests(self) -> int:
+        return sum(self.statuses.values())
+
+    @property
+    def errors(self) -> int:
+        return sum(
+            count for status, count in self.statuses.items()
+            if not (isinstance(status, int) and status < 400)
+        )
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return math.nan
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def generate_item(args, index: int) -> dict:
+    # A fresh seed per request, the result cache would answer repeats.
+    return {
+        "prompt": f"load test {index}",
+        "width": args.width,
+        "height": args.height,
+        "steps": 1,
+        "noise_seed": random.randint(0, 2**63),
+    }
+
+
+async def generate(session, args, index: int):
+    async with session.post(
+        f"{args.url}/{args.model}/generate", json=generate_item(args, index)
+    ) as response:
+        if response.status >= 400:
+            await response.read()
+            return response.status, []
+        data = await response.json()
+        return response.status, [data["id"]]
+
+
+async def bulk(session, args, index: int):
+    items = [
+        generate_item(args, index * args.bulk_size + offset)
+        for offset in range(args.bulk_size)
+    ]
+    async with session.post(
+        f"{args.url}/{args.model}/generate/bulk", json=items
+    ) as response:
+        if response.status >= 400:
+            await response.read()
+            return response.status, []
+        data = await response.json()
+        return response.status, [
+            item["job"]["id"] for item in data if item.get("job")
+        ]
+
+
+async def sync(session, args, index: int):
+    # Answered with the images, so its latency is the job's.
+    async with session.post(
+        f"{args.url}/{args.model}/generate/sync",
+        json=generate_item(args, index),
+    ) as response:
+        await response.read()
+        return response.status, []
+
+
+async def images(session, args, index: int):
+    async with session.get(
+        f"{args.url}/images", params={"limit": args.page_size}
+    ) as response:
+        await response.read()
+        return response.status, []
+
+
+async def drive(session, args, scenario: str) -> Result:
+    call = {
+        "generate": generate, "bulk": bulk, "images": images, "sync": sync
+    }[scenario]
+    result = Result(scenario)
+
+    async def timed(index: int):
+        started = time.perf_counter()
+        try:
+            status, job_ids = await call(session, args, index)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            status, job_ids = type(e).__name__, []
+        result.latencies.append(time.perf_counter() - started)
+        result.statuses[status] += 1
+        result.job_ids.extend(job_ids)
+
+    # Open loop: requests go out on schedule however slow answers are.
+    total = max(1, round(args.rate * args.duration))
+    tasks = []
+    started = time.perf_counter()
+    for index in range(total):
+        delay = started + index / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(timed(index)))
+    await asyncio.gather(*tasks)
+    result.elapsed = time.perf_counter() - started
+    return result
+
+
+async def wait_for_jobs(session, args, result: Result):
+    pending = set(result.job_ids)
+    semaphore = asyncio.Semaphore(32)
+    deadline = time.monotonic() + args.jobs_timeout
+
+    async def poll(job_id: str):
+        async with semaphore:
+            async with session.get(f"{args.url}/jobs/{job_id}") as response:
+                if response.status != 200:
+                    return
+                job = await response.json()
+        if job["state"] in FINISHED_STATES:
+            pending.discard(job_id)
+            result.job_states[job["state"]] += 1
+            result.job_latencies.append(job["finished_at"] - job["created_at"])
+
+    while pending and time.monotonic() < deadline:
+        await asyncio.gather(*(poll(job_id) for job_id in list(pending)))
+        if pending:
+            await asyncio.sleep(0.25)
+    if pending:
+        result.job_states["unfinished"] += len(pending)
+
+
+def prepare_comfyui_dir(root: Path):
+    # Empty model files satisfy the workflow requirement checks.
+    for model in Models:
+        path = root / model.value.PATH.relative_to(COMFYUI_DIR)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    (root / "output").mkdir(exist_ok=True)
+    (root / "main.py").symlink_to(FAKE_COMFYUI)
+
+
+def start_app(args, root: Path) -> subprocess.Popen:
+    fake_args = (
+        f"--delay {args.delay} --workers {args.fake_workers} "
+        f"--failure-rate {args.failure_rate} "
+        f"--encode-delay {args.encode_delay} --load-delay {args.load_delay}"
+        + (" --noisy-images" if args.noisy_images else "")
+    )
+    env = {
+        **os.environ,
+        "COMFYUI_DIR": str(root),
+        "COMFYUI_LOCAL": ",".join(
+            f"{args.fake_port + offset}:{fake_args}"
+            for offset in range(args.backends)
+        ),
+        "COMFYUI_REMOTE": "",
+        # Unlike ComfyUI, a fake backend runs several prompts at once.
+        "SCHEDULER_BACKEND_DEPTH": str(args.fake_workers + 1),
+    }
+    log = open(root / "app.log", "wb")
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--port", str(args.port), "--log-level", "warning",
+        ],
+        cwd=BASE_DIR,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_ready(session, args, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{args.url}/health") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise TimeoutError(f"{args.url} did not become healthy in {timeout}s")
+
+
+def ms(seconds: float) -> str:
+    return f"{seconds * 1000:9.1f}"
+
+
+def report(results: list[Result]) -> list[dict]:
+    print(
+        f"{'scenario':<14}{'requests':>9}{'errors':>8}{'req/s':>9}"
+        f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    summary = []
+    for result in results:
+        latencies = result.latencies
+        throughput = result.requests / result.elapsed
+        print(
+            f"{result.scenario:<14}{result.requests:>9}{result.errors:>8}"
+            f"{throughput:>9.1f}"
+            f"{ms(percentile(latencies, 50)):>10}"
+            f"{ms(percentile(latencies, 95)):>10}"
+            f"{ms(percentile(latencies, 99)):>10}"
+            f"{ms(max(latencies)):>10}"
+        )
+        if result.job_states:
+            print(
+                f"{'  jobs':<14}{sum(result.job_states.values()):>9}"
+                f"{result.job_states['failed']:>8}{'':>9}"
+                f"{ms(percentile(result.job_latencies, 50)):>10}"
+                f"{ms(percentile(result.job_latencies, 95)):>10}"
+                f"{ms(percentile(result.job_latencies, 99)):>10}"
+                f"{ms(max(result.job_latencies, default=math.nan)):>10}"
+                + "".join(
+                    f"  {result.job_states[state]} {state}"
+                    for state in ("cancelled", "unfinished")
+                    if result.job_states[state]
+                )
+            )
+        summary.append({
+            "scenario": result.scenario,
+            "requests": result.requests,
+            "errors": result.errors,
+            "statuses": {str(k): v for k, v in result.statuses.items()},
+            "throughput": throughput,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies),
+            "jobs": dict(result.job_states),
+            "job_p50": percentile(result.job_latencies, 50),
+            "job_p95": percentile(result.job_latencies, 95),
+            "job_p99": percentile(result.job_latencies, 99),
+        })
+    return summary
+
+
+def check_thresholds(args, summary: list[dict]) -> list[str]:
+    failures = []
+    for item in summary:
+        if args.max_p99 is not None and item["p99"] * 1000 > args.max_p99:
+            failures.append(
+                f"{item['scenario']}: p99 {item['p99'] * 1000:.1f} ms "
+                f"> {args.max_p99} ms"
+            )
+        error_rate = item["errors"] / item["requests"]
+        if error_rate > args.max_error_rate:
+            failures.append(
+                f"{item['scenario']}: error rate {error_rate:.2%} "
+                f"> {args.max_error_rate:.2%}"
+            )
+    return failures
+
+
+async def run(args) -> int:
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(
+        connector=connector, timeout=timeout
+    ) as session:
+        await wait_ready(session, args)
+        results = []
+        for scenario in args.scenarios:
+            print(
+                f"{scenario}: {args.rate} req/s for {args.duration}s",
+                file=sys.stderr,
+            )
+            result = await drive(session, args, scenario)
+            if result.job_ids and args.wait_jobs:
+                await wait_for_jobs(session, args, result)
+            results.append(result)
+
+    summary = report(results)
+    if args.json:
+        args.json.write_text(json.dumps(summary, indent=2))
+    failures = check_thresholds(args, summary)
+    for failure in failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Drive the API at a fixed request rate and report latency "
+            "percentiles and throughput. Without --url, the app is started "
+            "against fake ComfyUI backends, so no GPU is needed."
+        )
+    )
+    parser.add_argument(
+        "scenarios", nargs="*",
+        help=f"Scenarios to run in order (default: {' '.join(SCENARIOS)})",
+    )
+    parser.add_argument("--url", help="Test a running app instead")
+    parser.add_argument("-r", "--rate", type=float, default=20)
+    parser.add_argument("-d", "--duration", type=float, default=10)
+    parser.add_argument("--model", choices=("dev", "schnell"), default="dev")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--bulk-size", type=int, default=10)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--connections", type=int, default=256)
+    parser.add_argument("--request-timeout", type=float, default=60)
+    parser.add_argument(
+        "--no-wait-jobs", dest="wait_jobs", action="store_false",
+        help="Do not wait for jobs to finish",
+    )
+    parser.add_argument("--jobs-timeout", type=float, default=120)
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--fake-port", type=int, default=18188)
+    parser.add_argument("--backends", type=int, default=1)
+    parser.add_argument(
+        "--delay", type=float, default=0.05,
+        help="Seconds a fake backend takes per prompt",
+    )
+    parser.add_argument("--fake-workers", type=int, default=4)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--encode-delay", type=float, default=0.0,
+        help="Seconds a fake text encode takes unless cached",
+    )
+    parser.add_argument(
+        "--load-delay", type=float, default=0.0,
+        help="Seconds a fake model loader takes unless cached",
+    )
+    parser.add_argument(
+        "--noisy-images", action="store_true",
+        help="Fake images as large as real ones, e.g. for sync at 1920x1080",
+    )
+    parser.add_argument(
+        "--max-p99", type=float,
+        help="Fail if any scenario's p99 exceeds it, ms",
+    )
+    parser.add_argument(
+        "--max-error-rate", type=float, default=0.0,
+        help="Fail if any scenario's share of failed requests exceeds it",
+    )
+    parser.add_argument("--json", type=Path, help="Write the summary here")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"Unknown scenario {scenario}")
+
+    if args.url:
+        sys.exit(asyncio.run(run(args)))
+
+    args.url = f"http://127.0.0.1:{args.port}"
+    with tempfile.TemporaryDirectory(prefix="flux-load-") as tmp:
+        root = Path(tmp)
+        prepare_comfyui_dir(root)
+        app = start_app(args, root)
+        try:
+            code = asyncio.run(run(args))
+        except BaseException:
+            print((root / "app.log").read_text()[-4000:], file=sys.stderr)
+            raise
+        finally:
+            app.terminate()
+            app.wait(timeout=30)
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
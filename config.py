@@ -17,21 +17,143 @@ BASE_DIR = Path(__file__).resolve().parent
 TEMP_DIR = BASE_DIR / "temp"
 TEMP_DIR.mkdir(exist_ok=True)
 WORKFLOWS_DIR = BASE_DIR / "workflows"
+WORKFLOWS_RELOAD_INTERVAL = float(os.getenv("WORKFLOWS_RELOAD_INTERVAL", 2))
 STATIC_DIR = Path(__file__).parent / "ui/static"
 TEMPLATES_DIR = Path(__file__).parent / "ui/templates"
 
 # ComfyUI
 COMFYUI_REPO = "https://github.com/comfyanonymous/ComfyUI"
 
-COMFYUI_BASE_URL = "http://127.0.0.1:8188"
-
-COMFYUI_DIR = BASE_DIR / "ComfyUI"
+COMFYUI_HOST = "127.0.0.1"
+COMFYUI_BASE_URL = f"http://{COMFYUI_HOST}:8188"
+
+# ComfyUI backends: instances spawned locally, as comma separated
+# "port" or "port:extra args" (e.g. "8188,8189:--cpu"), and instances
+# attached by URL (e.g. "http://gpu-2:8188")
+COMFYUI_LOCAL = os.getenv("COMFYUI_LOCAL", "8188")
+COMFYUI_REMOTE = os.getenv("COMFYUI_REMOTE", "")
+COMFYUI_HEALTH_INTERVAL = float(os.getenv("COMFYUI_HEALTH_INTERVAL", 2))
+COMFYUI_EJECT_AFTER = int(os.getenv("COMFYUI_EJECT_AFTER", 3))
+
+# ComfyUI HTTP client
+COMFYUI_CONNECTION_LIMIT = int(os.getenv("COMFYUI_CONNECTION_LIMIT", 64))
+COMFYUI_KEEPALIVE_TIMEOUT = float(os.getenv("COMFYUI_KEEPALIVE_TIMEOUT", 60))
+COMFYUI_CONNECT_TIMEOUT = float(os.getenv("COMFYUI_CONNECT_TIMEOUT", 5))
+COMFYUI_REQUEST_TIMEOUT = float(os.getenv("COMFYUI_REQUEST_TIMEOUT", 30))
+COMFYUI_RETRIES = int(os.getenv("COMFYUI_RETRIES", 3))
+COMFYUI_RETRY_BACKOFF = float(os.getenv("COMFYUI_RETRY_BACKOFF", 0.25))
+COMFYUI_WS_RECONNECT_DELAY = float(os.getenv("COMFYUI_WS_RECONNECT_DELAY", 2))
+# Largest websocket message accepted, 0 for no limit. Images sent over the
+# websocket are lightly compressed PNGs, well above aiohttp's 4 MiB default
+COMFYUI_WS_MAX_MSG_SIZE = int(os.getenv("COMFYUI_WS_MAX_MSG_SIZE", 0))
+
+# Jobs
+JOBS_RETENTION = int(os.getenv("JOBS_RETENTION", 10000))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", 16))
+# Seconds a synchronous generate request waits for its images
+SYNC_TIMEOUT = float(os.getenv("SYNC_TIMEOUT", 300))
+
+# Admission control of generate requests, 0 disables a limit. Costs are
+# estimated in GPU seconds, starting from ADMISSION_SECONDS_PER_STEP for one
+# step of a one megapixel image and learned from finished jobs.
+ADMISSION_MAX_PENDING = int(os.getenv("ADMISSION_MAX_PENDING", 0))
+ADMISSION_MAX_GPU_SECONDS = float(os.getenv("ADMISSION_MAX_GPU_SECONDS", 0))
+ADMISSION_CLIENT_MAX_PENDING = int(
+    os.getenv("ADMISSION_CLIENT_MAX_PENDING", 0)
+)
+ADMISSION_SECONDS_PER_STEP = float(
+    os.getenv("ADMISSION_SECONDS_PER_STEP", 0.5)
+)
+
+# Scheduling of jobs onto ComfyUI. Each instance is kept at most
+# SCHEDULER_BACKEND_DEPTH prompts deep, the rest wait in the API ordered by
+# priority class and, within a class, by each client's weighted share of GPU
+# seconds. SCHEDULER_CLIENT_WEIGHTS holds comma separated "client=weight"
+# pairs, other clients weigh 1.
+SCHEDULER_BACKEND_DEPTH = int(os.getenv("SCHEDULER_BACKEND_DEPTH", 2))
+SCHEDULER_CLIENT_WEIGHTS = os.getenv("SCHEDULER_CLIENT_WEIGHTS", "")
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", 1))
+# A prompt with the same text and model as the one last sent to an instance
+# may jump ahead, letting ComfyUI reuse the text encoding, as long as its
+# client is at most SCHEDULER_AFFINITY_SLACK weighted GPU seconds ahead of
+# the client next in line (0 disables)
+SCHEDULER_AFFINITY_SLACK = float(os.getenv("SCHEDULER_AFFINITY_SLACK", 30))
+# Likewise a prompt needing the models an instance has loaded, saving a swap
+# of the UNET and text encoders
+SCHEDULER_MODEL_SLACK = float(os.getenv("SCHEDULER_MODEL_SLACK", 120))
+# Comma separated "workflow=backend|backend" pairs: a pinned workflow only
+# runs on its backends (e.g. "local:8188"), which run no other workflow
+SCHEDULER_PINS = os.getenv("SCHEDULER_PINS", "")
+
+# ComfyUI log lines that look like errors, most recent first on /diagnostics
+ERROR_LOG_SIZE = int(os.getenv("ERROR_LOG_SIZE", 1000))
+
+# Micro-batching of compatible requests, a window of 0 disables it
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", 0))
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", 8))
+
+# Results of seeded requests, a size of 0 disables the cache
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 10000))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 24 * 60 * 60))
+
+COMFYUI_DIR = Path(os.getenv("COMFYUI_DIR", BASE_DIR / "ComfyUI"))
 
 MODEL_DIR = COMFYUI_DIR / "models"
 UNET_DIR = MODEL_DIR / "unet"
 CLIP_DIR = MODEL_DIR / "clip"
 VAE_DIR = MODEL_DIR / "vae"
+# Seconds between checks of the model directories for added or removed files
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", 30))
+# Startup: model files read into the page cache while ComfyUI starts, either
+# "required" (by the loaded workflows), a comma-separated list of Models
+# names or empty for none
+PREWARM_MODELS = os.getenv("PREWARM_MODELS", "required")
+PREWARM_WORKERS = int(os.getenv("PREWARM_WORKERS", 4))
+PREWARM_READ_SIZE = int(os.getenv("PREWARM_READ_SIZE", 8 * 1024 * 1024))
+# Workflow run once before reporting ready, so ComfyUI has its models loaded
+WARMUP_WORKFLOW = os.getenv("WARMUP_WORKFLOW", "")
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 600))
+# Seconds before a failed warm-up run is tried again
+WARMUP_RETRY_DELAY = float(os.getenv("WARMUP_RETRY_DELAY", 30))
 OUTPUT_DIR = COMFYUI_DIR / "output"
+OUTPUT_WATCH_INTERVAL = float(os.getenv("OUTPUT_WATCH_INTERVAL", 5))
+IMAGE_EVENTS_QUEUE_SIZE = int(os.getenv("IMAGE_EVENTS_QUEUE_SIZE", 1000))
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", 100))
+
+# Output encoding: with OUTPUT_FORMAT empty ComfyUI saves its own PNGs,
+# otherwise it sends them over the websocket, cheaply compressed, and the
+# API encodes them in OUTPUT_ENCODE_WORKERS processes as "png", "jpeg",
+# "webp" or "webp-lossless". OUTPUT_QUALITY (1-100) applies to JPEG and WebP,
+# OUTPUT_COMPRESSION (0-9) to PNG and, scaled, to WebP's encoding effort
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "")
+OUTPUT_QUALITY = int(os.getenv("OUTPUT_QUALITY", 90))
+OUTPUT_COMPRESSION = int(os.getenv("OUTPUT_COMPRESSION", 4))
+OUTPUT_ENCODE_WORKERS = int(os.getenv("OUTPUT_ENCODE_WORKERS", 2))
+
+# Zip downloads
+ZIP_STREAM_CHUNK_SIZE = int(os.getenv("ZIP_STREAM_CHUNK_SIZE", 1024 * 1024))
+ZIP_STREAM_QUEUE_SIZE = int(os.getenv("ZIP_STREAM_QUEUE_SIZE", 8))
+
+# Thumbnails
+THUMBNAILS_DIR = BASE_DIR / "thumbnails"
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", 2))
+THUMBNAIL_WIDTHS = (128, 256, 512)
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+
+
+# Model downloads: files are fetched in DOWNLOAD_SEGMENT_SIZE ranges over
+# DOWNLOAD_CONNECTIONS connections and written DOWNLOAD_BUFFER_SIZE at a time
+DOWNLOAD_CONNECTIONS = int(os.getenv("DOWNLOAD_CONNECTIONS", 8))
+DOWNLOAD_SEGMENT_SIZE = int(
+    os.getenv("DOWNLOAD_SEGMENT_SIZE", 64 * 1024 * 1024)
+)
+DOWNLOAD_BUFFER_SIZE = int(os.getenv("DOWNLOAD_BUFFER_SIZE", 8 * 1024 * 1024))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 5))
+
+# Installing models from a local directory (setup.py --local): "auto" tries
+# a hardlink, then a reflink or in-kernel copy, then a plain copy
+MODEL_INSTALL_MODE = os.getenv("MODEL_INSTALL_MODE", "auto")
+MODEL_INSTALL_WORKERS = int(os.getenv("MODEL_INSTALL_WORKERS", 4))
 
 
 # Requirements
@@ -77,3 +199,28 @@ class Models(Enum):
         NAME="flux1-schnell.safetensors",
         PATH=UNET_DIR / "flux1-schnell.safetensors"
     )
+
+
+@dataclass
+class MemoryProfile:
+    TEXT_ENCODER: Models
+    WEIGHT_DTYPE: str
+    # Extra arguments of spawned ComfyUI instances, when it is the
+    # deployment's profile.
+    COMFYUI_ARGS: tuple[str, ...] = ()
+
+
+# Precision and memory trade-offs, selected per deployment with
+# MEMORY_PROFILE and per request with `profile`. A profile sets the T5 text
+# encoder file and the UNET weight dtype of every workflow; without one the
+# workflow files' own settings are used.
+MEMORY_PROFILES = {
+    "fp16": MemoryProfile(TEXT_ENCODER=Models.FP16, WEIGHT_DTYPE="default"),
+    "fp8": MemoryProfile(TEXT_ENCODER=Models.FP8, WEIGHT_DTYPE="fp8_e4m3fn"),
+    "low-vram": MemoryProfile(
+        TEXT_ENCODER=Models.FP8,
+        WEIGHT_DTYPE="fp8_e4m3fn",
+        COMFYUI_ARGS=("--lowvram",),
+    ),
+}
+MEMORY_PROFILE = os.getenv("MEMORY_PROFILE", "")
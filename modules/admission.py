@@ -0,0 +1,190 @@
+import math
+from collections import Counter
+from dataclasses import dataclass
+
+from fastapi import HTTPException, status
+
+from config import (
+    ADMISSION_MAX_PENDING,
+    ADMISSION_MAX_GPU_SECONDS,
+    ADMISSION_CLIENT_MAX_PENDING,
+    ADMISSION_SECONDS_PER_STEP,
+)
+from modules.backends import BackendPool
+from modules.jobs import Job, JobState
+from modules.logger import logger
+
+
+# Weight of the newest observation in the learned seconds per step.
+LEARNING_RATE = 0.2
+
+
+def work_units(params: dict) -> float:
+    megapixels = (params.get("width") or 1024) * (
+        params.get("height") or 1024
+    ) / 2**20
+    return (
+        (params.get("steps") or 1) * (params.get("batch_size") or 1) *
+        megapixels
+    )
+
+
+@dataclass
+class Reservation:
+    client: str
+    jobs: int
+    seconds: float
+
+
+# Bounds the work waiting for ComfyUI. Requests are admitted against the
+# number of unfinished jobs, their estimated GPU seconds and a per-client
+# job quota; capacity is reserved up front, so a burst of concurrent
+# requests can not overshoot while its jobs are being created.
+class AdmissionController:
+    def __init__(
+        self,
+        backends: BackendPool,
+        max_pending: int = ADMISSION_MAX_PENDING,
+        max_gpu_seconds: float = ADMISSION_MAX_GPU_SECONDS,
+        client_max_pending: int = ADMISSION_CLIENT_MAX_PENDING,
+        seconds_per_step: float = ADMISSION_SECONDS_PER_STEP,
+    ):
+        self.backends = backends
+        self.max_pending = max_pending
+        self.max_gpu_seconds = max_gpu_seconds
+        self.client_max_pending = client_max_pending
+        self.default_seconds_per_step = seconds_per_step
+        self.seconds_per_step: dict[str, float] = {}
+        self.pending = 0
+        self.gpu_seconds = 0.0
+        self.rejected = 0
+        self._client_pending: Counter[str] = Counter()
+        self._active: dict[str, tuple[str, float]] = {}
+
+    @property
+    def saturated(self) -> bool:
+        return (
+            0 < self.max_pending <= self.pending or
+            0 < self.max_gpu_seconds <= self.gpu_seconds
+        )
+
+    def estimate(self, model: str, params: dict) -> float:
+        seconds_per_step = self.seconds_per_step.get(
+            model, self.default_seconds_per_step
+        )
+        return seconds_per_step * work_units(params)
+
+    def _drain_seconds(self, seconds: float) -> int:
+        # Every available backend works off one GPU second per second.
+        backends = max(1, len(self.backends.available()))
+        return max(1, math.ceil(seconds / backends))
+
+    def _reject(self, reason: str, retry_after: int):
+        self.rejected += 1
+        logger.warning(f"Rejected request: {reason}, retry in {retry_after}s")
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=reason,
+            headers={"Retry-After": str(retry_after)},
+        )
+
+    def _check(self, client: str, costs: list[float]):
+        jobs, seconds = len(costs), sum(costs)
+        for limit, used, requested, name in (
+            (self.max_pending, self.pending, jobs, "pending jobs"),
+            (
+                self.client_max_pending,
+                self._client_pending[client],
+                jobs,
+                f"pending jobs of client {client}",
+            ),
+            (self.max_gpu_seconds, self.gpu_seconds, seconds, "GPU seconds"),
+        ):
+            if limit and requested > limit:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"Request exceeds the limit of {limit} {name}",
+                )
+        average = (
+            self.gpu_seconds / self.pending if self.pending
+            else seconds / jobs
+        )
+        if self.max_pending and self.pending + jobs > self.max_pending:
+            excess = self.pending + jobs - self.max_pending
+            self._reject(
+                f"Too many pending jobs ({self.pending}/{self.max_pending})",
+                self._drain_seconds(excess * average),
+            )
+        client_pending = self._client_pending[client]
+        if (
+            self.client_max_pending and
+            client_pending + jobs > self.client_max_pending
+        ):
+            excess = client_pending + jobs - self.client_max_pending
+            self._reject(
+                f"Too many pending jobs of client {client} "
+                f"({client_pending}/{self.client_max_pending})",
+                self._drain_seconds(excess * average),
+            )
+        if (
+            self.max_gpu_seconds and
+            self.gpu_seconds + seconds > self.max_gpu_seconds
+        ):
+            self._reject(
+                f"Too much queued work ({self.gpu_seconds:.0f}/"
+                f"{self.max_gpu_seconds:.0f} GPU seconds)",
+                self._drain_seconds(
+                    self.gpu_seconds + seconds - self.max_gpu_seconds
+                ),
+            )
+
+    def _add(self, client: str, jobs: int, seconds: float):
+        self.pending += jobs
+        self.gpu_seconds = max(0.0, self.gpu_seconds + seconds)
+        self._client_pending[client] += jobs
+        if self._client_pending[client] <= 0:
+            del self._client_pending[client]
+
+    def reserve(self, client: str, costs: list[float]) -> Reservation:
+        self._check(client, costs)
+        reservation = Reservation(client, len(costs), sum(costs))
+        self._add(client, reservation.jobs, reservation.seconds)
+        return reservation
+
+    def track(self, reservation: Reservation, job: Job, cost: float):
+        # Moves one job's share of the reservation over to the job itself.
+        reservation.jobs -= 1
+        reservation.seconds -= cost
+        self._add(reservation.client, -1, -cost)
+        # Answered from the cache, or shared with a job tracked already.
+        if job.finished or job.id in self._active:
+            return
+        self._active[job.id] = (reservation.client, cost)
+        self._add(reservation.client, 1, cost)
+
+    def cancel(self, reservation: Reservation):
+        self._add(reservation.client, -reservation.jobs, -reservation.seconds)
+        reservation.jobs, reservation.seconds = 0, 0.0
+
+    def release(self, job: Job):
+        active = self._active.pop(job.id, None)
+        if active is None:
+            return
+        client, cost = active
+        self._add(client, -1, -cost)
+        self._learn(job)
+
+    def _learn(self, job: Job):
+        # A batched job's run time covers the other jobs of its batch too.
+        if (
+            job.state != JobState.COMPLETED or
+            job.run_seconds is None or
+            job.output_count is not None
+        ):
+            return
+        observed = job.run_seconds / work_units(job.params)
+        current = self.seconds_per_step.get(job.model)
+        self.seconds_per_step[job.model] = (
+            observed if current is None
+            else current + LEARNING_RATE * (observed - current)
+        )
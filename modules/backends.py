@@ -0,0 +1,260 @@
+import asyncio
+import re
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Awaitable, Callable
+from urllib.parse import urlparse
+
+import aiohttp
+
+from config import (
+    COMFYUI_HOST,
+    COMFYUI_LOCAL,
+    COMFYUI_REMOTE,
+    COMFYUI_HEALTH_INTERVAL,
+    COMFYUI_EJECT_AFTER,
+    MEMORY_PROFILE,
+    MEMORY_PROFILES,
+)
+from modules.comfyui_client import ComfyUIClient
+from modules.logger import logger
+
+
+DEFAULT_FILENAME_PREFIX = "ComfyUI"
+
+
+class BackendState(str, Enum):
+    STARTING = "starting"
+    HEALTHY = "healthy"
+    EJECTED = "ejected"
+
+
+@dataclass
+class Backend:
+    name: str
+    client: ComfyUIClient
+    # Set for instances spawned by us, None for ones attached by URL.
+    port: int | None = None
+    args: list[str] = field(default_factory=list)
+    process: asyncio.subprocess.Process | None = field(
+        default=None, repr=False
+    )
+    log_tasks: list[asyncio.Task] = field(default_factory=list, repr=False)
+    state: BackendState = BackendState.STARTING
+    # Prompts in ComfyUI's queue as last polled, prompts being sent to it,
+    # ones it took from us by the poll count then, and ones finished since.
+    # Our own are counted from what we know, the poll adds other clients'
+    # and drops ours it no longer holds.
+    polled: set[str] = field(default_factory=set)
+    polls: int = 0
+    in_flight: int = 0
+    active: dict[str, int] = field(default_factory=dict)
+    done: set[str] = field(default_factory=set)
+    failures: int = 0
+    connected: bool = False
+    filename_prefix: str = DEFAULT_FILENAME_PREFIX
+    # Workflow of the last prompt sent and the models it needs, which the
+    # instance holds in memory once it has run it.
+    loaded: str | None = None
+    model_set: str | None = None
+
+    @property
+    def local(self) -> bool:
+        return self.port is not None
+
+    @property
+    def available(self) -> bool:
+        return self.state == BackendState.HEALTHY
+
+    @property
+    def queue_depth(self) -> int:
+        foreign = self.polled - self.active.keys() - self.done
+        return self.in_flight + len(self.active) + len(foreign)
+
+
+Spawn = Callable[[Backend], Awaitable[asyncio.subprocess.Process]]
+
+
+def parse_backends(
+    local: str = COMFYUI_LOCAL, remote: str = COMFYUI_REMOTE
+) -> list[Backend]:
+    backends = []
+    profile = MEMORY_PROFILES.get(MEMORY_PROFILE)
+    profile_args = list(profile.COMFYUI_ARGS) if profile else []
+    for spec in filter(None, (item.strip() for item in local.split(","))):
+        port, _, args = spec.partition(":")
+        backends.append(
+            Backend(
+                name=f"local:{port}",
+                client=ComfyUIClient(f"http://{COMFYUI_HOST}:{port}"),
+                port=int(port),
+                args=profile_args + args.split(),
+            )
+        )
+    for url in filter(None, (item.strip() for item in remote.split(","))):
+        name = urlparse(url).netloc or url
+        backends.append(Backend(name=name, client=ComfyUIClient(url)))
+    return backends
+
+
+def set_filename_prefix(workflow: dict, prefix: str) -> dict:
+    if prefix == DEFAULT_FILENAME_PREFIX:
+        return workflow
+    workflow = dict(workflow)
+    for node_id, node in workflow.items():
+        if node.get("class_type") == "SaveImage":
+            workflow[node_id] = {
+                **node, "inputs": {**node["inputs"], "filename_prefix": prefix}
+            }
+    return workflow
+
+
+# The ComfyUI instances jobs are spread over. Each one is polled for its
+# queue depth, which doubles as its health check: an instance failing
+# `eject_after` checks in a row, or refusing a prompt, stops receiving jobs
+# until it answers again.
+class BackendPool:
+    def __init__(
+        self,
+        backends: list[Backend],
+        spawn: Spawn | None = None,
+        health_interval: float = COMFYUI_HEALTH_INTERVAL,
+        eject_after: int = COMFYUI_EJECT_AFTER,
+    ):
+        if not backends:
+            raise ValueError("No ComfyUI backends configured")
+        self.backends = backends
+        self.spawn = spawn
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        # Instances sharing the output directory must not race for names.
+        if len(backends) > 1 or not backends[0].local:
+            for backend in backends:
+                backend.filename_prefix = "ComfyUI_" + re.sub(
+                    r"\W", "_", backend.name
+                )
+
+    def __iter__(self):
+        return iter(self.backends)
+
+    def __len__(self) -> int:
+        return len(self.backends)
+
+    def get(self, name: str) -> Backend | None:
+        for backend in self.backends:
+            if backend.name == name:
+                return backend
+        return None
+
+    def available(self) -> list[Backend]:
+        return [backend for backend in self.backends if backend.available]
+
+    def candidates(self) -> list[Backend]:
+        # Images sent over a websocket not yet connected would be lost.
+        return sorted(
+            (backend for backend in self.available() if backend.connected),
+            key=lambda backend: backend.queue_depth,
+        )
+
+    def dispatched(self, backend: Backend):
+        # Counted before the prompt is sent, so a concurrent burst spreads
+        # over instances.
+        backend.in_flight += 1
+
+    def sent(self, backend: Backend, prompt_id: str | None):
+        # None when ComfyUI did not take the prompt.
+        backend.in_flight = max(0, backend.in_flight - 1)
+        if prompt_id is not None:
+            backend.active[prompt_id] = backend.polls
+
+    def finished(self, backend: Backend, prompt_id: str):
+        # A poll taken before it finished may still list it.
+        backend.active.pop(prompt_id, None)
+        backend.done.add(prompt_id)
+
+    def report_failure(self, backend: Backend, error):
+        if backend.state != BackendState.HEALTHY:
+            return
+        backend.failures += 1
+        logger.warning(
+            f"ComfyUI {backend.name} failed ({error}) "
+            f"[{backend.failures}/{self.eject_after}]"
+        )
+        if backend.failures >= self.eject_after:
+            self.eject(backend)
+
+    def eject(self, backend: Backend, reason: str | None = None):
+        if backend.state == BackendState.HEALTHY:
+            logger.error(
+                f"Ejected ComfyUI {backend.name}"
+                + (f": {reason}" if reason else "")
+            )
+        backend.state = BackendState.EJECTED
+
+    def _admit(self, backend: Backend):
+        if backend.state == BackendState.EJECTED:
+            logger.info(f"Readmitted ComfyUI {backend.name}")
+        elif backend.state == BackendState.STARTING:
+            logger.info(f"ComfyUI {backend.name} is ready")
+        backend.state = BackendState.HEALTHY
+        backend.failures = 0
+
+    async def start(self):
+        for backend in self.backends:
+            await backend.client.start()
+            if backend.local and self.spawn is not None:
+                backend.process = await self.spawn(backend)
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
+            process = backend.process
+            if process is None or process.returncode is not None:
+                continue
+            logger.info(f"Stopping ComfyUI {backend.name}...")
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                continue
+            await process.wait()
+            logger.info(f"ComfyUI {backend.name} stopped")
+
+    async def check(self, backend: Backend):
+        process = backend.process
+        if process is not None and process.returncode is not None:
+            logger.error(
+                f"ComfyUI {backend.name} exited with code {process.returncode}"
+            )
+            self.eject(backend)
+            backend.state = BackendState.STARTING
+            backend.loaded = backend.model_set = None
+            backend.process = await self.spawn(backend)
+            return
+        backend.polls += 1
+        poll = backend.polls
+        try:
+            status_code, data = await backend.client.get("/queue")
+            if status_code != 200:
+                raise ValueError(f"status {status_code}")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self.report_failure(backend, repr(e))
+            return
+        backend.polled = {
+            item[1] for item in data["queue_pending"] + data["queue_running"]
+        }
+        # Gone from the queue, so no later poll can list them again. Ours
+        # sent before the poll started were finished, or lost in a restart.
+        backend.done &= backend.polled
+        backend.active = {
+            prompt_id: accepted_at
+            for prompt_id, accepted_at in backend.active.items()
+            if accepted_at >= poll or prompt_id in backend.polled
+        }
+        self._admit(backend)
+
+    async def run(self):
+        while True:
+            await asyncio.gather(
+                *(self.check(backend) for backend in self.backends)
+            )
+            await asyncio.sleep(self.health_interval)
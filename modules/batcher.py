@@ -0,0 +1,136 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from config import BATCH_WINDOW, BATCH_MAX_SIZE
+from modules.jobs import Job, JobOptions, JobTracker
+from modules.logger import logger
+from modules.workflows import WorkflowTemplate
+
+
+QueueJobs = Callable[..., Awaitable[None]]
+
+
+@dataclass
+class PendingBatch:
+    template: WorkflowTemplate
+    prompt: str
+    params: dict
+    submitted: asyncio.Future
+    jobs: list[Job] = field(default_factory=list)
+    size: int = 0
+    timer: asyncio.TimerHandle | None = None
+
+
+# Holds compatible requests for a short window and sends them to ComfyUI as
+# one prompt with a larger latent batch. Only requests which left the noise
+# seed unset are merged: a batch shares one conditioning and one noise seed,
+# so they must agree on everything else.
+class MicroBatcher:
+    def __init__(
+        self,
+        queue_jobs: QueueJobs,
+        jobs: JobTracker,
+        window: float = BATCH_WINDOW,
+        max_batch_size: int = BATCH_MAX_SIZE,
+    ):
+        self.queue_jobs = queue_jobs
+        self.jobs = jobs
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: dict[tuple, PendingBatch] = {}
+        self._submitting: set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def accepts(self, template: WorkflowTemplate, **kwargs) -> bool:
+        return (
+            self.enabled and
+            kwargs.get("noise_seed") is None and
+            "batch_size" in template.parameters
+        )
+
+    async def add(
+        self,
+        template: WorkflowTemplate,
+        options: JobOptions,
+        prompt: str,
+        **kwargs
+    ) -> Job:
+        batch_size = kwargs.pop("batch_size", 1)
+        kwargs.pop("noise_seed", None)
+        # A batch is scheduled as one prompt, so it keeps to one priority
+        # and is charged to one client.
+        key = (
+            template.name,
+            template.profile,
+            options.client,
+            options.priority,
+            prompt,
+            tuple(sorted(kwargs.items())),
+        )
+
+        batch = self._pending.get(key)
+        if batch is not None and batch.size + batch_size > self.max_batch_size:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            loop = asyncio.get_running_loop()
+            batch = PendingBatch(
+                template=template,
+                prompt=prompt,
+                params=kwargs,
+                submitted=loop.create_future(),
+            )
+            batch.timer = loop.call_later(self.window, self._flush, key)
+            self._pending[key] = batch
+
+        job = self.jobs.create(
+            template.name,
+            options,
+            prompt=prompt,
+            batch_size=batch_size,
+            **kwargs
+        )
+        job.output_offset = batch.size
+        job.output_count = batch_size
+        batch.jobs.append(job)
+        batch.size += batch_size
+        if batch.size >= self.max_batch_size:
+            self._flush(key)
+
+        await asyncio.shield(batch.submitted)
+        return job
+
+    def _flush(self, key: tuple):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._submit(batch))
+        self._submitting.add(task)
+        task.add_done_callback(self._submitting.discard)
+
+    async def _submit(self, batch: PendingBatch):
+        if len(batch.jobs) > 1:
+            logger.info(
+                f"Merged {len(batch.jobs)} {batch.template.name} requests "
+                f"into one batch of {batch.size}"
+            )
+        try:
+            await self.queue_jobs(
+                batch.jobs,
+                batch.template,
+                batch.prompt,
+                batch_size=batch.size,
+                **batch.params,
+            )
+        except Exception as e:
+            batch.submitted.set_exception(e)
+            # Every caller awaits the future, mark it retrieved regardless.
+            batch.submitted.exception()
+        else:
+            batch.submitted.set_result(None)
@@ -0,0 +1,131 @@
+import asyncio
+
+import aiohttp
+
+from config import (
+    COMFYUI_BASE_URL,
+    COMFYUI_CONNECTION_LIMIT,
+    COMFYUI_KEEPALIVE_TIMEOUT,
+    COMFYUI_CONNECT_TIMEOUT,
+    COMFYUI_REQUEST_TIMEOUT,
+    COMFYUI_RETRIES,
+    COMFYUI_RETRY_BACKOFF,
+)
+from modules.logger import logger
+
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "DELETE"}
+
+
+# One keep-alive connection pool per ComfyUI instance, shared by every call.
+class ComfyUIClient:
+    def __init__(
+        self,
+        base_url: str = COMFYUI_BASE_URL,
+        connection_limit: int = COMFYUI_CONNECTION_LIMIT,
+        keepalive_timeout: float = COMFYUI_KEEPALIVE_TIMEOUT,
+        connect_timeout: float = COMFYUI_CONNECT_TIMEOUT,
+        request_timeout: float = COMFYUI_REQUEST_TIMEOUT,
+        retries: int = COMFYUI_RETRIES,
+        retry_backoff: float = COMFYUI_RETRY_BACKOFF,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self):
+        if self._session is not None:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.connection_limit,
+            limit_per_host=self.connection_limit,
+            keepalive_timeout=self.keepalive_timeout,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.request_timeout,
+            sock_connect=self.connect_timeout,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=timeout,
+        )
+        logger.info(
+            f"ComfyUI client started for {self.base_url} "
+            f"(pool size: {self.connection_limit})"
+        )
+
+    async def close(self):
+        if self._session is None:
+            return
+        await self._session.close()
+        self._session = None
+        logger.info(f"ComfyUI client for {self.base_url} closed")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            raise RuntimeError("ComfyUI client is not started")
+        return self._session
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def _should_retry(self, method: str, error: Exception) -> bool:
+        if method in IDEMPOTENT_METHODS:
+            return True
+        # A non-idempotent request is only safe to resend when it never
+        # reached ComfyUI, otherwise the prompt could be queued twice.
+        return isinstance(error, aiohttp.ClientConnectorError)
+
+    async def request(self, method: str, path: str, **kwargs):
+        method = method.upper()
+        attempt = 0
+        while True:
+            try:
+                async with self.session.request(
+                    method, self.url(path), **kwargs
+                ) as response:
+                    if (
+                        response.status >= 500 and
+                        method in IDEMPOTENT_METHODS and
+                        attempt < self.retries
+                    ):
+                        raise aiohttp.ClientResponseError(
+                            response.request_info,
+                            response.history,
+                            status=response.status,
+                            message=response.reason or "",
+                        )
+                    data = await self._read_body(response)
+                    return response.status, data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if (
+                    attempt >= self.retries or
+                    not self._should_retry(method, e)
+                ):
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                attempt += 1
+                logger.warning(
+                    f"{method} {path} failed ({e!r}), "
+                    f"retrying in {delay:.2f}s "
+                    f"[{attempt}/{self.retries}]"
+                )
+                await asyncio.sleep(delay)
+
+    @staticmethod
+    async def _read_body(response: aiohttp.ClientResponse):
+        if response.content_type == "application/json":
+            return await response.json()
+        return await response.read()
+
+    async def get(self, path: str, **kwargs):
+        return await self.request("GET", path, **kwargs)
+
+    async def post(self, path: str, payload, **kwargs):
+        return await self.request("POST", path, json=payload, **kwargs)
@@ -1,60 +1,43 @@
-from enum import Enum
+import asyncio
 import random
-import json
-from pathlib import Path
+import time
+from dataclasses import asdict
 
 from fastapi import HTTPException, status
 import aiohttp
 
-from config import COMFYUI_BASE_URL, WORKFLOWS_DIR, Models
+from config import BULK_CONCURRENCY
+from modules.admission import AdmissionController
+from modules.backends import BackendPool
+from modules.batcher import MicroBatcher
+from modules.comfyui_client import ComfyUIClient
+from modules.encoder import Encoding, get_encoding
+from modules.jobs import (
+    INLINE_CLASS_TYPE,
+    INLINE_NODE,
+    Job,
+    JobOptions,
+    JobState,
+    JobTracker,
+    Priority,
+)
 from modules.logger import logger
-
-
-class WorkflowPaths(Enum):
-    DEV = WORKFLOWS_DIR / "flux_dev_workflow.json"
-    SCHNELL = WORKFLOWS_DIR / "flux_schnell_workflow.json"
+from modules.metrics import observe_bulk
+from modules.model_registry import ModelRegistry
+from modules.result_cache import ResultCache, workflow_key
+from modules.scheduler import Scheduler
+from modules.workflows import WorkflowRegistry, WorkflowTemplate
 
 
 def get_random_noise_seed() -> int:
     return random.randint(0, 2**64)
 
 
-def load_workflow(workflow_path: Path):
-    try:
-        logger.info(f"Loading workflow from {workflow_path}")
-        with open(workflow_path, 'r') as file:
-            return json.load(file)
-    except FileNotFoundError:
-        logger.error(f"The file {workflow_path} was not found.")
-        return None
-    except json.JSONDecodeError:
-        logger.error(f"The file {workflow_path} contains invalid JSON.")
-        return None
-
-
-async def queue_prompt(nodes):
-    prompt = {"prompt": nodes}
-    data = json.dumps(prompt).encode("utf-8")
+async def get_queue_status(client: ComfyUIClient):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{COMFYUI_BASE_URL}/prompt", data=data) as response:
-                response_json = await response.json()
-                response.raise_for_status()
-                return response_json
-    except aiohttp.ClientError as e:
-        logger.error(f"Failed to queue prompt: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Failed to queue prompt: {e} {response_json}"
-        )
-
-
-async def get_queue_status():
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{COMFYUI_BASE_URL}/queue") as response:
-                return await response.json()
-    except aiohttp.ClientError as e:
+        _, response_json = await client.get("/queue")
+        return response_json
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
         logger.error(f"Failed to get queue status: {e}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -62,145 +45,258 @@ async def get_queue_status():
         )
 
 
-async def check_health():
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{COMFYUI_BASE_URL}") as response:
-                return response.status == 200
-    except aiohttp.ClientError as e:
-        logger.error(f"Failed to check health: {e}")
-        return False
-
-
-def prepare_schnell_workflow(
+def prepare_workflow(
+    template: WorkflowTemplate,
     prompt: str,
-    width: int = 1920,
-    height: int = 1080,
-    batch_size: int = 1,
     noise_seed: int | None = None,
-    steps: int = 4,
+    **kwargs
 ):
-    logger.info("Preparing schnell workflow")
-    workflow = load_workflow(WorkflowPaths.SCHNELL.value)
-    workflow["5"]["inputs"]["width"] = width
-    workflow["5"]["inputs"]["height"] = height
-    workflow["5"]["inputs"]["batch_size"] = batch_size
-    workflow["25"]["inputs"]["noise_seed"] = (
-        get_random_noise_seed() if noise_seed is None else noise_seed
-    )
-    workflow["17"]["inputs"]["steps"] = steps
-    workflow["6"]["inputs"]["text"] = prompt
+    logger.info(f"Preparing {template.name} workflow")
+    noise_seed = get_random_noise_seed() if noise_seed is None else noise_seed
+    workflow = template.render(prompt=prompt, noise_seed=noise_seed, **kwargs)
     logger.info(
-        f"Schnell workflow prepared with prompt: {prompt}, "
-        f"width: {width}, height: {height}, batch_size: {batch_size}, "
-        f"noise_seed: {noise_seed}, steps: {steps}"
+        f"{template.name.capitalize()} workflow prepared with "
+        f"prompt: {prompt}, noise_seed: {noise_seed}, "
+        + ", ".join(f"{key}: {value}" for key, value in kwargs.items())
     )
     return workflow
 
 
-def prepare_dev_workflow(
-    prompt: str,
-    width: int = 1920,
-    height: int = 1080,
-    batch_size: int = 1,
-    noise_seed: int | None = None,
-    steps: int = 20,
-):
-    logger.info("Preparing dev workflow")
-    workflow = load_workflow(WorkflowPaths.DEV.value)
-    workflow["6"]["inputs"]["text"] = prompt
-    workflow["25"]["inputs"]["noise_seed"] = (
-        get_random_noise_seed() if noise_seed is None else noise_seed
-    )
-    workflow["27"]["inputs"]["width"] = width
-    workflow["27"]["inputs"]["height"] = height
-    workflow["27"]["inputs"]["batch_size"] = batch_size
-    workflow["30"]["inputs"]["width"] = width
-    workflow["30"]["inputs"]["height"] = height
-    workflow["17"]["inputs"]["steps"] = steps
-
-    logger.info(
-        f"Dev workflow prepared with prompt: {prompt}, "
-        f"width: {width}, height: {height}, batch_size: {batch_size}, "
-        f"noise_seed: {noise_seed}, steps: {steps}"
-    )
+def send_images_inline(workflow: dict, save: bool = False) -> dict:
+    # The images saved go out over the websocket instead, or as well.
+    saves = [
+        node_id for node_id, node in workflow.items()
+        if node.get("class_type") == "SaveImage"
+    ]
+    if not saves:
+        raise ValueError("Workflow has no SaveImage node")
+    images = workflow[saves[0]]["inputs"]["images"]
+    workflow = {
+        node_id: node for node_id, node in workflow.items()
+        if save or node_id not in saves
+    }
+    workflow[INLINE_NODE] = {
+        "class_type": INLINE_CLASS_TYPE,
+        "inputs": {"images": images},
+    }
     return workflow
 
 
-def check_dev_workflow_requirements():
-    errors = []
-    msg = "Model: {model_name} not found"
-    if not Models.FLUX_DEV.value.PATH.exists():
-        model_name = Models.FLUX_DEV.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    if not Models.CLIPL.value.PATH.exists():
-        model_name = Models.CLIPL.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    if not Models.FP16.value.PATH.exists():
-        model_name = Models.FP16.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    # TODO: Make option to use FP8 for dev workflow
-    # elif not Models.FP8.value.PATH.exists():
-    #     model_name = Models.FP8.value.NAME
-    #     logger.error(msg.format(model_name=model_name))
-    #     errors.append(model_name)
-    if not Models.VAE.value.PATH.exists():
-        model_name = Models.VAE.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    if errors:
-        raise FileNotFoundError(msg.format(model_name=", ".join(errors)))
-
-
-def check_schnell_workflow_requirements():
-    errors = []
-    msg = "Model: {model_name} not found"
-    if not Models.FLUX_SCHNELL.value.PATH.exists():
-        model_name = Models.FLUX_SCHNELL.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    if not Models.CLIPL.value.PATH.exists():
-        model_name = Models.CLIPL.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    if not Models.FP8.value.PATH.exists():
-        model_name = Models.FP8.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    # TODO: Make option to use FP16 for schnell workflow
-    # elif not Models.FP16.value.PATH.exists():
-    #     model_name = Models.FP16.value.NAME
-    #     logger.error(msg.format(model_name=model_name))
-    #     errors.append(model_name)
-    if not Models.VAE.value.PATH.exists():
-        model_name = Models.VAE.value.NAME
-        logger.error(msg.format(model_name=model_name))
-        errors.append(model_name)
-    if errors:
-        raise FileNotFoundError(msg.format(model_name=", ".join(errors)))
-
-
-async def generate(
-    model: str,
-    prompt: str,
-    **kwargs
-):
-    logger.info(
-        f"Generating with model {model} "
-        f"with prompt: {prompt} and kwargs: {kwargs}"
+def job_options(
+    client: str,
+    priority: Priority | str,
+    deadline: float | None,
+    template: WorkflowTemplate,
+    inline: bool = False,
+    save: bool = True,
+    encoding: Encoding | None = None,
+) -> JobOptions:
+    # Deadlines are given in seconds from now.
+    return JobOptions(
+        client=client,
+        priority=Priority(priority),
+        deadline=None if deadline is None else time.time() + deadline,
+        profile=template.profile,
+        inline=inline,
+        save=save,
+        encoding=encoding,
     )
-    if model == "dev":
-        check_dev_workflow_requirements()
-        workflow = prepare_dev_workflow(
-            prompt, **kwargs)
-    elif model == "schnell":
-        check_schnell_workflow_requirements()
-        workflow = prepare_schnell_workflow(
-            prompt, **kwargs)
-    else:
-        logger.error(f"Invalid model: {model}")
-        raise ValueError(f"Invalid model: {model}")
-    await queue_prompt(workflow)
+
+
+class FluxService:
+    def __init__(
+        self,
+        backends: BackendPool,
+        workflows: WorkflowRegistry,
+        jobs: JobTracker,
+        cache: ResultCache | None = None,
+        admission: AdmissionController | None = None,
+        scheduler: Scheduler | None = None,
+        models: ModelRegistry | None = None,
+    ):
+        self.backends = backends
+        self.workflows = workflows
+        self.jobs = jobs
+        if models is None:
+            models = ModelRegistry()
+            models.refresh()
+        self.models = models
+        self.cache = ResultCache() if cache is None else cache
+        self.admission = (
+            AdmissionController(backends) if admission is None else admission
+        )
+        self.scheduler = (
+            Scheduler(backends, jobs) if scheduler is None else scheduler
+        )
+        self.batcher = MicroBatcher(self._queue_jobs, jobs)
+
+    async def generate(
+        self,
+        model: str,
+        prompt: str,
+        client: str = "",
+        priority: Priority | str = Priority.NORMAL,
+        deadline: float | None = None,
+        profile: str | None = None,
+        inline: bool = False,
+        save: bool = True,
+        format: str | None = None,
+        quality: int | None = None,
+        compression: int | None = None,
+        **kwargs
+    ) -> Job:
+        logger.info(
+            f"Generating with model {model} "
+            f"with prompt: {prompt} and kwargs: {kwargs}"
+        )
+        template = self.workflows.get(model, profile)
+        self.models.check(template)
+        options = job_options(
+            client,
+            priority,
+            deadline,
+            template,
+            inline,
+            save,
+            get_encoding(format, quality, compression),
+        )
+        cost = self.admission.estimate(template.name, kwargs)
+        reservation = self.admission.reserve(client, [cost])
+        try:
+            job = await self._submit(template, options, prompt, **kwargs)
+            self.admission.track(reservation, job, cost)
+        finally:
+            self.admission.cancel(reservation)
+        return job
+
+    async def generate_bulk(
+        self,
+        model: str,
+        items: list[dict],
+        client: str = "",
+        concurrency: int = BULK_CONCURRENCY,
+    ) -> list[Job | Exception]:
+        logger.info(f"Generating {len(items)} items with model {model}")
+        costs = [
+            self.admission.estimate(model, item) for item in items
+        ]
+        # A bulk request is admitted as a whole or not at all.
+        reservation = self.admission.reserve(client, costs)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def submit(item: dict, cost: float) -> Job:
+            item = dict(item)
+            # An item whose profile cannot be served fails on its own.
+            item_template = self.workflows.get(
+                model, item.pop("profile", None)
+            )
+            self.models.check(item_template)
+            options = job_options(
+                client,
+                item.pop("priority", Priority.BATCH),
+                item.pop("deadline", None),
+                item_template,
+                encoding=get_encoding(
+                    item.pop("format", None),
+                    item.pop("quality", None),
+                    item.pop("compression", None),
+                ),
+            )
+            async with semaphore:
+                job = await self._submit(item_template, options, **item)
+                self.admission.track(reservation, job, cost)
+                return job
+
+        try:
+            results = await asyncio.gather(
+                *(submit(item, cost) for item, cost in zip(items, costs)),
+                return_exceptions=True,
+            )
+        finally:
+            self.admission.cancel(reservation)
+        accepted = sum(isinstance(result, Job) for result in results)
+        observe_bulk(model, accepted, len(results) - accepted)
+        return results
+
+    async def _submit(
+        self,
+        template: WorkflowTemplate,
+        options: JobOptions,
+        prompt: str,
+        **kwargs
+    ) -> Job:
+        if options.inline:
+            return self._submit_inline(template, options, prompt, **kwargs)
+        encoding = options.encoding
+        if encoding is None and self.batcher.accepts(template, **kwargs):
+            return await self.batcher.add(template, options, prompt, **kwargs)
+        workflow = prepare_workflow(template, prompt, **kwargs)
+        if encoding is not None:
+            workflow = send_images_inline(workflow)
+        key = cached = None
+        # Without a seed every run differs, so only seeded ones are cached.
+        if self.cache.enabled and kwargs.get("noise_seed") is not None:
+            key = workflow_key(workflow)
+            if encoding is not None:
+                key = workflow_key({"workflow": key, **asdict(encoding)})
+            cached = self.cache.get(key)
+        job = self.jobs.create(
+            template.name, options, prompt=prompt, **kwargs
+        )
+        if cached is not None and self._from_cache(cached, job):
+            return job
+        if key is not None:
+            self.cache.put(key, job)
+        self.scheduler.submit(
+            [job], workflow, self.admission.estimate(template.name, kwargs)
+        )
+        return job
+
+    def _submit_inline(
+        self,
+        template: WorkflowTemplate,
+        options: JobOptions,
+        prompt: str,
+        **kwargs
+    ) -> Job:
+        # The images only ever exist in the prompt's websocket messages,
+        # which a cached or batched job would not see. Encoded ones are
+        # saved by the API rather than by ComfyUI.
+        workflow = send_images_inline(
+            prepare_workflow(template, prompt, **kwargs),
+            options.save and options.encoding is None,
+        )
+        job = self.jobs.create(
+            template.name, options, prompt=prompt, **kwargs
+        )
+        self.scheduler.submit(
+            [job], workflow, self.admission.estimate(template.name, kwargs)
+        )
+        return job
+
+    def _from_cache(self, cached: Job, job: Job) -> bool:
+        # Identical requests still in flight share one prompt, each with
+        # its own job, unless it would wait behind a lower priority.
+        if cached.finished:
+            job.cached = True
+            self.jobs.complete(job, cached.outputs)
+            return True
+        order = list(Priority)
+        if (
+            cached.state == JobState.PENDING and
+            order.index(job.priority) < order.index(cached.priority)
+        ):
+            return False
+        return self.scheduler.follow(cached, job)
+
+    async def _queue_jobs(
+        self,
+        jobs: list[Job],
+        template: WorkflowTemplate,
+        prompt: str,
+        **kwargs
+    ):
+        workflow = prepare_workflow(template, prompt, **kwargs)
+        self.scheduler.submit(
+            jobs, workflow, self.admission.estimate(template.name, kwargs)
+        )
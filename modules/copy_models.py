@@ -1,12 +1,165 @@
+import hashlib
+import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
 from pathlib import Path
+from typing import Callable
+from uuid import uuid4
 
-from config import Models
+from tqdm import tqdm
+
+from config import MODEL_INSTALL_MODE, MODEL_INSTALL_WORKERS, Models
 from modules.logger import logger
 
+try:
+    import fcntl
+except ImportError:
+    # Missing on Windows, which can not reflink.
+    fcntl = None
+
+
+# Linux ioctl sharing the extents of one file with another (btrfs, XFS).
+FICLONE = 0x40049409
+CHUNK_SIZE = 64 * 1024 * 1024
+# Reflinks take the ioctl, or copy_file_range to fall back on, as on Linux.
+REFLINK_SUPPORTED = fcntl is not None and hasattr(os, "copy_file_range")
+
+Progress = Callable[[int], None]
+
+
+class InstallMode(str, Enum):
+    AUTO = "auto"
+    HARDLINK = "hardlink"
+    REFLINK = "reflink"
+    SYMLINK = "symlink"
+    COPY = "copy"
+
+
+class Verify(str, Enum):
+    SIZE = "size"
+    HASH = "hash"
+
+
+# Modes tried in turn when one is not supported between two locations.
+FALLBACKS = {
+    InstallMode.AUTO: [
+        InstallMode.HARDLINK, InstallMode.REFLINK, InstallMode.COPY
+    ],
+    InstallMode.HARDLINK: [
+        InstallMode.HARDLINK, InstallMode.REFLINK, InstallMode.COPY
+    ],
+    InstallMode.REFLINK: [InstallMode.REFLINK, InstallMode.COPY],
+    InstallMode.SYMLINK: [InstallMode.SYMLINK, InstallMode.COPY],
+    InstallMode.COPY: [InstallMode.COPY],
+}
+
+
+def reflink(source: Path, target: Path, progress: Progress):
+    size = source.stat().st_size
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            # No shared extents, the kernel may still copy without us
+            # (or server side on NFS).
+            copied = 0
+            while copied < size:
+                count = os.copy_file_range(
+                    src.fileno(), dst.fileno(), min(CHUNK_SIZE, size - copied)
+                )
+                if count == 0:
+                    raise OSError(f"copy_file_range stopped at {copied}")
+                copied += count
+                progress(count)
+            return
+    progress(size)
+
+
+def copy(source: Path, target: Path, progress: Progress):
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        while chunk := src.read(CHUNK_SIZE):
+            dst.write(chunk)
+            progress(len(chunk))
+    shutil.copystat(source, target)
 
-def copy_local_models_from_dir(path: str):
+
+def install(
+    source: Path, target: Path, mode: InstallMode, progress: Progress
+):
+    if mode == InstallMode.HARDLINK:
+        os.link(source, target)
+        progress(source.stat().st_size)
+    elif mode == InstallMode.SYMLINK:
+        os.symlink(source.resolve(), target)
+        progress(source.stat().st_size)
+    elif mode == InstallMode.REFLINK:
+        reflink(source, target, progress)
+    else:
+        copy(source, target, progress)
+
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_model(source: Path, target: Path, verify: Verify):
+    source_stat, target_stat = source.stat(), target.stat()
+    if source_stat.st_size != target_stat.st_size:
+        raise ValueError(
+            f"{target} has {target_stat.st_size} bytes, "
+            f"expected {source_stat.st_size}"
+        )
+    # Links share their data with the source, nothing left to compare.
+    if verify == Verify.HASH and not os.path.samefile(source, target):
+        if file_hash(source) != file_hash(target):
+            raise ValueError(f"{target} differs from {source}")
+
+
+def install_model(
+    source: Path, target: Path, mode: InstallMode, verify: Verify, bar: tqdm
+) -> InstallMode:
+    target.parent.mkdir(parents=True, exist_ok=True)
+    # Installed under a temporary name, so a model is never seen half done.
+    tmp_path = target.with_name(f".{target.name}.{uuid4().hex}.tmp")
+    modes = [
+        used for used in FALLBACKS[mode]
+        if used != InstallMode.REFLINK or REFLINK_SUPPORTED
+    ]
+    for used in modes:
+        installed = 0
+
+        def progress(count: int):
+            nonlocal installed
+            installed += count
+            bar.update(count)
+
+        try:
+            install(source, tmp_path, used, progress)
+            verify_model(source, tmp_path, verify)
+        except (OSError, ValueError) as e:
+            tmp_path.unlink(missing_ok=True)
+            bar.update(-installed)
+            if used == modes[-1]:
+                raise
+            logger.warning(f"Can not {used.value} {source.name}: {e}")
+            continue
+        os.replace(tmp_path, target)
+        return used
+
+
+def copy_local_models_from_dir(
+    path: str,
+    mode: InstallMode | str = MODEL_INSTALL_MODE,
+    verify: Verify | str = Verify.SIZE,
+    workers: int = MODEL_INSTALL_WORKERS,
+):
     path = Path(path)
+    mode, verify = InstallMode(mode), Verify(verify)
     logger.info(f"Finding local models in {path}...")
     tasks = []
     for model in Models:
@@ -20,12 +173,39 @@ def copy_local_models_from_dir(path: str):
     else:
         logger.info(f"Found {len(tasks)} local models.")
 
+    pending = []
     for model in tasks:
-        copy_from_path = path / model.value.NAME
         if model.value.PATH.exists():
-            logger.error(f"Model {model.value.NAME} already exists.")      
+            logger.error(f"Model {model.value.NAME} already exists.")
             continue
-        logger.info(f"Copying {copy_from_path} to {model.value.PATH}...")
-        shutil.copy(copy_from_path, model.value.PATH)
-        logger.info(f"Copied {copy_from_path} to {model.value.PATH}")
-    logger.info(f"Copied {len(tasks)} models successfully.")
+        pending.append(model)
+
+    total = sum((path / model.value.NAME).stat().st_size for model in pending)
+    installed = 0
+    with tqdm(total=total, unit="iB", unit_scale=True, desc="models") as bar:
+        with ThreadPoolExecutor(max(1, workers)) as executor:
+            futures = {
+                model: executor.submit(
+                    install_model,
+                    path / model.value.NAME,
+                    model.value.PATH,
+                    mode,
+                    verify,
+                    bar,
+                )
+                for model in pending
+            }
+            for model, future in futures.items():
+                try:
+                    used = future.result()
+                except (OSError, ValueError) as e:
+                    logger.error(
+                        f"Failed to install {model.value.NAME}: {e}"
+                    )
+                    continue
+                installed += 1
+                logger.info(
+                    f"Installed {model.value.NAME} to {model.value.PATH} "
+                    f"({used.value})"
+                )
+    logger.info(f"Installed {installed} models successfully.")
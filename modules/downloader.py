@@ -1,46 +1,331 @@
 import asyncio
+import json
+import os
+import time
+from dataclasses import dataclass
 from pathlib import Path
 
 import aiohttp
 from tqdm import tqdm
 
 from modules.logger import logger
-from config import get_huggingface_token, Models
+from config import (
+    DOWNLOAD_CONNECTIONS,
+    DOWNLOAD_SEGMENT_SIZE,
+    DOWNLOAD_BUFFER_SIZE,
+    DOWNLOAD_RETRIES,
+    get_huggingface_token,
+    Models,
+)
 
 
 TO_DOWNLOAD = [Models.VAE.value, Models.CLIPL.value]
 
 
-async def download_model(url: str, destination_path: Path):
+# Reads off the socket, the buffer collects them for one large write.
+READ_SIZE = 1024 * 1024
+# Progress is persisted at most this often, and whenever a segment ends.
+STATE_INTERVAL = 1.0
+
+
+class DownloadError(Exception):
+    pass
+
+
+# Statuses a CDN answers under load or while failing over, worth retrying.
+class TransientStatus(DownloadError):
+    def __init__(self, status: int):
+        super().__init__(f"status {status}")
+        self.status = status
+
+
+RETRYABLE = (aiohttp.ClientError, asyncio.TimeoutError, TransientStatus)
+
+
+def check_status(status: int, expected: tuple[int, ...]):
+    if status in expected:
+        return
+    if status == 429 or status >= 500:
+        raise TransientStatus(status)
+    raise DownloadError(f"status {status}")
+
+
+@dataclass
+class Segment:
+    start: int
+    end: int
+    done: int = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.start + self.done >= self.end
+
+
+def plan_segments(size: int, segment_size: int) -> list[Segment]:
+    return [
+        Segment(start, min(start + segment_size, size))
+        for start in range(0, size, segment_size)
+    ]
+
+
+def write_at(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def preallocate(fd: int, size: int):
+    os.ftruncate(fd, size)
     try:
-        timeout = aiohttp.ClientTimeout(total=None)
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # Not offered by every platform and file system, the file is sized.
+        pass
+
+
+# Fetches one file over parallel HTTP Range requests into a preallocated
+# `<name>.part` file, which is renamed into place once complete. Progress is
+# kept in `<name>.part.json`, so an interrupted download picks up where it
+# stopped. Servers without range support get a single streamed request.
+class SegmentedDownload:
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        url: str,
+        destination: Path,
+        connections: int = DOWNLOAD_CONNECTIONS,
+        segment_size: int = DOWNLOAD_SEGMENT_SIZE,
+        buffer_size: int = DOWNLOAD_BUFFER_SIZE,
+        retries: int = DOWNLOAD_RETRIES,
+    ):
+        self.session = session
+        self.url = url
+        self.destination = destination
+        self.connections = connections
+        self.segment_size = segment_size
+        self.buffer_size = buffer_size
+        self.retries = retries
+        self.part = destination.with_name(destination.name + ".part")
+        self.state_file = destination.with_name(
+            destination.name + ".part.json"
+        )
+        self.size: int | None = None
+        self.etag: str | None = None
+        self.segments: list[Segment] = []
+        self._saved_at = 0.0
+
+    async def _retrying(self, describe, call):
+        for attempt in range(self.retries + 1):
+            try:
+                return await call()
+            except RETRYABLE as e:
+                if attempt == self.retries:
+                    raise DownloadError(
+                        f"{describe()} failed after {self.retries} "
+                        f"retries: {e!r}"
+                    )
+                logger.warning(
+                    f"Retrying {self.destination.name} {describe()}: {e!r}"
+                )
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+    async def probe(self) -> bool:
+        return await self._retrying(lambda: "probe", self._probe)
+
+    async def _probe(self) -> bool:
+        async with self.session.get(
+            self.url, headers={"Range": "bytes=0-0"}
+        ) as response:
+            check_status(response.status, (200, 206))
+            self.etag = response.headers.get("ETag")
+            if response.status == 206:
+                content_range = response.headers.get("Content-Range", "")
+                total = content_range.rpartition("/")[2]
+                if total.isdigit():
+                    self.size = int(total)
+                    return True
+            length = response.headers.get("Content-Length")
+            self.size = int(length) if length else None
+            return False
+
+    def clear(self):
+        self.part.unlink(missing_ok=True)
+        self.state_file.unlink(missing_ok=True)
+
+    def load_state(self) -> bool:
+        try:
+            state = json.loads(self.state_file.read_text())
+            if (
+                state["url"] != self.url or
+                state["size"] != self.size or
+                state["etag"] != self.etag or
+                self.part.stat().st_size != self.size
+            ):
+                return False
+            self.segments = [
+                Segment(*segment) for segment in state["segments"]
+            ]
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return True
+
+    def save_state(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._saved_at < STATE_INTERVAL:
+            return
+        self._saved_at = now
+        state = {
+            "url": self.url,
+            "size": self.size,
+            "etag": self.etag,
+            "segments": [
+                [segment.start, segment.end, segment.done]
+                for segment in self.segments
+            ],
+        }
+        tmp_path = self.state_file.with_name(self.state_file.name + ".tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_file)
+
+    async def run(self):
+        ranges = await self.probe()
+        self.destination.parent.mkdir(parents=True, exist_ok=True)
+        if not ranges or not self.size:
+            self.clear()
+            await self._single()
+        else:
+            await self._segmented()
+        os.replace(self.part, self.destination)
+        self.state_file.unlink(missing_ok=True)
+
+    async def _segmented(self):
+        resumed = self.load_state()
+        if not resumed:
+            self.clear()
+            self.segments = plan_segments(self.size, self.segment_size)
+        fd = os.open(self.part, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if not resumed:
+                await asyncio.to_thread(preallocate, fd, self.size)
+                self.save_state(force=True)
+            done = sum(segment.done for segment in self.segments)
+            if resumed:
+                logger.info(
+                    f"Resuming {self.destination.name} at "
+                    f"{done / self.size:.0%}"
+                )
+            queue = asyncio.Queue()
+            for segment in self.segments:
+                if not segment.finished:
+                    queue.put_nowait(segment)
+            with tqdm(
+                total=self.size,
+                initial=done,
+                unit="iB",
+                unit_scale=True,
+                desc=self.destination.name,
+            ) as bar:
+                workers = [
+                    asyncio.create_task(self._worker(queue, fd, bar))
+                    for _ in range(min(self.connections, queue.qsize()))
+                ]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for worker in workers:
+                        worker.cancel()
+                    self.save_state(force=True)
+            await asyncio.to_thread(os.fsync, fd)
+        finally:
+            os.close(fd)
+
+    async def _worker(self, queue: asyncio.Queue, fd: int, bar: tqdm):
+        while not queue.empty():
+            segment = queue.get_nowait()
+            await self._retrying(
+                lambda: (
+                    f"bytes {segment.start + segment.done}-{segment.end}"
+                ),
+                lambda: self._fetch(segment, fd, bar),
+            )
+            self.save_state(force=True)
+
+    async def _fetch(self, segment: Segment, fd: int, bar: tqdm):
+        start = segment.start + segment.done
+        async with self.session.get(
+            self.url, headers={"Range": f"bytes={start}-{segment.end - 1}"}
+        ) as response:
+            # A 200 means the range was ignored, retrying would not help.
+            if response.status == 200:
+                raise DownloadError("Expected a partial response, got 200")
+            check_status(response.status, (206,))
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(READ_SIZE):
+                buffer += chunk
+                if len(buffer) >= self.buffer_size:
+                    await self._write(segment, fd, buffer, bar)
+                    buffer = bytearray()
+            if buffer:
+                await self._write(segment, fd, buffer, bar)
+        if not segment.finished:
+            raise aiohttp.ClientPayloadError(
+                f"Connection closed at byte {segment.start + segment.done}"
+            )
+
+    async def _write(
+        self, segment: Segment, fd: int, data: bytearray, bar: tqdm
+    ):
+        # The server may send more than asked for, never write past the end.
+        data = data[:segment.end - segment.start - segment.done]
+        offset = segment.start + segment.done
+        await asyncio.to_thread(write_at, fd, data, offset)
+        segment.done += len(data)
+        bar.update(len(data))
+        self.save_state()
+
+    async def _single(self):
+        async with self.session.get(self.url) as response:
+            check_status(response.status, (200,))
+            with tqdm(
+                total=self.size,
+                unit="iB",
+                unit_scale=True,
+                desc=self.destination.name,
+            ) as bar:
+                with self.part.open("wb", buffering=0) as file:
+                    buffer = bytearray()
+                    async for chunk in response.content.iter_chunked(
+                        READ_SIZE
+                    ):
+                        buffer += chunk
+                        if len(buffer) >= self.buffer_size:
+                            await asyncio.to_thread(file.write, buffer)
+                            bar.update(len(buffer))
+                            buffer = bytearray()
+                    if buffer:
+                        await asyncio.to_thread(file.write, buffer)
+                        bar.update(len(buffer))
+                    await asyncio.to_thread(os.fsync, file.fileno())
+        if self.size and self.part.stat().st_size != self.size:
+            raise DownloadError(
+                f"got {self.part.stat().st_size} of {self.size} bytes"
+            )
+
+
+async def download_model(url: str, destination_path: Path) -> bool:
+    try:
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
         async with aiohttp.ClientSession(
             trust_env=True,
             connector=aiohttp.TCPConnector(ssl=False),
             timeout=timeout,
             headers={"Authorization": f"Bearer {get_huggingface_token()}"},
         ) as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    total_size = int(response.headers.get("Content-Length", 0))
-                    chunk_size = 1024
-                    with tqdm(
-                        total=total_size,
-                        unit="iB",
-                        unit_scale=True,
-                        desc=destination_path.name,
-                    ) as bar:
-                        with destination_path.open("wb") as f:
-                            async for chunk in response.content.iter_chunked(
-                                chunk_size
-                            ):
-                                f.write(chunk)
-                                bar.update(len(chunk))
-                else:
-                    logger.error(
-                        f"Failed to download {url}. "
-                        f"Status code: {response.status}"
-                    )
+            await SegmentedDownload(session, url, destination_path).run()
+    except DownloadError as e:
+        logger.error(f"Failed to download {url}. Error: {e}")
     except aiohttp.ClientError as e:
         logger.error(f"Failed to download {url}. Error: {e}")
     except asyncio.TimeoutError:
@@ -48,6 +333,9 @@ async def download_model(url: str, destination_path: Path):
             "Download timed out. Please check your internet "
             "connection and try again."
         )
+    else:
+        return True
+    return False
 
 
 def clips_menu():
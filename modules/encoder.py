@@ -0,0 +1,157 @@
+import asyncio
+import io
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from config import (
+    OUTPUT_COMPRESSION,
+    OUTPUT_ENCODE_WORKERS,
+    OUTPUT_FORMAT,
+    OUTPUT_QUALITY,
+)
+
+
+# EXIF tag holding the generation parameters of JPEG and WebP outputs, PNG
+# ones keep them in a text chunk of the same name as in ComfyUI's images.
+IMAGE_DESCRIPTION = 0x010E
+PARAMETERS_KEY = "parameters"
+
+
+class ImageFormat(str, Enum):
+    PNG = "png"
+    JPEG = "jpeg"
+    WEBP = "webp"
+    WEBP_LOSSLESS = "webp-lossless"
+
+
+SUFFIXES = {
+    ImageFormat.PNG: ".png",
+    ImageFormat.JPEG: ".jpg",
+    ImageFormat.WEBP: ".webp",
+    ImageFormat.WEBP_LOSSLESS: ".webp",
+}
+MEDIA_TYPES = {
+    ImageFormat.PNG: "image/png",
+    ImageFormat.JPEG: "image/jpeg",
+    ImageFormat.WEBP: "image/webp",
+    ImageFormat.WEBP_LOSSLESS: "image/webp",
+}
+
+
+@dataclass(frozen=True)
+class Encoding:
+    format: ImageFormat
+    # JPEG and WebP quality, or the effort of lossless WebP, 1-100
+    quality: int = OUTPUT_QUALITY
+    # PNG zlib level, 0-9, scaled to WebP's method 0-6
+    compression: int = OUTPUT_COMPRESSION
+
+    @property
+    def suffix(self) -> str:
+        return SUFFIXES[self.format]
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.format]
+
+
+def get_encoding(
+    format: str | None = None,
+    quality: int | None = None,
+    compression: int | None = None,
+    default: str = OUTPUT_FORMAT,
+) -> Encoding | None:
+    # No format at all leaves saving to ComfyUI's SaveImage node.
+    format = format or default
+    if not format:
+        if quality is not None or compression is not None:
+            raise ValueError("Quality and compression need an output format")
+        return None
+    try:
+        image_format = ImageFormat(format)
+    except ValueError:
+        raise ValueError(
+            f"Invalid output format: {format}, expected one of "
+            + ", ".join(image_format.value for image_format in ImageFormat)
+        )
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError(f"Invalid quality {quality}, expected 1-100")
+    if compression is not None and not 0 <= compression <= 9:
+        raise ValueError(f"Invalid compression {compression}, expected 0-9")
+    return Encoding(
+        image_format,
+        OUTPUT_QUALITY if quality is None else quality,
+        OUTPUT_COMPRESSION if compression is None else compression,
+    )
+
+
+def encode_image(data: bytes, encoding: Encoding, parameters: dict) -> bytes:
+    text = json.dumps(parameters, default=str)
+    output = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        if encoding.format == ImageFormat.PNG:
+            info = PngInfo()
+            info.add_text(PARAMETERS_KEY, text)
+            image.save(
+                output,
+                format="PNG",
+                compress_level=encoding.compression,
+                pnginfo=info,
+            )
+            return output.getvalue()
+        exif = Image.Exif()
+        exif[IMAGE_DESCRIPTION] = text
+        if encoding.format == ImageFormat.JPEG:
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image.save(
+                output,
+                format="JPEG",
+                quality=encoding.quality,
+                optimize=encoding.compression > 0,
+                exif=exif,
+            )
+        else:
+            image.save(
+                output,
+                format="WEBP",
+                lossless=encoding.format == ImageFormat.WEBP_LOSSLESS,
+                quality=encoding.quality,
+                method=round(encoding.compression * 6 / 9),
+                exif=exif,
+            )
+    return output.getvalue()
+
+
+# Encodes the images ComfyUI sends over its websocket, cheaply compressed,
+# into their output format in a process pool, off the event loop and off
+# ComfyUI's execution thread. Before start, encoding runs in threads.
+class ImageEncoder:
+    def __init__(self, workers: int = OUTPUT_ENCODE_WORKERS):
+        self.workers = workers
+        self._pool: ProcessPoolExecutor | None = None
+
+    def start(self):
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def encode(
+        self, data: bytes, encoding: Encoding, parameters: dict
+    ) -> bytes:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._pool, encode_image, bytes(data), encoding, parameters
+        )
@@ -0,0 +1,50 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from config import ERROR_LOG_SIZE
+
+
+@dataclass
+class ErrorEntry:
+    backend: str
+    message: str
+    # Prompt the backend was running when the line was printed, if any.
+    prompt_id: str | None = None
+    time: float = field(default_factory=time.time)
+
+
+# Keeps the last `size` error lines printed by ComfyUI for diagnostics. They
+# are not tied to requests: a job's own failure comes from ComfyUI's
+# execution events.
+class ErrorLog:
+    def __init__(self, size: int = ERROR_LOG_SIZE):
+        self.total = 0
+        self._entries: deque[ErrorEntry] = deque(maxlen=size)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, backend: str, message: str, prompt_id: str | None = None):
+        self.total += 1
+        self._entries.append(ErrorEntry(backend, message, prompt_id))
+
+    def recent(
+        self,
+        limit: int,
+        backend: str | None = None,
+        prompt_id: str | None = None,
+    ) -> list[ErrorEntry]:
+        entries = []
+        for entry in reversed(self._entries):
+            if len(entries) >= limit:
+                break
+            if backend is not None and entry.backend != backend:
+                continue
+            if prompt_id is not None and entry.prompt_id != prompt_id:
+                continue
+            entries.append(entry)
+        return entries
+
+    def clear(self):
+        self._entries.clear()
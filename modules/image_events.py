@@ -0,0 +1,54 @@
+import asyncio
+import json
+
+from config import IMAGE_EVENTS_QUEUE_SIZE
+
+
+IMAGE_ADDED = "image-added"
+IMAGE_DELETED = "image-deleted"
+IMAGES_CLEARED = "images-cleared"
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Fans image changes out to every connected gallery. A subscriber that
+# falls too far behind is dropped and resyncs when its browser reconnects.
+class ImageEvents:
+    def __init__(self, queue_size: int = IMAGE_EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers: set[asyncio.Queue] = set()
+
+    def publish(self, event: str, **data):
+        for queue in list(self._subscribers):
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                self._subscribers.discard(queue)
+
+    def added(self, image: str):
+        self.publish(IMAGE_ADDED, image=image)
+
+    def deleted(self, image: str):
+        self.publish(IMAGE_DELETED, image=image)
+
+    def cleared(self):
+        self.publish(IMAGES_CLEARED)
+
+    async def stream(self, keepalive: float = 15):
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.add(queue)
+        try:
+            yield "retry: 3000\n\n"
+            while queue in self._subscribers:
+                try:
+                    event, data = await asyncio.wait_for(
+                        queue.get(), keepalive
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event, data)
+        finally:
+            self._subscribers.discard(queue)
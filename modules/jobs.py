@@ -0,0 +1,590 @@
+import asyncio
+import os
+import struct
+import time
+from bisect import insort
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Callable
+from uuid import uuid4
+
+import aiohttp
+
+from config import (
+    JOBS_RETENTION,
+    COMFYUI_WS_MAX_MSG_SIZE,
+    COMFYUI_WS_RECONNECT_DELAY,
+    OUTPUT_DIR,
+)
+from modules.backends import Backend
+from modules.encoder import Encoding, ImageEncoder
+from modules.logger import logger
+
+
+class JobState(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+FINISHED_STATES = {JobState.COMPLETED, JobState.FAILED, JobState.CANCELLED}
+
+
+# ComfyUI's log of a failure can trail its websocket events this long.
+LOG_GRACE = 1.0
+
+# Fields of ComfyUI's execution_error event kept on the failed job.
+ERROR_DETAILS = (
+    "node_id", "node_type", "exception_type", "exception_message", "traceback"
+)
+
+
+# Node added to prompts whose images are delivered inline: ComfyUI's
+# SaveImageWebsocket sends each image as a binary websocket message, headed
+# by the event (a preview image) and the image format.
+INLINE_NODE = "inline_images"
+INLINE_CLASS_TYPE = "SaveImageWebsocket"
+PREVIEW_IMAGE = 1
+IMAGE_FORMATS = {1: "image/jpeg", 2: "image/png"}
+
+
+# Scheduling classes, in the order they are served.
+class Priority(str, Enum):
+    INTERACTIVE = "interactive"
+    NORMAL = "normal"
+    BATCH = "batch"
+
+
+@dataclass
+class JobOptions:
+    client: str = ""
+    priority: Priority = Priority.NORMAL
+    # Latest time the job may start at, it fails when still queued then.
+    deadline: float | None = None
+    # Memory profile of the workflow run, None for the workflow's own.
+    profile: str | None = None
+    # Images sent back over the websocket, and also saved to disk if asked.
+    inline: bool = False
+    save: bool = True
+    # Format the API encodes images to, None for ComfyUI's own PNGs.
+    encoding: Encoding | None = None
+
+
+@dataclass
+class Job:
+    model: str
+    params: dict = field(default_factory=dict)
+    id: str = field(default_factory=lambda: uuid4().hex)
+    prompt_id: str | None = None
+    backend: str | None = None
+    client: str = ""
+    priority: Priority = Priority.NORMAL
+    deadline: float | None = None
+    profile: str | None = None
+    state: JobState = JobState.PENDING
+    created_at: float = field(default_factory=time.time)
+    started_at: float | None = None
+    finished_at: float | None = None
+    node: str | None = None
+    node_started_at: float | None = None
+    progress: float = 0.0
+    inline: bool = False
+    save: bool = True
+    encoding: Encoding | None = None
+    # Media type and data of the images received inline, until delivered.
+    images: list[tuple[str, bytes | memoryview] | None] = field(
+        default_factory=list, repr=False
+    )
+    images_received: int = 0
+    # Nodes ComfyUI answered from its cache of the previous prompt.
+    cached_nodes: list[str] = field(default_factory=list)
+    outputs: list[str] = field(default_factory=list)
+    # Slice of the prompt's images owned by this job when it was batched.
+    output_offset: int = 0
+    output_count: int | None = None
+    error: str | None = None
+    error_details: dict | None = None
+    # Answered from the result cache without running a prompt.
+    cached: bool = False
+    done: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.state in FINISHED_STATES
+
+    @property
+    def queue_seconds(self) -> float | None:
+        end = self.started_at or self.finished_at
+        return None if end is None else end - self.created_at
+
+    @property
+    def run_seconds(self) -> float | None:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+def save_output(path: Path, data: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{uuid4().hex}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+# Keeps job state current from the events every ComfyUI backend pushes over
+# its websocket. Images of backends attached by URL are fetched into the
+# output directory, and those to encode are encoded, before their job
+# completes.
+class JobTracker:
+    def __init__(
+        self,
+        retention: int = JOBS_RETENTION,
+        on_output: Callable[[str], None] | None = None,
+        on_finish: Callable[[Job], None] | None = None,
+        on_node: Callable[[Job, str, float], None] | None = None,
+        on_cached: Callable[[Job, list[str]], None] | None = None,
+        directory: Path = OUTPUT_DIR,
+        encoder: ImageEncoder | None = None,
+    ):
+        self.retention = retention
+        self.on_output = on_output
+        self.on_finish = on_finish
+        self.on_node = on_node
+        self.on_cached = on_cached
+        self.directory = directory
+        self.encoder = ImageEncoder() if encoder is None else encoder
+        self.client_id = uuid4().hex
+        self._backends: dict[str, Backend] = {}
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._by_prompt: dict[str, list[Job]] = {}
+        self._fetching: dict[str, set[asyncio.Task]] = {}
+        self._completing: set[str] = set()
+        # Backend name to the prompt it failed last and when.
+        self._last_failed: dict[str, tuple[str, float]] = {}
+        # Backend name to the prompt and node it runs, and the images the
+        # node has sent so far.
+        self._executing: dict[str, tuple[str | None, str | None]] = {}
+        self._images_sent: dict[str, int] = {}
+        # Events can arrive before /prompt has returned the prompt id.
+        self._unclaimed: OrderedDict[str, list[dict]] = OrderedDict()
+
+    def create(
+        self, model: str, options: JobOptions | None = None, **params
+    ) -> Job:
+        options = options or JobOptions()
+        job = Job(
+            model=model,
+            params=params,
+            client=options.client,
+            priority=options.priority,
+            deadline=options.deadline,
+            profile=options.profile,
+            inline=options.inline,
+            save=options.save,
+            encoding=options.encoding,
+        )
+        self._jobs[job.id] = job
+        self._evict()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def for_prompt(self, prompt_id: str) -> list[Job]:
+        return list(self._by_prompt.get(prompt_id, []))
+
+    def log_prompt(self, backend: str) -> str | None:
+        # Best guess at the prompt a line of the backend's log belongs to:
+        # one that just failed, else the one running.
+        prompt_id, failed_at = self._last_failed.get(backend, (None, 0.0))
+        if time.time() - failed_at <= LOG_GRACE:
+            return prompt_id
+        for prompt_id, jobs in self._by_prompt.items():
+            job = jobs[0]
+            if job.backend == backend and job.state == JobState.RUNNING:
+                return prompt_id
+        return None
+
+    def attach(self, job: Job, prompt_id: str):
+        self._detach(job)
+        job.prompt_id = prompt_id
+        self._by_prompt.setdefault(prompt_id, []).append(job)
+        for message in self._unclaimed.pop(prompt_id, []):
+            self._handle(message)
+
+    def _detach(self, job: Job):
+        jobs = self._by_prompt.get(job.prompt_id, [])
+        if job in jobs:
+            jobs.remove(job)
+            if not jobs:
+                del self._by_prompt[job.prompt_id]
+
+    def unassign(self, job: Job):
+        # Takes back a job whose prompt never reached its backend.
+        self._detach(job)
+        job.prompt_id = None
+        job.backend = None
+
+    def complete(self, job: Job, outputs: list[str]):
+        job.outputs = list(outputs)
+        self._finish(job, JobState.COMPLETED)
+
+    def fail(self, job: Job, error: str):
+        job.error = error
+        self._finish(job, JobState.FAILED)
+
+    def _fail_execution(self, job: Job, data: dict):
+        job.error = (
+            f"{data.get('node_type')}: {data.get('exception_message')}"
+        )
+        job.error_details = {
+            key: data[key] for key in ERROR_DETAILS if key in data
+        }
+        self._finish(job, JobState.FAILED)
+
+    def cancel(self, job: Job):
+        job.error = "Cancelled"
+        self._finish(job, JobState.CANCELLED)
+
+    def _missing_images(self, job: Job) -> str | None:
+        # Images sent over the websocket are gone if the connection dropped
+        # while they were, ComfyUI's history does not have them.
+        if not job.inline and job.encoding is None:
+            return None
+        expected = job.output_count
+        if expected is None:
+            expected = int(job.params.get("batch_size", 1))
+        if job.images_received >= expected:
+            return None
+        return (
+            f"Received {job.images_received} of {expected} images "
+            "over the websocket"
+        )
+
+    def _complete(self, job: Job):
+        missing = None if job.finished else self._missing_images(job)
+        if missing is not None:
+            self.fail(job, missing)
+        elif not self._fetching.get(job.id):
+            self._finish(job, JobState.COMPLETED)
+        elif job.id not in self._completing:
+            self._completing.add(job.id)
+            asyncio.create_task(self._complete_after_fetch(job))
+
+    async def _complete_after_fetch(self, job: Job):
+        while tasks := self._fetching.get(job.id):
+            await asyncio.gather(*tasks)
+        self._completing.discard(job.id)
+        if job.error is not None:
+            self._finish(job, JobState.FAILED)
+        else:
+            self._finish(job, JobState.COMPLETED)
+
+    def _finish(self, job: Job, state: JobState):
+        if job.finished:
+            return
+        job.state = state
+        job.finished_at = time.time()
+        if state == JobState.COMPLETED:
+            job.progress = 1.0
+        job.node = None
+        job.done.set()
+        if state == JobState.FAILED and job.backend is not None:
+            self._last_failed[job.backend] = (job.prompt_id, job.finished_at)
+        self._detach(job)
+        logger.info(f"Job {job.id} {state.value}")
+        if self.on_finish is not None:
+            self.on_finish(job)
+
+    def _evict(self):
+        while len(self._jobs) > self.retention:
+            for job_id, job in self._jobs.items():
+                if job.finished:
+                    del self._jobs[job_id]
+                    break
+            else:
+                break
+
+    def _handle(self, message: dict):
+        event = message.get("type")
+        data = message.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+        jobs = self._by_prompt.get(prompt_id)
+        if not jobs:
+            self._unclaimed.setdefault(prompt_id, []).append(message)
+            while len(self._unclaimed) > self.retention:
+                self._unclaimed.popitem(last=False)
+            return
+        for job in list(jobs):
+            self._apply(job, event, data)
+
+    def _track(self, backend: Backend, message: dict):
+        # Binary messages carry no prompt id, they belong to the node
+        # running when they arrive.
+        if message.get("type") != "executing":
+            return
+        data = message.get("data") or {}
+        self._executing[backend.name] = (
+            data.get("prompt_id"), data.get("node")
+        )
+        self._images_sent[backend.name] = 0
+
+    def _handle_image(self, backend: Backend, data: bytes):
+        prompt_id, node = self._executing.get(backend.name, (None, None))
+        # Samplers' latent previews arrive as the same kind of message.
+        if node != INLINE_NODE or len(data) < 8:
+            return
+        event, image_format = struct.unpack(">II", data[:8])
+        if event != PREVIEW_IMAGE:
+            return
+        index = self._images_sent[backend.name]
+        self._images_sent[backend.name] += 1
+        image = (
+            IMAGE_FORMATS.get(image_format, "application/octet-stream"),
+            memoryview(data)[8:],
+        )
+        for job in self._by_prompt.get(prompt_id, []):
+            if not job.inline and job.encoding is None:
+                continue
+            if job.output_count is not None and not (
+                job.output_offset <= index <
+                job.output_offset + job.output_count
+            ):
+                continue
+            job.images_received += 1
+            if job.encoding is None:
+                job.images.append(image)
+            else:
+                self._encode(job, backend, index - job.output_offset, image)
+
+    def _apply(self, job: Job, event: str, data: dict):
+        if event == "execution_start":
+            job.state = JobState.RUNNING
+            job.started_at = time.time()
+        elif event == "execution_cached":
+            nodes = [str(node) for node in data.get("nodes") or []]
+            job.cached_nodes.extend(nodes)
+            if self.on_cached is not None and self._first(job):
+                self.on_cached(job, nodes)
+        elif event == "executing":
+            self._node_done(job)
+            if data.get("node") is None:
+                self._complete(job)
+            else:
+                job.node = data["node"]
+                job.node_started_at = time.time()
+        elif event == "progress":
+            if data.get("max"):
+                job.node = data.get("node", job.node)
+                job.progress = data["value"] / data["max"]
+        elif event == "executed":
+            self._add_outputs(job, data.get("output") or {})
+        elif event == "execution_success":
+            self._node_done(job)
+            self._complete(job)
+        elif event == "execution_error":
+            self._fail_execution(job, data)
+        elif event == "execution_interrupted":
+            job.error = "Execution interrupted"
+            self._finish(job, JobState.FAILED)
+
+    def _node_done(self, job: Job):
+        if job.node is None or job.node_started_at is None:
+            return
+        seconds = time.time() - job.node_started_at
+        job.node_started_at = None
+        if self.on_node is not None and self._first(job):
+            self.on_node(job, job.node, seconds)
+
+    def _first(self, job: Job) -> bool:
+        # Jobs sharing a prompt share its nodes, report them once.
+        jobs = self._by_prompt.get(job.prompt_id)
+        return bool(jobs) and jobs[0] is job
+
+    def _add_outputs(self, job: Job, output: dict):
+        names = []
+        for image in output.get("images", []):
+            if image.get("type") != "output":
+                continue
+            name = image["filename"]
+            if image.get("subfolder"):
+                name = f"{image['subfolder']}/{name}"
+            names.append(name)
+        if job.output_count is not None:
+            start = job.output_offset
+            names = names[start:start + job.output_count]
+        backend = self._backends.get(job.backend)
+        for name in names:
+            if name in job.outputs:
+                continue
+            job.outputs.append(name)
+            if backend is not None and not backend.local:
+                self._fetch(job, backend, name)
+            elif self.on_output is not None:
+                self.on_output(name)
+
+    def _fetch(self, job: Job, backend: Backend, name: str):
+        self._track_fetch(job, self._fetch_output(job, backend, name))
+
+    def _encode(
+        self,
+        job: Job,
+        backend: Backend,
+        index: int,
+        image: tuple[str, memoryview],
+    ):
+        # Encodes run concurrently, each fills the place of its image.
+        slot = None
+        if job.inline:
+            slot = len(job.images)
+            job.images.append(None)
+        self._track_fetch(
+            job, self._encode_output(job, backend, index, image[1], slot)
+        )
+
+    def _track_fetch(self, job: Job, coroutine):
+        tasks = self._fetching.setdefault(job.id, set())
+        task = asyncio.create_task(coroutine)
+        tasks.add(task)
+
+        def done(_):
+            tasks.discard(task)
+            if not tasks and self._fetching.get(job.id) is tasks:
+                del self._fetching[job.id]
+
+        task.add_done_callback(done)
+
+    async def _fetch_output(self, job: Job, backend: Backend, name: str):
+        subfolder, _, filename = name.rpartition("/")
+        try:
+            status, data = await backend.client.get(
+                "/view",
+                params={
+                    "filename": filename,
+                    "subfolder": subfolder,
+                    "type": "output",
+                },
+            )
+            if status != 200:
+                raise ValueError(f"status {status}")
+            await asyncio.to_thread(save_output, self.directory / name, data)
+        except (
+            aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError
+        ) as e:
+            logger.error(f"Failed to fetch {name} from {backend.name}: {e!r}")
+            job.error = f"Failed to fetch {name} from {backend.name}"
+            return
+        if self.on_output is not None:
+            self.on_output(name)
+
+    async def _encode_output(
+        self,
+        job: Job,
+        backend: Backend,
+        index: int,
+        data: memoryview,
+        slot: int | None,
+    ):
+        encoding = job.encoding
+        name = f"{backend.filename_prefix}_{job.id}_{index:02d}"
+        name += encoding.suffix
+        parameters = {
+            "model": job.model, "profile": job.profile, **job.params
+        }
+        try:
+            encoded = await self.encoder.encode(data, encoding, parameters)
+            if job.save:
+                await asyncio.to_thread(
+                    save_output, self.directory / name, encoded
+                )
+        except (OSError, ValueError, BrokenProcessPool) as e:
+            logger.error(f"Failed to encode {name}: {e!r}")
+            job.error = f"Failed to encode {name}"
+            return
+        if slot is not None and job.inline:
+            job.images[slot] = (encoding.media_type, encoded)
+        if not job.save:
+            return
+        insort(job.outputs, name)
+        if self.on_output is not None:
+            self.on_output(name)
+
+    async def _reconcile(self, backend: Backend):
+        # Completion events sent while disconnected are lost, so look up
+        # the outcome of in-flight prompts once after every reconnect.
+        for prompt_id, jobs in list(self._by_prompt.items()):
+            if jobs[0].backend != backend.name:
+                continue
+            try:
+                _, history = await backend.client.get(
+                    f"/history/{prompt_id}"
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"Failed to get history of {prompt_id}: {e}")
+                continue
+            entry = (history or {}).get(prompt_id)
+            if not entry:
+                continue
+            status = entry.get("status") or {}
+            # The history keeps the events, the error one among them.
+            messages = {
+                message[0]: message[1]
+                for message in status.get("messages", [])
+                if len(message) == 2
+            }
+            for job in list(jobs):
+                for output in entry.get("outputs", {}).values():
+                    self._add_outputs(job, output)
+                if "execution_error" in messages:
+                    self._fail_execution(job, messages["execution_error"])
+                elif "execution_interrupted" in messages:
+                    self.fail(job, "Execution interrupted")
+                elif status.get("status_str") == "error":
+                    self.fail(job, "Execution failed")
+                elif status.get("completed"):
+                    self._complete(job)
+
+    async def run(self, backend: Backend):
+        self._backends[backend.name] = backend
+        client = backend.client
+        url = client.url(f"/ws?clientId={self.client_id}")
+        while True:
+            try:
+                async with client.session.ws_connect(
+                    url, heartbeat=30, max_msg_size=COMFYUI_WS_MAX_MSG_SIZE
+                ) as ws:
+                    backend.connected = True
+                    logger.info(
+                        f"Connected to ComfyUI {backend.name} websocket"
+                    )
+                    await self._reconcile(backend)
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            message = msg.json()
+                            self._track(backend, message)
+                            self._handle(message)
+                        elif msg.type == aiohttp.WSMsgType.BINARY:
+                            self._handle_image(backend, msg.data)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            logger.warning(
+                                f"ComfyUI {backend.name} websocket error: "
+                                f"{msg.data!r}"
+                            )
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket error: {e!r}")
+            if backend.connected:
+                logger.warning(
+                    f"Disconnected from ComfyUI {backend.name} websocket"
+                )
+            backend.connected = False
+            await asyncio.sleep(COMFYUI_WS_RECONNECT_DELAY)
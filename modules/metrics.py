@@ -0,0 +1,210 @@
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+from modules.admission import AdmissionController
+from modules.backends import BackendPool
+from modules.error_log import ErrorLog
+from modules.jobs import Job, JobState
+from modules.output_index import OutputIndex
+from modules.result_cache import ResultCache
+from modules.scheduler import Scheduler
+from modules.workflows import WorkflowRegistry
+
+
+REQUEST_SECONDS = Histogram(
+    "flux_http_request_duration_seconds",
+    "Time to answer an API request, up to the start of streamed bodies",
+    ["method", "route", "status"],
+)
+JOB_QUEUE_SECONDS = Histogram(
+    "flux_job_queue_seconds",
+    "Time from a job's creation until ComfyUI started running it",
+    ["model"],
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+)
+JOB_RUN_SECONDS = Histogram(
+    "flux_job_run_seconds",
+    "Time ComfyUI spent running a job's prompt",
+    ["model", "resolution", "steps"],
+    buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600),
+)
+NODE_SECONDS = Histogram(
+    "flux_node_seconds",
+    "Time ComfyUI spent executing one node of a prompt",
+    ["model", "node", "class_type"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+NODE_RUNS = Counter(
+    "flux_node_runs",
+    "Nodes of prompts, executed or answered from ComfyUI's cache",
+    ["model", "node", "class_type", "result"],
+)
+JOBS = Counter("flux_jobs", "Finished jobs", ["model", "state"])
+IMAGES = Counter("flux_images", "Images produced by ComfyUI", ["model"])
+BULK_ITEMS = Counter(
+    "flux_bulk_items", "Items of bulk requests", ["model", "result"]
+)
+
+
+def observe_request(method: str, route: str, status: int, seconds: float):
+    REQUEST_SECONDS.labels(method, route, str(status)).observe(seconds)
+
+
+def observe_bulk(model: str, accepted: int, failed: int):
+    BULK_ITEMS.labels(model, "accepted").inc(accepted)
+    BULK_ITEMS.labels(model, "failed").inc(failed)
+
+
+# Records finished jobs and the node timings taken from ComfyUI's events.
+class JobMetrics:
+    def __init__(self, workflows: WorkflowRegistry):
+        self.workflows = workflows
+
+    def job_finished(self, job: Job):
+        JOBS.labels(job.model, job.state.value).inc()
+        # Answered from the cache or cancelled before ComfyUI ran it.
+        if job.started_at is None:
+            return
+        JOB_QUEUE_SECONDS.labels(job.model).observe(job.queue_seconds)
+        if job.state != JobState.COMPLETED:
+            return
+        JOB_RUN_SECONDS.labels(
+            job.model,
+            f"{job.params.get('width')}x{job.params.get('height')}",
+            str(job.params.get("steps")),
+        ).observe(job.run_seconds)
+        IMAGES.labels(job.model).inc(len(job.outputs))
+
+    def _class_type(self, job: Job, node: str) -> str:
+        try:
+            nodes = self.workflows.get(job.model).nodes
+        except ValueError:
+            nodes = {}
+        return nodes.get(node, {}).get("class_type", "unknown")
+
+    def node_finished(self, job: Job, node: str, seconds: float):
+        class_type = self._class_type(job, node)
+        NODE_SECONDS.labels(job.model, node, class_type).observe(seconds)
+        NODE_RUNS.labels(job.model, node, class_type, "executed").inc()
+
+    def nodes_cached(self, job: Job, nodes: list[str]):
+        for node in nodes:
+            NODE_RUNS.labels(
+                job.model, node, self._class_type(job, node), "cached"
+            ).inc()
+
+
+# Reports the state of the service at scrape time.
+class StateCollector:
+    def __init__(
+        self,
+        backends: BackendPool,
+        scheduler: Scheduler,
+        admission: AdmissionController,
+        index: OutputIndex,
+        cache: ResultCache,
+        errors: ErrorLog,
+    ):
+        self.backends = backends
+        self.scheduler = scheduler
+        self.admission = admission
+        self.index = index
+        self.cache = cache
+        self.errors = errors
+
+    def collect(self):
+        up = GaugeMetricFamily(
+            "flux_backend_up",
+            "Whether a ComfyUI backend is taking jobs",
+            labels=["backend"],
+        )
+        depth = GaugeMetricFamily(
+            "flux_backend_queue_depth",
+            "Prompts queued or running on a ComfyUI backend",
+            labels=["backend"],
+        )
+        for backend in self.backends:
+            up.add_metric([backend.name], int(backend.available))
+            depth.add_metric([backend.name], backend.queue_depth)
+        yield up
+        yield depth
+
+        scheduled = GaugeMetricFamily(
+            "flux_scheduler_jobs",
+            "Jobs waiting in the scheduler",
+            labels=["priority"],
+        )
+        for priority, count in self.scheduler.counts().items():
+            scheduled.add_metric([priority.value], count)
+        yield scheduled
+        yield CounterMetricFamily(
+            "flux_scheduler_expired",
+            "Jobs failed for not starting before their deadline",
+            value=self.scheduler.expired,
+        )
+        yield CounterMetricFamily(
+            "flux_scheduler_cancelled",
+            "Jobs cancelled before they started",
+            value=self.scheduler.cancelled,
+        )
+        reordered = CounterMetricFamily(
+            "flux_scheduler_reordered",
+            "Prompts sent ahead of their turn to follow one sharing the "
+            "text encoding (prompt) or the loaded models (model)",
+            labels=["reason"],
+        )
+        for reason in ("prompt", "model"):
+            reordered.add_metric([reason], self.scheduler.reordered[reason])
+        yield reordered
+        swaps = CounterMetricFamily(
+            "flux_backend_model_swaps",
+            "Prompts needing other models than the backend had loaded",
+            labels=["backend", "model"],
+        )
+        for (backend, model), count in self.scheduler.swaps.items():
+            swaps.add_metric([backend, model], count)
+        yield swaps
+
+        yield GaugeMetricFamily(
+            "flux_admission_pending_jobs",
+            "Unfinished jobs counted by admission control",
+            value=self.admission.pending,
+        )
+        yield GaugeMetricFamily(
+            "flux_admission_gpu_seconds",
+            "Estimated GPU seconds of unfinished jobs",
+            value=self.admission.gpu_seconds,
+        )
+        yield CounterMetricFamily(
+            "flux_admission_rejected",
+            "Requests rejected by admission control",
+            value=self.admission.rejected,
+        )
+
+        yield GaugeMetricFamily(
+            "flux_output_files",
+            "Images in the output directory",
+            value=len(self.index),
+        )
+        yield GaugeMetricFamily(
+            "flux_output_bytes",
+            "Size of the images in the output directory",
+            value=self.index.total_size,
+        )
+
+        cache = CounterMetricFamily(
+            "flux_result_cache_lookups",
+            "Result cache lookups by outcome",
+            labels=["result"],
+        )
+        stats = self.cache.stats()
+        cache.add_metric(["hit"], stats.hits)
+        cache.add_metric(["miss"], stats.misses)
+        cache.add_metric(["coalesced"], stats.coalesced)
+        yield cache
+
+        yield CounterMetricFamily(
+            "flux_comfyui_error_lines",
+            "Lines ComfyUI printed that look like errors",
+            value=self.errors.total,
+        )
@@ -0,0 +1,103 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+from config import MODEL_WATCH_INTERVAL, Models
+from modules.logger import logger
+from modules.workflows import WorkflowRegistry, WorkflowTemplate
+
+
+@dataclass
+class ModelStatus:
+    name: str
+    file: str
+    path: Path
+    available: bool
+    size: int | None = None
+
+
+def check_model(model: Models) -> ModelStatus:
+    try:
+        size = model.value.PATH.stat().st_size
+    except OSError:
+        size = None
+    return ModelStatus(
+        name=model.name,
+        file=model.value.NAME,
+        path=model.value.PATH,
+        available=size is not None,
+        size=size,
+    )
+
+
+def _mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except OSError:
+        return 0.0
+
+
+# Availability of the model files in config.Models. Model files are large
+# and may sit on network storage, so they are looked at once and again only
+# when a model directory changes or a refresh is asked for; requests check
+# the result held in memory.
+class ModelRegistry:
+    def __init__(self, interval: float = MODEL_WATCH_INTERVAL):
+        self.interval = interval
+        self.checked_at: float | None = None
+        self._status: dict[str, ModelStatus] = {}
+
+    def __iter__(self):
+        return iter(self._status.values())
+
+    def directories(self) -> set[Path]:
+        return {model.value.PATH.parent for model in Models}
+
+    def refresh(self):
+        status = {model.name: check_model(model) for model in Models}
+        for name, model in status.items():
+            previous = self._status.get(name)
+            if previous is not None and previous.available == model.available:
+                continue
+            if model.available:
+                logger.info(f"Model {model.file} is available")
+            else:
+                logger.warning(f"Model {model.file} not found")
+        self._status = status
+        self.checked_at = time.time()
+
+    def missing(self, template: WorkflowTemplate) -> list[str]:
+        return [
+            Models[requirement].value.NAME
+            for requirement in template.requires
+            if not (
+                requirement in self._status and
+                self._status[requirement].available
+            )
+        ]
+
+    def check(self, template: WorkflowTemplate):
+        missing = self.missing(template)
+        if missing:
+            raise FileNotFoundError(f"Model: {', '.join(missing)} not found")
+
+    def servable(self, workflows: WorkflowRegistry) -> dict[str, bool]:
+        return {
+            name: not self.missing(workflows.get(name))
+            for name in workflows.names()
+        }
+
+    async def watch(self):
+        directories = sorted(self.directories())
+        mtimes = await asyncio.to_thread(
+            lambda: [_mtime(directory) for directory in directories]
+        )
+        while True:
+            await asyncio.sleep(self.interval)
+            current = await asyncio.to_thread(
+                lambda: [_mtime(directory) for directory in directories]
+            )
+            if current != mtimes:
+                mtimes = current
+                await asyncio.to_thread(self.refresh)
@@ -0,0 +1,223 @@
+import asyncio
+import base64
+import json
+import os
+import struct
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+from uuid import uuid4
+
+from PIL import Image
+
+from config import OUTPUT_DIR, OUTPUT_WATCH_INTERVAL
+from modules.image_events import ImageEvents
+from modules.logger import logger
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp")
+MAX_KEY = "\U0010ffff"
+
+
+@dataclass
+class ImageEntry:
+    name: str
+    size: int
+    mtime: float
+    width: int | None = None
+    height: int | None = None
+
+    @property
+    def key(self) -> tuple[float, str]:
+        return self.mtime, self.name
+
+
+def read_png_size(path: Path) -> tuple[int | None, int | None]:
+    # Width and height are the first fields of the IHDR chunk.
+    with open(path, "rb") as file:
+        header = file.read(24)
+    if len(header) < 24 or not header.startswith(PNG_SIGNATURE):
+        return None, None
+    return struct.unpack(">II", header[16:24])
+
+
+def read_image_size(path: Path) -> tuple[int | None, int | None]:
+    # PNGs are most of the directory and cheapest to read by hand.
+    if path.suffix == ".png":
+        return read_png_size(path)
+    with Image.open(path) as image:
+        return image.size
+
+
+def read_entry(directory: Path, name: str) -> ImageEntry | None:
+    path = directory / name
+    try:
+        stat = path.stat()
+        width, height = read_image_size(path)
+    except OSError:
+        return None
+    return ImageEntry(name, stat.st_size, stat.st_mtime, width, height)
+
+
+def is_image(name: str) -> bool:
+    return name.endswith(IMAGE_SUFFIXES) and "/" not in name
+
+
+def list_images(directory: Path = OUTPUT_DIR) -> set[str]:
+    return {
+        entry.name for entry in os.scandir(directory)
+        if is_image(entry.name)
+    }
+
+
+def encode_cursor(key: tuple[float, str]) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    try:
+        mtime, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(mtime), str(name)
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+# In-memory view of OUTPUT_DIR, kept sorted by (mtime, name). It is updated
+# as jobs produce images and as the API deletes them, with a directory
+# watcher as fallback for changes made behind the API's back.
+class OutputIndex:
+    def __init__(
+        self,
+        directory: Path = OUTPUT_DIR,
+        events: ImageEvents | None = None,
+        on_remove: Callable[[str], None] | None = None,
+    ):
+        self.directory = directory
+        self.events = events
+        self.on_remove = on_remove
+        self.version = 0
+        self.total_size = 0
+        self._instance = uuid4().hex[:8]
+        self._entries: dict[str, ImageEntry] = {}
+        self._order: list[tuple[float, str]] = []
+        self._adding: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    @property
+    def etag(self) -> str:
+        return f'"{self._instance}-{self.version}"'
+
+    def get(self, name: str) -> ImageEntry | None:
+        return self._entries.get(name)
+
+    def scan(self):
+        entries = {}
+        for name in list_images(self.directory):
+            entry = read_entry(self.directory, name)
+            if entry is not None:
+                entries[name] = entry
+        self._entries = entries
+        self._order = sorted(entry.key for entry in entries.values())
+        self.total_size = sum(entry.size for entry in entries.values())
+        self.version += 1
+        logger.info(f"Indexed {len(entries)} images in {self.directory}")
+
+    def track(self, name: str):
+        # Called by jobs as they write images. Reading the size of a JPEG
+        # or WebP takes a header parse, so it runs on a thread.
+        task = asyncio.create_task(self.add(name))
+        self._adding.add(task)
+        task.add_done_callback(self._adding.discard)
+
+    async def add(self, name: str) -> ImageEntry | None:
+        if not is_image(name):
+            return None
+        entry = await asyncio.to_thread(read_entry, self.directory, name)
+        if entry is None:
+            return None
+        existing = self._entries.get(name)
+        if existing is not None:
+            self._order.pop(bisect_left(self._order, existing.key))
+            self.total_size -= existing.size
+        self._entries[name] = entry
+        self.total_size += entry.size
+        insort(self._order, entry.key)
+        self.version += 1
+        if existing is None and self.events is not None:
+            self.events.added(name)
+        return entry
+
+    def remove(self, name: str) -> bool:
+        entry = self._entries.pop(name, None)
+        if entry is None:
+            return False
+        self._order.pop(bisect_left(self._order, entry.key))
+        self.total_size -= entry.size
+        self.version += 1
+        if self.on_remove is not None:
+            self.on_remove(name)
+        if self.events is not None:
+            self.events.deleted(name)
+        return True
+
+    def clear(self):
+        self._entries.clear()
+        self._order.clear()
+        self.total_size = 0
+        self.version += 1
+        if self.events is not None:
+            self.events.cleared()
+
+    def page(
+        self,
+        limit: int,
+        cursor: str | None = None,
+        order: str = "newest",
+        since: float | None = None,
+    ) -> tuple[list[ImageEntry], str | None]:
+        keys = self._order
+        low = 0 if since is None else bisect_right(keys, (since, MAX_KEY))
+        if order == "newest":
+            high = len(keys)
+            if cursor is not None:
+                high = min(high, bisect_left(keys, decode_cursor(cursor)))
+            start, stop = max(low, high - limit), high
+            selected = keys[start:stop][::-1]
+            more = start > low
+        else:
+            if cursor is not None:
+                low = max(low, bisect_right(keys, decode_cursor(cursor)))
+            selected = keys[low:low + limit]
+            more = low + limit < len(keys)
+        entries = [self._entries[name] for _, name in selected]
+        next_cursor = None
+        if more and selected:
+            next_cursor = encode_cursor(selected[-1])
+        return entries, next_cursor
+
+    async def watch(self, interval: float = OUTPUT_WATCH_INTERVAL):
+        mtime = self.directory.stat().st_mtime
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                current_mtime = self.directory.stat().st_mtime
+                if current_mtime == mtime:
+                    continue
+                mtime = current_mtime
+                current = await asyncio.to_thread(list_images, self.directory)
+            except OSError as e:
+                logger.error(f"Failed to watch {self.directory}: {e}")
+                continue
+            for name in sorted(current - self._entries.keys()):
+                await self.add(name)
+            for name in sorted(self._entries.keys() - current):
+                # Skip images reported by a job after the listing was taken.
+                if not (self.directory / name).exists():
+                    self.remove(name)
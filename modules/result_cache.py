@@ -0,0 +1,97 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+from config import OUTPUT_DIR, RESULT_CACHE_SIZE, RESULT_CACHE_TTL
+from modules.jobs import Job, JobState
+from modules.logger import logger
+
+
+def workflow_key(workflow: dict) -> str:
+    return hashlib.sha256(
+        json.dumps(workflow, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    entries: int
+    hits: int
+    misses: int
+    coalesced: int
+    evictions: int
+
+
+# Maps the hash of a fully prepared workflow to the job that ran it. Seeded
+# workflows always produce the same images, so a completed job can answer
+# again as long as its outputs exist, and a running one is shared.
+class ResultCache:
+    def __init__(
+        self,
+        max_size: int = RESULT_CACHE_SIZE,
+        ttl: float = RESULT_CACHE_TTL,
+        directory: Path = OUTPUT_DIR,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, Job] = OrderedDict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            entries=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            evictions=self.evictions,
+        )
+
+    def _usable(self, job: Job) -> bool:
+        if not job.finished:
+            return True
+        if job.state != JobState.COMPLETED or not job.outputs:
+            return False
+        if time.time() - job.finished_at > self.ttl:
+            return False
+        return all((self.directory / name).exists() for name in job.outputs)
+
+    def get(self, key: str) -> Job | None:
+        job = self._entries.get(key)
+        if job is not None and not self._usable(job):
+            del self._entries[key]
+            self.evictions += 1
+            job = None
+        if job is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        if job.finished:
+            self.hits += 1
+        else:
+            self.coalesced += 1
+        logger.info(f"Result cache hit for job {job.id}")
+        return job
+
+    def put(self, key: str, job: Job):
+        self._entries[key] = job
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
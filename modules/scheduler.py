@@ -0,0 +1,594 @@
+import asyncio
+import copy
+import hashlib
+import heapq
+import json
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field, replace
+from uuid import uuid4
+
+from fastapi import HTTPException, status
+import aiohttp
+
+from config import (
+    SCHEDULER_AFFINITY_SLACK,
+    SCHEDULER_BACKEND_DEPTH,
+    SCHEDULER_CLIENT_WEIGHTS,
+    SCHEDULER_INTERVAL,
+    SCHEDULER_MODEL_SLACK,
+    SCHEDULER_PINS,
+)
+from modules.backends import Backend, BackendPool, set_filename_prefix
+from modules.comfyui_client import ComfyUIClient
+from modules.jobs import Job, JobState, JobTracker, Priority
+from modules.logger import logger
+
+
+# Nodes whose output ComfyUI can reuse from the previous prompt when their
+# inputs are unchanged, the expensive text encodings in particular.
+ENCODERS = {"CLIPTextEncode", "CLIPTextEncodeFlux"}
+# Nodes loading model weights, whose inputs tell which models a prompt needs
+# ComfyUI to hold in memory.
+LOADERS = {
+    "UNETLoader",
+    "CLIPLoader",
+    "DualCLIPLoader",
+    "VAELoader",
+    "CheckpointLoaderSimple",
+}
+
+
+async def queue_prompt(client: ComfyUIClient, nodes, **extra):
+    try:
+        status_code, response_json = await client.post(
+            "/prompt", {"prompt": nodes, **extra}
+        )
+    except aiohttp.ClientConnectorError as e:
+        # Never reached ComfyUI, so another instance can take the prompt.
+        logger.error(f"Failed to queue prompt: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"Failed to queue prompt: {e}"
+        )
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"Failed to queue prompt: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to queue prompt: {e}"
+        )
+    if status_code >= 400:
+        logger.error(f"Failed to queue prompt: {response_json}")
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Failed to queue prompt: {response_json}"
+        )
+    return response_json
+
+
+def parse_weights(
+    weights: str = SCHEDULER_CLIENT_WEIGHTS
+) -> dict[str, float]:
+    parsed = {}
+    for item in filter(None, (item.strip() for item in weights.split(","))):
+        client, _, weight = item.rpartition("=")
+        parsed[client.strip()] = float(weight)
+    return parsed
+
+
+def parse_pins(pins: str = SCHEDULER_PINS) -> dict[str, set[str]]:
+    parsed = {}
+    for item in filter(None, (item.strip() for item in pins.split(","))):
+        model, _, backends = item.partition("=")
+        parsed[model.strip()] = {
+            backend.strip() for backend in backends.split("|")
+            if backend.strip()
+        }
+    return parsed
+
+
+def model_set_key(model: str, workflow: dict) -> str:
+    loaders = {
+        node_id: node["inputs"] for node_id, node in workflow.items()
+        if node.get("class_type") in LOADERS
+    }
+    if not loaders:
+        return model
+    return hashlib.sha256(
+        json.dumps(loaders, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def affinity_key(model: str, workflow: dict) -> str | None:
+    encoders = {
+        node_id: node["inputs"] for node_id, node in workflow.items()
+        if node.get("class_type") in ENCODERS
+    }
+    if not encoders:
+        return None
+    return hashlib.sha256(
+        json.dumps([model, encoders], sort_keys=True).encode()
+    ).hexdigest()
+
+
+@dataclass
+class ScheduledPrompt:
+    jobs: list[Job]
+    workflow: dict
+    # Estimated GPU seconds, charged to the client's share when dispatched.
+    cost: float
+    client: str
+    priority: Priority
+    # Equal for prompts needing the same models loaded.
+    model_set: str
+    # Equal for prompts whose text encodings ComfyUI can reuse.
+    affinity: str | None = None
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def model(self) -> str:
+        return self.jobs[0].model
+
+    @property
+    def deadline(self) -> float | None:
+        return min(
+            (job.deadline for job in self.jobs if job.deadline is not None),
+            default=None,
+        )
+
+
+@dataclass
+class ClientShare:
+    name: str
+    weight: float = 1.0
+    virtual_time: float = 0.0
+    queued: int = 0
+    gpu_seconds: float = 0.0
+
+
+# Holds prompts until a ComfyUI instance has room for them, since ComfyUI
+# itself runs prompts strictly in order. Priority classes are served
+# strictly in order; within a class the client with the least weighted GPU
+# time used goes next (start-time fair queuing). Instances are kept `depth`
+# prompts deep, enough to start the next prompt without waiting on us.
+# A prompt sharing its text with the one last sent to an instance may go
+# ahead of its turn, within `affinity_slack`, to run on ComfyUI's cache;
+# failing that, one needing the models the instance has loaded may, within
+# `model_slack`. Models pinned to instances only run there, and those
+# instances run nothing else.
+class Scheduler:
+    def __init__(
+        self,
+        backends: BackendPool,
+        jobs: JobTracker,
+        depth: int = SCHEDULER_BACKEND_DEPTH,
+        weights: dict[str, float] | None = None,
+        interval: float = SCHEDULER_INTERVAL,
+        affinity_slack: float = SCHEDULER_AFFINITY_SLACK,
+        model_slack: float = SCHEDULER_MODEL_SLACK,
+        pins: dict[str, set[str]] | None = None,
+    ):
+        self.backends = backends
+        self.jobs = jobs
+        self.depth = depth
+        self.weights = parse_weights() if weights is None else weights
+        self.interval = interval
+        self.affinity_slack = affinity_slack
+        self.model_slack = model_slack
+        self.pins = parse_pins() if pins is None else pins
+        self._dedicated = set().union(*self.pins.values())
+        unknown = sorted(
+            name for name in self._dedicated if backends.get(name) is None
+        )
+        if unknown:
+            raise ValueError(
+                f"Models pinned to unknown backends: {', '.join(unknown)}"
+            )
+        self.virtual_time = 0.0
+        self.expired = 0
+        self.cancelled = 0
+        # Prompts sent ahead of their turn, by what they had in common
+        # with the previous prompt of the instance.
+        self.reordered: Counter[str] = Counter()
+        # Prompts needing other models than the instance had loaded, by
+        # backend and model.
+        self.swaps: Counter[tuple[str, str]] = Counter()
+        self._queues: dict[Priority, dict[str, deque[ScheduledPrompt]]] = {
+            priority: {} for priority in Priority
+        }
+        self._clients: dict[str, ClientShare] = {}
+        self._by_job: dict[str, ScheduledPrompt] = {}
+        self._deadlines: list[tuple[float, str]] = []
+        self._last_affinity: dict[str, str | None] = {}
+        self._sending: set[asyncio.Task] = set()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._by_job)
+
+    def __contains__(self, job: Job) -> bool:
+        return job.id in self._by_job
+
+    def counts(self) -> dict[Priority, int]:
+        return {
+            priority: sum(
+                len(prompt.jobs)
+                for queue in queues.values()
+                for prompt in queue
+            )
+            for priority, queues in self._queues.items()
+        }
+
+    def shares(self) -> list[ClientShare]:
+        return list(self._clients.values())
+
+    def _share(self, client: str) -> ClientShare:
+        share = self._clients.get(client)
+        if share is None:
+            # Newcomers start level with the others instead of owed time.
+            share = ClientShare(
+                name=client,
+                weight=self.weights.get(client, 1.0),
+                virtual_time=self.virtual_time,
+            )
+            self._clients[client] = share
+        return share
+
+    def _forget(self, share: ClientShare):
+        # Idle clients without a debt are dropped to bound the table.
+        if not share.queued and share.virtual_time <= self.virtual_time:
+            self._clients.pop(share.name, None)
+
+    def submit(self, jobs: list[Job], workflow: dict, cost: float):
+        # Jobs can be cancelled while the batcher holds them.
+        jobs = [job for job in jobs if not job.finished]
+        if not jobs:
+            return
+        prompt = ScheduledPrompt(
+            jobs=list(jobs),
+            workflow=workflow,
+            cost=cost,
+            client=jobs[0].client,
+            priority=min(
+                (job.priority for job in jobs), key=list(Priority).index
+            ),
+            model_set=model_set_key(jobs[0].model, workflow),
+            affinity=affinity_key(jobs[0].model, workflow),
+        )
+        self._enqueue(prompt)
+        logger.info(
+            f"Jobs {', '.join(job.id for job in jobs)} scheduled as "
+            f"{prompt.priority.value} for client {prompt.client}"
+        )
+
+    def follow(self, leader: Job, job: Job) -> bool:
+        # Lets a job share the prompt of an identical one, as long as it
+        # gets all of its events. The prompt is dropped only once none of
+        # its jobs are left.
+        prompt = self._by_job.get(leader.id)
+        if prompt is not None:
+            prompt.jobs.append(job)
+            self._by_job[job.id] = prompt
+            self._share(prompt.client).queued += 1
+            if job.deadline is not None:
+                heapq.heappush(self._deadlines, (job.deadline, job.id))
+            return True
+        # Being sent, or already sending images the job would miss.
+        if (
+            leader.prompt_id is None or
+            leader.finished or
+            leader.outputs or
+            leader.images_received
+        ):
+            return False
+        job.backend = leader.backend
+        job.state = leader.state
+        job.started_at = leader.started_at
+        self.jobs.attach(job, leader.prompt_id)
+        return True
+
+    def _enqueue(self, prompt: ScheduledPrompt, first: bool = False):
+        queue = self._queues[prompt.priority].setdefault(
+            prompt.client, deque()
+        )
+        if first:
+            queue.appendleft(prompt)
+        else:
+            queue.append(prompt)
+        self._share(prompt.client).queued += len(prompt.jobs)
+        for job in prompt.jobs:
+            self._by_job[job.id] = prompt
+            if job.deadline is not None:
+                heapq.heappush(self._deadlines, (job.deadline, job.id))
+        self._wakeup.set()
+
+    def _remove(self, job: Job):
+        prompt = self._by_job.pop(job.id)
+        prompt.jobs.remove(job)
+        share = self._clients[prompt.client]
+        share.queued -= 1
+        if not prompt.jobs:
+            queues = self._queues[prompt.priority]
+            queue = queues[prompt.client]
+            queue.remove(prompt)
+            if not queue:
+                del queues[prompt.client]
+        self._forget(share)
+
+    def _runs_on(self, prompt: ScheduledPrompt, backend: Backend) -> bool:
+        pinned = self.pins.get(prompt.model)
+        if pinned is not None:
+            return backend.name in pinned
+        return backend.name not in self._dedicated
+
+    def _pick(self, backend: Backend) -> ScheduledPrompt | None:
+        for queues in self._queues.values():
+            clients = sorted(
+                queues, key=lambda name: self._clients[name].virtual_time
+            )
+            prompt = next(
+                (
+                    prompt for client in clients for prompt in queues[client]
+                    if self._runs_on(prompt, backend)
+                ),
+                None,
+            )
+            if prompt is None:
+                continue
+            turn = self._clients[prompt.client].virtual_time
+            affinity = self._last_affinity.get(backend.name)
+            for reason, key, slack, match in (
+                (
+                    "prompt",
+                    affinity,
+                    self.affinity_slack,
+                    lambda other: other.affinity == affinity,
+                ),
+                (
+                    "model",
+                    backend.model_set,
+                    self.model_slack,
+                    lambda other: other.model_set == backend.model_set,
+                ),
+            ):
+                if key is None or match(prompt):
+                    continue
+                following = self._follow(
+                    queues,
+                    clients,
+                    turn + slack if slack > 0 else None,
+                    lambda other: match(other) and self._runs_on(
+                        other, backend
+                    ),
+                )
+                if following is not None:
+                    self.reordered[reason] += 1
+                    prompt = following
+                    break
+            self._take(queues, prompt, turn)
+            return prompt
+        return None
+
+    def _follow(
+        self,
+        queues: dict[str, deque[ScheduledPrompt]],
+        clients: list[str],
+        bound: float | None,
+        match,
+    ) -> ScheduledPrompt | None:
+        # The earliest matching prompt among the clients at most `bound`
+        # far in virtual time, that is ahead of the one whose turn it is.
+        if bound is None:
+            return None
+        for client in clients:
+            if self._clients[client].virtual_time > bound:
+                break
+            for prompt in queues[client]:
+                if match(prompt):
+                    return prompt
+        return None
+
+    def _take(
+        self,
+        queues: dict[str, deque[ScheduledPrompt]],
+        prompt: ScheduledPrompt,
+        turn: float,
+    ):
+        queue = queues[prompt.client]
+        if prompt is queue[0]:
+            queue.popleft()
+        else:
+            queue.remove(prompt)
+        if not queue:
+            del queues[prompt.client]
+        share = self._clients[prompt.client]
+        start = max(share.virtual_time, self.virtual_time)
+        # A prompt taken ahead of its turn does not move the others on.
+        self.virtual_time = max(self.virtual_time, min(start, turn))
+        share.virtual_time = start + prompt.cost / share.weight
+        share.gpu_seconds += prompt.cost
+        share.queued -= len(prompt.jobs)
+        for job in prompt.jobs:
+            del self._by_job[job.id]
+
+    def snapshot(self, limit: int) -> list[ScheduledPrompt]:
+        # Replays the dispatch loop on copies, each instance taking the
+        # next prompt while the least loaded, giving the order prompts
+        # will leave. Ones no instance can take now follow, by class and
+        # client.
+        replay = copy.copy(self)
+        replay._queues = {
+            priority: {
+                client: deque(queue) for client, queue in queues.items()
+            }
+            for priority, queues in self._queues.items()
+        }
+        replay._clients = {
+            name: replace(share) for name, share in self._clients.items()
+        }
+        replay._by_job = dict(self._by_job)
+        replay._last_affinity = dict(self._last_affinity)
+        replay.reordered = Counter()
+        backends = [
+            copy.copy(backend) for backend in self.backends.candidates()
+        ]
+        prompts = []
+        while len(prompts) < limit:
+            for backend in sorted(
+                backends, key=lambda backend: backend.queue_depth
+            ):
+                prompt = replay._pick(backend)
+                if prompt is not None:
+                    backend.model_set = prompt.model_set
+                    backend.in_flight += 1
+                    replay._last_affinity[backend.name] = prompt.affinity
+                    prompts.append(prompt)
+                    break
+            else:
+                break
+        for queues in replay._queues.values():
+            for queue in queues.values():
+                prompts.extend(queue)
+        return prompts[:limit]
+
+    def _expire(self):
+        now = time.time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, job_id = heapq.heappop(self._deadlines)
+            prompt = self._by_job.get(job_id)
+            if prompt is None:
+                continue
+            job = next(job for job in prompt.jobs if job.id == job_id)
+            self._remove(job)
+            self.expired += 1
+            self.jobs.fail(job, "Deadline passed before the job started")
+
+    async def cancel(self, job: Job, interrupt: bool = False):
+        if job in self:
+            self._remove(job)
+            self.cancelled += 1
+            self.jobs.cancel(job)
+            return
+        running = job.state == JobState.RUNNING
+        if job.state != JobState.PENDING and not (interrupt and running):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Job {job.id} is already {job.state.value}"
+            )
+        # Already handed to ComfyUI, whose queue drops it, or which stops
+        # running it, unless it is shared with other jobs of a batch.
+        backend = self.backends.get(job.backend)
+        prompt_id = job.prompt_id
+        shared = [
+            other for other in self.jobs.for_prompt(prompt_id)
+            if other is not job
+        ]
+        self.cancelled += 1
+        self.jobs.cancel(job)
+        if shared or backend is None:
+            return
+        try:
+            if running:
+                await backend.client.post(
+                    "/interrupt", {"prompt_id": prompt_id}
+                )
+            else:
+                await backend.client.post("/queue", {"delete": [prompt_id]})
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(
+                f"Failed to drop prompt {prompt_id} from {backend.name}: {e}"
+            )
+
+    def _dispatch(self):
+        # Instances with room in turn, least loaded first, until none of
+        # them has anything left to run.
+        while True:
+            for backend in self.backends.candidates():
+                if 0 < self.depth <= backend.queue_depth:
+                    continue
+                prompt = self._pick(backend)
+                if prompt is not None:
+                    self._start(prompt, backend)
+                    break
+            else:
+                return
+
+    def _start(self, prompt: ScheduledPrompt, backend: Backend):
+        if backend.model_set not in (None, prompt.model_set):
+            self.swaps[backend.name, prompt.model] += 1
+            logger.info(
+                f"ComfyUI {backend.name} switches from {backend.loaded} "
+                f"to {prompt.model} models"
+            )
+        backend.model_set = prompt.model_set
+        backend.loaded = prompt.model
+        self._last_affinity[backend.name] = prompt.affinity
+        self.backends.dispatched(backend)
+        task = asyncio.create_task(self._send(prompt, backend))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, prompt: ScheduledPrompt, backend: Backend):
+        # Register the prompt id up front so no websocket event is missed.
+        prompt_id = str(uuid4())
+        for job in prompt.jobs:
+            job.backend = backend.name
+            self.jobs.attach(job, prompt_id)
+        try:
+            response = await queue_prompt(
+                backend.client,
+                set_filename_prefix(prompt.workflow, backend.filename_prefix),
+                prompt_id=prompt_id,
+                client_id=self.jobs.client_id,
+            )
+        except HTTPException as e:
+            self.backends.sent(backend, None)
+            # Whatever the instance holds now, it is not this prompt's.
+            self._last_affinity.pop(backend.name, None)
+            backend.loaded = backend.model_set = None
+            if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
+                self.backends.eject(backend, e.detail)
+                self._retry(prompt)
+            else:
+                for job in prompt.jobs:
+                    self.jobs.fail(job, str(e.detail))
+            self._wakeup.set()
+            return
+        if response.get("prompt_id") != prompt_id:
+            prompt_id = response["prompt_id"]
+            for job in prompt.jobs:
+                self.jobs.attach(job, prompt_id)
+        self.backends.sent(backend, prompt_id)
+        logger.info(
+            f"Jobs {', '.join(job.id for job in prompt.jobs)} "
+            f"queued as prompt {prompt_id} on {backend.name}"
+        )
+        try:
+            await asyncio.gather(*(job.done.wait() for job in prompt.jobs))
+        finally:
+            self.backends.finished(backend, prompt_id)
+            self._wakeup.set()
+
+    def _retry(self, prompt: ScheduledPrompt):
+        # Back to the head of its queue, with the charge refunded.
+        for job in prompt.jobs:
+            self.jobs.unassign(job)
+        prompt.jobs = [job for job in prompt.jobs if not job.finished]
+        if not prompt.jobs:
+            return
+        share = self._share(prompt.client)
+        share.virtual_time -= prompt.cost / share.weight
+        share.gpu_seconds -= prompt.cost
+        self._enqueue(prompt, first=True)
+
+    async def run(self):
+        while True:
+            self._wakeup.clear()
+            self._expire()
+            for share in list(self._clients.values()):
+                self._forget(share)
+            self._dispatch()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,193 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+from config import (
+    OUTPUT_DIR,
+    PREWARM_MODELS,
+    PREWARM_READ_SIZE,
+    PREWARM_WORKERS,
+    WARMUP_RETRY_DELAY,
+    WARMUP_TIMEOUT,
+    WARMUP_WORKFLOW,
+    Models,
+)
+from modules.backends import BackendPool
+from modules.comfyui_flux_service import FluxService
+from modules.jobs import JobState, Priority
+from modules.logger import logger
+from modules.model_registry import ModelRegistry
+from modules.output_index import OutputIndex
+from modules.workflows import WorkflowRegistry
+
+
+# Small enough to run quickly, while still loading every model it uses.
+WARMUP_PARAMS = {"width": 256, "height": 256, "steps": 1, "batch_size": 1}
+WARMUP_CLIENT = "warmup"
+
+
+@dataclass
+class Phase:
+    name: str
+    started_at: float | None = None
+    seconds: float | None = None
+    error: str | None = None
+    attempts: int = 0
+
+    @property
+    def done(self) -> bool:
+        return self.seconds is not None
+
+
+def prewarm_file(path: Path, read_size: int = PREWARM_READ_SIZE) -> int:
+    # Reading the file through once leaves it in the page cache, where
+    # ComfyUI's own reads find it.
+    buffer = memoryview(bytearray(read_size))
+    total = 0
+    with open(path, "rb", buffering=0) as file:
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        while count := file.readinto(buffer):
+            total += count
+    return total
+
+
+def prewarm_paths(
+    models: ModelRegistry,
+    workflows: WorkflowRegistry,
+    names: str = PREWARM_MODELS,
+) -> list[Path]:
+    if names == "required":
+        wanted = {
+            requirement
+            for name in workflows.names()
+            for requirement in workflows.get(name).requires
+        }
+    else:
+        wanted = {name.strip() for name in names.split(",") if name.strip()}
+        unknown = wanted - set(Models.__members__)
+        if unknown:
+            logger.warning(
+                f"Unknown models to prewarm: {', '.join(sorted(unknown))}"
+            )
+    return sorted(
+        model.path for model in models
+        if model.name in wanted and model.available
+    )
+
+
+# Gets the service ready before it reports ready: model files are read into
+# the page cache while ComfyUI starts, then a warm-up workflow makes ComfyUI
+# load them, so the first real request does not pay for either.
+class Startup:
+    def __init__(
+        self,
+        backends: BackendPool,
+        models: ModelRegistry,
+        workflows: WorkflowRegistry,
+        service: FluxService,
+        index: OutputIndex,
+        workflow: str = WARMUP_WORKFLOW,
+        workers: int = PREWARM_WORKERS,
+        timeout: float = WARMUP_TIMEOUT,
+        retry_delay: float = WARMUP_RETRY_DELAY,
+    ):
+        self.backends = backends
+        self.models = models
+        self.workflows = workflows
+        self.service = service
+        self.index = index
+        self.workflow = workflow
+        self.workers = workers
+        self.timeout = timeout
+        self.retry_delay = retry_delay
+        self.started_at = time.time()
+        self.phases = {
+            name: Phase(name) for name in ("prewarm", "comfyui", "warmup")
+        }
+        self.prewarmed_bytes = 0
+        self._done = False
+
+    @property
+    def ready(self) -> bool:
+        return self._done and bool(self.backends.available())
+
+    async def _timed(self, name: str, run):
+        phase = self.phases[name]
+        phase.started_at = time.time()
+        phase.error = None
+        phase.attempts += 1
+        started = time.perf_counter()
+        try:
+            await run()
+        except Exception as e:
+            phase.error = str(e) or type(e).__name__
+            logger.error(f"Startup phase {name} failed: {phase.error}")
+        phase.seconds = time.perf_counter() - started
+        logger.info(f"Startup phase {name} took {phase.seconds:.2f}s")
+
+    async def _prewarm(self):
+        paths = await asyncio.to_thread(
+            prewarm_paths, self.models, self.workflows
+        )
+        if not paths:
+            return
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max(1, self.workers)) as executor:
+            sizes = await asyncio.gather(
+                *(
+                    loop.run_in_executor(executor, prewarm_file, path)
+                    for path in paths
+                )
+            )
+        self.prewarmed_bytes = sum(sizes)
+        logger.info(
+            f"Prewarmed {len(paths)} model files, "
+            f"{self.prewarmed_bytes / 2**30:.1f} GiB"
+        )
+
+    async def _comfyui(self):
+        while not self.backends.available():
+            await asyncio.sleep(0.5)
+
+    async def _warmup(self):
+        if not self.workflow:
+            return
+        template = self.workflows.get(self.workflow)
+        params = {
+            name: value for name, value in WARMUP_PARAMS.items()
+            if name in template.parameters
+        }
+        job = await self.service.generate(
+            self.workflow,
+            "warm-up",
+            client=WARMUP_CLIENT,
+            priority=Priority.INTERACTIVE,
+            **params,
+        )
+        await asyncio.wait_for(job.done.wait(), self.timeout)
+        # The image is of no use to anyone, keep it out of the gallery.
+        for name in job.outputs:
+            (OUTPUT_DIR / name).unlink(missing_ok=True)
+            self.index.remove(name)
+        if job.state != JobState.COMPLETED:
+            raise RuntimeError(job.error or job.state.value)
+
+    async def run(self):
+        await asyncio.gather(
+            self._timed("prewarm", self._prewarm),
+            self._timed("comfyui", self._comfyui),
+        )
+        # Prewarming only saves time, but ready means the warm-up has run.
+        await self._timed("warmup", self._warmup)
+        while self.phases["warmup"].error is not None:
+            logger.info(f"Retrying the warm-up in {self.retry_delay:g}s")
+            await asyncio.sleep(self.retry_delay)
+            await self._timed("warmup", self._warmup)
+        self._done = True
+        logger.info(
+            f"Ready {time.time() - self.started_at:.2f}s after startup"
+        )
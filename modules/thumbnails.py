@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from uuid import uuid4
+
+from PIL import Image
+
+from config import (
+    OUTPUT_DIR,
+    THUMBNAILS_DIR,
+    THUMBNAIL_WORKERS,
+    THUMBNAIL_WIDTHS,
+    THUMBNAIL_QUALITY,
+)
+from modules.logger import logger
+
+
+THUMBNAIL_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+def render_thumbnail(
+    source: Path, destination: Path, width: int, fmt: str, quality: int
+):
+    with Image.open(source) as image:
+        height = max(1, round(image.height * width / image.width))
+        image.thumbnail((width, height))
+        if fmt == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = destination.with_name(f".{uuid4().hex}.tmp")
+        image.save(tmp_path, format=THUMBNAIL_FORMATS[fmt], quality=quality)
+    os.replace(tmp_path, destination)
+
+
+# Small renditions of output images, rendered once in a process pool and
+# cached on disk under a key derived from the source file's identity.
+class Thumbnails:
+    def __init__(
+        self,
+        source_dir: Path = OUTPUT_DIR,
+        cache_dir: Path = THUMBNAILS_DIR,
+        workers: int = THUMBNAIL_WORKERS,
+        quality: int = THUMBNAIL_QUALITY,
+    ):
+        self.source_dir = source_dir
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.quality = quality
+        self._pool: ProcessPoolExecutor | None = None
+        self._rendering: dict[Path, asyncio.Future] = {}
+
+    def start(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def path(self, name: str, width: int, fmt: str) -> Path:
+        stat = (self.source_dir / name).stat()
+        key = hashlib.sha256(
+            f"{name}:{stat.st_size}:{stat.st_mtime_ns}:"
+            f"{width}:{fmt}:{self.quality}".encode()
+        ).hexdigest()[:32]
+        return self.cache_dir / name / f"{key}.{fmt}"
+
+    async def get(self, name: str, width: int, fmt: str = "webp") -> Path:
+        if width not in THUMBNAIL_WIDTHS:
+            raise ValueError(
+                f"Unsupported width {width}, use one of {THUMBNAIL_WIDTHS}"
+            )
+        if fmt not in THUMBNAIL_FORMATS:
+            raise ValueError(f"Unsupported format {fmt}")
+        path = self.path(name, width, fmt)
+        if path.exists():
+            return path
+
+        future = self._rendering.get(path)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._pool,
+                render_thumbnail,
+                self.source_dir / name,
+                path,
+                width,
+                fmt,
+                self.quality,
+            )
+            self._rendering[path] = future
+            future.add_done_callback(
+                lambda _: self._rendering.pop(path, None)
+            )
+        await asyncio.shield(future)
+        return path
+
+    def invalidate(self, name: str):
+        path = self.cache_dir / name
+        if path.exists():
+            loop = asyncio.get_running_loop()
+            loop.run_in_executor(None, shutil.rmtree, path, True)
+            logger.info(f"Invalidated thumbnails of {name}")
+
+    async def clear(self):
+        await asyncio.to_thread(shutil.rmtree, self.cache_dir, True)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
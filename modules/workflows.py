@@ -0,0 +1,219 @@
+import json
+import time
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+
+from config import (
+    MEMORY_PROFILE,
+    MEMORY_PROFILES,
+    WORKFLOWS_DIR,
+    WORKFLOWS_RELOAD_INTERVAL,
+    MemoryProfile,
+)
+from modules.logger import logger
+
+
+BINDINGS_SUFFIX = ".bindings.json"
+# Text encoder files a profile may swap for another.
+TEXT_ENCODERS = {profile.TEXT_ENCODER for profile in MEMORY_PROFILES.values()}
+
+
+@dataclass
+class WorkflowTemplate:
+    name: str
+    path: Path
+    bindings_path: Path
+    nodes: dict
+    parameters: dict[str, list[tuple[str, str]]]
+    requires: list[str] = field(default_factory=list)
+    mtime: tuple[float, float] = (0.0, 0.0)
+    # Memory profile applied to the workflow file's nodes, if any.
+    profile: str | None = None
+
+    def render(self, **params) -> dict:
+        unknown = set(params) - set(self.parameters)
+        if unknown:
+            raise ValueError(
+                f"Unknown parameters for workflow {self.name}: "
+                f"{', '.join(sorted(unknown))}"
+            )
+        # Untouched nodes are shared with the template, only nodes with
+        # bound inputs are copied before patching.
+        workflow = dict(self.nodes)
+        copied = set()
+        for param, value in params.items():
+            for node_id, input_name in self.parameters[param]:
+                if node_id not in copied:
+                    node = self.nodes[node_id]
+                    workflow[node_id] = {
+                        **node, "inputs": dict(node["inputs"])
+                    }
+                    copied.add(node_id)
+                workflow[node_id]["inputs"][input_name] = value
+        return workflow
+
+
+def _mtime(path: Path) -> float:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def get_profile(name: str) -> MemoryProfile:
+    try:
+        return MEMORY_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Invalid profile: {name}, expected one of "
+            f"{', '.join(MEMORY_PROFILES)}"
+        )
+
+
+def apply_profile(template: WorkflowTemplate, name: str) -> WorkflowTemplate:
+    profile = get_profile(name)
+    encoder_names = {model.value.NAME for model in TEXT_ENCODERS}
+    nodes = {}
+    for node_id, node in template.nodes.items():
+        inputs = {
+            input_name: (
+                profile.TEXT_ENCODER.value.NAME
+                if isinstance(value, str) and value in encoder_names
+                else value
+            )
+            for input_name, value in node.get("inputs", {}).items()
+        }
+        if node.get("class_type") == "UNETLoader":
+            inputs["weight_dtype"] = profile.WEIGHT_DTYPE
+        nodes[node_id] = {**node, "inputs": inputs}
+    encoders = {model.name for model in TEXT_ENCODERS}
+    requires = [
+        profile.TEXT_ENCODER.name if requirement in encoders else requirement
+        for requirement in template.requires
+    ]
+    return replace(
+        template,
+        nodes=nodes,
+        requires=list(dict.fromkeys(requires)),
+        profile=name,
+    )
+
+
+def load_template(bindings_path: Path) -> WorkflowTemplate:
+    with open(bindings_path, "r") as file:
+        bindings = json.load(file)
+    path = bindings_path.parent / bindings["workflow"]
+    with open(path, "r") as file:
+        nodes = json.load(file)
+
+    parameters = {}
+    for param, targets in bindings["parameters"].items():
+        parameters[param] = []
+        for node_id, input_name in targets:
+            if input_name not in nodes.get(node_id, {}).get("inputs", {}):
+                raise ValueError(
+                    f"{bindings_path.name}: parameter {param} is bound to "
+                    f"missing input {node_id}.{input_name}"
+                )
+            parameters[param].append((node_id, input_name))
+
+    return WorkflowTemplate(
+        name=bindings["name"],
+        path=path,
+        bindings_path=bindings_path,
+        nodes=nodes,
+        parameters=parameters,
+        requires=bindings.get("requires", []),
+        mtime=(_mtime(path), _mtime(bindings_path)),
+    )
+
+
+class WorkflowRegistry:
+    def __init__(
+        self,
+        directory: Path = WORKFLOWS_DIR,
+        reload_interval: float = WORKFLOWS_RELOAD_INTERVAL,
+        profile: str = MEMORY_PROFILE,
+    ):
+        if profile:
+            get_profile(profile)
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self.profile = profile or None
+        self._templates: dict[str, WorkflowTemplate] = {}
+        # Templates with a profile applied, along with the one they were
+        # derived from, so a reloaded workflow gets them derived again.
+        self._profiled: dict[
+            tuple[str, str], tuple[WorkflowTemplate, WorkflowTemplate]
+        ] = {}
+        self._last_check = 0.0
+
+    def load(self):
+        templates = {}
+        bindings_paths = self.directory.glob(f"*{BINDINGS_SUFFIX}")
+        for bindings_path in sorted(bindings_paths):
+            template = self._load(bindings_path)
+            if template is not None:
+                templates[template.name] = template
+        self._templates = templates
+        self._last_check = time.monotonic()
+        logger.info(
+            f"Loaded {len(templates)} workflows: {', '.join(templates)}"
+        )
+
+    def _load(self, bindings_path: Path) -> WorkflowTemplate | None:
+        try:
+            template = load_template(bindings_path)
+        except FileNotFoundError as e:
+            logger.error(f"Workflow file not found: {e.filename}")
+            return None
+        except json.JSONDecodeError as e:
+            logger.error(f"Invalid JSON in workflow {bindings_path}: {e}")
+            return None
+        except (KeyError, ValueError) as e:
+            logger.error(f"Invalid bindings in {bindings_path}: {e}")
+            return None
+        logger.info(f"Loaded workflow {template.name} from {template.path}")
+        return template
+
+    def refresh(self):
+        known = {t.bindings_path: t for t in self._templates.values()}
+        for bindings_path in self.directory.glob(f"*{BINDINGS_SUFFIX}"):
+            template = known.pop(bindings_path, None)
+            if template is not None:
+                mtime = (_mtime(template.path), _mtime(bindings_path))
+                if mtime == template.mtime:
+                    continue
+            # Keep serving the previous version while a file is mid-edit.
+            reloaded = self._load(bindings_path)
+            if reloaded is not None:
+                if template is not None and template.name != reloaded.name:
+                    self._templates.pop(template.name, None)
+                self._templates[reloaded.name] = reloaded
+        for template in known.values():
+            logger.info(f"Workflow {template.name} removed")
+            self._templates.pop(template.name, None)
+        self._last_check = time.monotonic()
+
+    def _maybe_refresh(self):
+        if time.monotonic() - self._last_check >= self.reload_interval:
+            self.refresh()
+
+    def get(self, name: str, profile: str | None = None) -> WorkflowTemplate:
+        self._maybe_refresh()
+        try:
+            template = self._templates[name]
+        except KeyError:
+            raise ValueError(f"Invalid model: {name}")
+        profile = profile or self.profile
+        if profile is None:
+            return template
+        base, profiled = self._profiled.get((name, profile), (None, None))
+        if base is not template:
+            profiled = apply_profile(template, profile)
+            self._profiled[name, profile] = (template, profiled)
+        return profiled
+
+    def names(self) -> list[str]:
+        self._maybe_refresh()
+        return list(self._templates)
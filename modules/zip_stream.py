@@ -0,0 +1,121 @@
+import asyncio
+import io
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import AsyncIterator, Iterable
+
+from config import ZIP_STREAM_CHUNK_SIZE, ZIP_STREAM_QUEUE_SIZE
+from modules.logger import logger
+
+
+# Already compressed formats gain nothing from deflate.
+STORED_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp"}
+
+
+class ZipStreamCancelled(Exception):
+    pass
+
+
+# File-like sink for ZipFile that hands fixed-size chunks to the event loop.
+# It is not seekable, so ZipFile writes data descriptors instead of seeking
+# back, and writes block while the queue is full, which gives backpressure.
+class QueueWriter(io.RawIOBase):
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        queue: asyncio.Queue,
+        chunk_size: int,
+    ):
+        self.loop = loop
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self.cancelled = threading.Event()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.cancelled.is_set():
+            raise ZipStreamCancelled()
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.send()
+        return len(data)
+
+    def send(self):
+        if not self._buffer:
+            return
+        chunk = bytes(self._buffer)
+        self._buffer.clear()
+        self.put(chunk)
+
+    def put(self, item):
+        future = asyncio.run_coroutine_threadsafe(
+            self.queue.put(item), self.loop
+        )
+        while True:
+            try:
+                return future.result(timeout=1)
+            except TimeoutError:
+                if self.cancelled.is_set():
+                    future.cancel()
+                    raise ZipStreamCancelled()
+
+
+def write_zip(writer: QueueWriter, files: Iterable[tuple[Path, str]]):
+    with zipfile.ZipFile(writer, "w", strict_timestamps=False) as archive:
+        for path, arcname in files:
+            compress_type = (
+                zipfile.ZIP_STORED
+                if path.suffix.lower() in STORED_SUFFIXES
+                else zipfile.ZIP_DEFLATED
+            )
+            try:
+                archive.write(path, arcname, compress_type=compress_type)
+            except FileNotFoundError:
+                logger.warning(f"Skipping {path}, it was removed")
+    writer.send()
+
+
+async def stream_zip(
+    files: Iterable[tuple[Path, str]],
+    chunk_size: int = ZIP_STREAM_CHUNK_SIZE,
+    queue_size: int = ZIP_STREAM_QUEUE_SIZE,
+) -> AsyncIterator[bytes]:
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(queue_size)
+    writer = QueueWriter(loop, queue, chunk_size)
+    done = object()
+
+    def produce():
+        try:
+            write_zip(writer, files)
+        except ZipStreamCancelled:
+            return
+        except BaseException as e:
+            writer.put(e)
+            return
+        writer.put(done)
+
+    started = time.monotonic()
+    producer = loop.run_in_executor(None, produce)
+    sent = 0
+    try:
+        while True:
+            item = await queue.get()
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            sent += len(item)
+            yield item
+        logger.info(
+            f"Streamed {sent / 2**20:.1f} MiB zip "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+    finally:
+        writer.cancelled.set()
+        await producer
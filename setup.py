@@ -8,10 +8,15 @@ from pathlib import Path
 from config import (
     COMFYUI_DIR,
     COMFYUI_REQUIREMENTS_FILE,
+    MODEL_INSTALL_MODE,
 )
 from modules.logger import logger
 from modules.downloader import downloader
-from modules.copy_models import copy_local_models_from_dir
+from modules.copy_models import (
+    InstallMode,
+    Verify,
+    copy_local_models_from_dir,
+)
 
 
 def upgrade_pip():
@@ -96,6 +101,21 @@ async def main():
         ),
         metavar="PATH"
     )
+    parser.add_argument(
+        "--install-mode",
+        help=(
+            "How --local models are installed: auto tries hardlink, then "
+            "reflink, then copy. Unsupported modes fall back the same way."
+        ),
+        choices=[mode.value for mode in InstallMode],
+        default=MODEL_INSTALL_MODE,
+    )
+    parser.add_argument(
+        "--verify",
+        help="Check installed --local models by size or by full hash.",
+        choices=[verify.value for verify in Verify],
+        default=Verify.SIZE.value,
+    )
     args = parser.parse_args()
 
     if args.token:
@@ -111,7 +131,7 @@ async def main():
         install_comfyui()
         install_requirements(COMFYUI_REQUIREMENTS_FILE)
     if args.local:
-        copy_local_models_from_dir(args.local)
+        copy_local_models_from_dir(args.local, args.install_mode, args.verify)
     else:
         await downloader(args.models, args.reinstall)
 
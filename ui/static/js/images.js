@@ -1,5 +1,10 @@
 // Function to open the lightbox
 function openLightbox(lightbox) {
+    // Full resolution images are only fetched once the lightbox is opened
+    const image = lightbox.querySelector('img[data-src]');
+    if (image && !image.getAttribute('src')) {
+        image.src = image.dataset.src;
+    }
     lightbox.style.display = 'flex'; // Show the lightbox as a flexbox for centering
 }
 
@@ -8,9 +13,9 @@ function closeLightbox(lightbox) {
     lightbox.style.display = 'none'; // Hide the lightbox
 }
 
-// Function to add lightbox functionality to all images
-function addLightboxListeners() {
-    document.querySelectorAll('.lightbox-trigger').forEach(function(trigger) {
+// Function to add lightbox functionality to all images under root
+function addLightboxListeners(root = document) {
+    root.querySelectorAll('.lightbox-trigger').forEach(function(trigger) {
         trigger.addEventListener('click', function(event) {
             event.preventDefault(); // Prevent default anchor behavior
             const lightbox = this.parentElement.querySelector('.lightbox');
@@ -18,7 +23,7 @@ function addLightboxListeners() {
         });
     });
 
-    document.querySelectorAll('.lightbox .close').forEach(function(closeButton) {
+    root.querySelectorAll('.lightbox .close').forEach(function(closeButton) {
         closeButton.addEventListener('click', function(event) {
             event.preventDefault(); // Prevent default anchor behavior
             const lightbox = this.closest('.lightbox');
@@ -28,8 +33,8 @@ function addLightboxListeners() {
 }
 
 // Function to handle image download
-function addDownloadListeners() {
-    document.querySelectorAll('.btn-outline-primary').forEach(function(button) {
+function addDownloadListeners(root = document) {
+    root.querySelectorAll('.btn-outline-primary').forEach(function(button) {
         button.addEventListener('click', function() {
             const imageName = this.getAttribute('data-image-name');
             const imageUrl = `/images/${imageName}`;  // Construct the image URL
@@ -46,27 +51,20 @@ function addDownloadListeners() {
 }
 
 // Function to handle the deletion of an image
-function addDeleteListeners() {
-    document.querySelectorAll('.delete-image-btn').forEach(function(button) {
+function addDeleteListeners(root = document) {
+    root.querySelectorAll('.delete-image-btn').forEach(function(button) {
         button.addEventListener('click', function(event) {
             event.preventDefault();
             const imageName = this.getAttribute('data-image-name');
-            const cardId = `image-card-${imageName}`;
 
             fetch(`/images/${imageName}`, {
                 method: 'DELETE'
             })
             .then(response => {
                 if (response.ok) {
-                    // Remove the image card from the DOM
-                    const imageCard = document.getElementById(cardId);
-                    if (imageCard) {
-                        imageCard.remove();
-                        showAlert('Image deleted successfully.', 'success');
-                    }
-                    // Update the image count
-                    const currentCount = parseInt(document.getElementById('image-count').innerText);
-                    updateImageCount(currentCount - 1);
+                    // The card may already be gone if the event arrived first
+                    removeImageCard(imageName);
+                    showAlert('Image deleted successfully.', 'success');
                 } else {
                     showAlert('Error deleting the image.', 'danger');
                 }
@@ -100,59 +98,90 @@ document.getElementById('delete-btn').addEventListener('click', function(event)
     });
 });
 
-// Update image count directly based on the number of images fetched from the server
+// Update the total image count shown above the grid
 function updateImageCount(newCount) {
     const imageCountElement = document.getElementById('image-count');
     imageCountElement.innerText = newCount;
 }
 
-// Polling for new images every 20 seconds
-function fetchNewImages() {
-    fetch('/images')
+// Change the total image count by delta
+function changeImageCount(delta) {
+    const currentCount = parseInt(document.getElementById('image-count').innerText);
+    updateImageCount(Math.max(currentCount + delta, 0));
+}
+
+// Names of the images currently shown in the grid
+function currentImageNames() {
+    return Array.from(document.querySelectorAll('#image-grid > .col'))
+        .map(col => col.id.replace('image-card-', ''));
+}
+
+// Function to add a card for an image, new images go first
+function addImageCard(image, prepend = false) {
+    if (document.getElementById(`image-card-${image}`)) {
+        return false;
+    }
+    const imageGrid = document.getElementById('image-grid');
+    const col = document.createElement('div');
+    col.className = 'col';
+    col.id = `image-card-${image}`;
+    col.innerHTML = `
+        <div class="card">
+            <a href="#${image}" class="card-body text-center p-0 lightbox-trigger">
+                <img src="/images/${image}/thumb?w=256" class="card-img-top" alt="${image}" loading="lazy" style="object-fit: contain;">
+            </a>
+            <div id="${image}" class="lightbox" style="display: none;">
+                <a href="#" class="close" style="position: absolute; top: 10px; right: 15px; color: white; font-size: 30px; text-decoration: none;">&times;</a>
+                <img data-src="/images/${image}" alt="${image}">
+            </div>
+            <div class="card-footer">
+                <div class="row gap-2">
+                    <button class="btn btn-outline-primary col-sm" data-image-name="${image}">Download</button>
+                    <button class="btn btn-outline-danger col-sm delete-image-btn" data-image-name="${image}">Delete</button>
+                </div>
+            </div>
+        </div>`;
+    if (prepend) {
+        imageGrid.prepend(col);
+    } else {
+        imageGrid.appendChild(col);
+    }
+
+    // Remove the "No images found" message if present
+    const noImagesMessage = document.getElementById('no-images-message');
+    if (noImagesMessage) {
+        noImagesMessage.remove();
+    }
+
+    // Attach lightbox, download, and delete listeners to the new card only
+    addLightboxListeners(col);
+    addDownloadListeners(col);
+    addDeleteListeners(col);
+    return true;
+}
+
+// Function to remove the card of a deleted image
+function removeImageCard(image) {
+    const imageCard = document.getElementById(`image-card-${image}`);
+    if (imageCard) {
+        imageCard.remove();
+    }
+}
+
+// Full resync of the newest page, only needed when the event stream (re)connects
+function resyncImages() {
+    const pageSize = document.getElementById('image-grid').dataset.pageSize;
+    fetch(`/images?limit=${pageSize}`)
     .then(response => response.json())
     .then(data => {
-        const imageGrid = document.getElementById('image-grid');
-        const noImagesMessage = document.getElementById('no-images-message');
-        const currentImages = Array.from(imageGrid.querySelectorAll('img')).map(img => img.getAttribute('src').split('/').pop());
-
-        // Update the image count with the length of images from the server
-        updateImageCount(data.images.length);
-
-        data.images.forEach(image => {
-            if (!currentImages.includes(image)) {
-                const col = document.createElement('div');
-                col.className = 'col';
-                col.id = `image-card-${image}`;
-                col.innerHTML = `
-                    <div class="card">
-                        <a href="#${image}" class="card-body text-center p-0 lightbox-trigger">
-                            <img src="/images/${image}" class="card-img-top" alt="${image}" style="object-fit: contain;">
-                        </a>
-                        <div id="${image}" class="lightbox" style="display: none;">
-                            <a href="#" class="close" style="position: absolute; top: 10px; right: 15px; color: white; font-size: 30px; text-decoration: none;">&times;</a>
-                            <img src="/images/${image}" alt="${image}">
-                        </div>
-                        <div class="card-footer">
-                            <div class="row gap-2">
-                                <button class="btn btn-outline-primary col-sm" data-image-name="${image}">Download</button>
-                                <button class="btn btn-outline-danger col-sm delete-image-btn" data-image-name="${image}">Delete</button>
-                            </div>
-                        </div>
-                    </div>`;
-                imageGrid.appendChild(col);
-                showAlert('New image added.', 'success');
-
-                // Remove the "No images found" message if present
-                if (noImagesMessage) {
-                    noImagesMessage.remove();
-                }
-
-                // Attach lightbox, download, and delete listeners for the new images
-                addLightboxListeners();
-                addDownloadListeners();
-                addDeleteListeners();
+        const serverImages = new Set(data.images);
+        currentImageNames().forEach(image => {
+            if (!serverImages.has(image)) {
+                removeImageCard(image);
             }
         });
+        data.images.forEach(image => addImageCard(image));
+        updateImageCount(data.total);
     })
     .catch(error => {
         console.error('Error fetching images:', error);
@@ -160,6 +189,32 @@ function fetchNewImages() {
     });
 }
 
+// Subscribe to image changes pushed by the server
+function subscribeToImageEvents() {
+    const source = new EventSource('/images/events');
+
+    source.addEventListener('open', resyncImages);
+    source.addEventListener('image-added', function(event) {
+        const data = JSON.parse(event.data);
+        changeImageCount(1);
+        if (addImageCard(data.image, true)) {
+            showAlert('New image added.', 'success');
+        }
+    });
+    source.addEventListener('image-deleted', function(event) {
+        const data = JSON.parse(event.data);
+        changeImageCount(-1);
+        removeImageCard(data.image);
+    });
+    source.addEventListener('images-cleared', function() {
+        currentImageNames().forEach(image => removeImageCard(image));
+        updateImageCount(0);
+    });
+    source.addEventListener('error', function() {
+        console.error('Image event stream disconnected, reconnecting...');
+    });
+}
+
 // Polling the queue endpoint every 4 seconds
 function fetchQueueStatus() {
     fetch('/queue')
@@ -193,15 +248,14 @@ function showAlert(message, type = 'success') {
 }
 
 
-const fetchQueueInterval = 20000; // Polling interval for queue and images
+const fetchQueueInterval = 20000; // Polling interval for queue
 
-// Start polling for new images and queue status
-setInterval(fetchNewImages, fetchQueueInterval);
+// Start polling for queue status, images are pushed by the server
 setInterval(fetchQueueStatus, fetchQueueInterval);
 
-// Initial call to populate queue status and images immediately
+// Initial call to populate queue status immediately
 fetchQueueStatus();
-fetchNewImages();
+subscribeToImageEvents();
 
 // Attach lightbox, download, and delete functionality to initially loaded images
 addLightboxListeners();